@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Conference server-side Python App Engine caching helpers
+
+"""
+
+from collections import OrderedDict
+import contextlib
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# How long a request may hold the right to recompute a missing value
+LEASE_SECONDS = 10
+
+# Attempts of versionedSet() at a compare-and-set racing with others
+CAS_RETRIES = 5
+
+# Entities held per instance, and for how long at most
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_TTL = 60
+
+# How often each instance re-reads the per-kind version stamps, and
+# how many stamps it holds at most
+VERSION_CHECK_SECONDS = 1
+VERSION_CACHE_SIZE = 1000
+
+
+def leasedSet(key, value):
+    """Store value under key, along with the stale copy that
+    leasedGet() falls back on."""
+    memcache.set_multi({key: value, key + ':stale': value})
+
+
+def _setNewer(client, key, value):
+    """Store a (version, value) pair under key unless memcache holds one
+    of the same or a later version."""
+    for _ in range(CAS_RETRIES):
+        current = client.gets(key)
+        if current is not None and current[0] >= value[0]:
+            return
+        if current is None:
+            stored = client.add(key, value)
+        else:
+            stored = client.cas(key, value)
+        if stored:
+            return
+
+
+def versionedSet(key, value):
+    """Like leasedSet(), for (version, value) pairs: a pair only
+    replaces one of an earlier version. Writes are compared and swapped
+    with gets and cas, so a writer holding an older value can't
+    overwrite a newer one that was stored after it read."""
+    client = memcache.Client()
+    _setNewer(client, key, value)
+    _setNewer(client, key + ':stale', value)
+
+
+def leasedGet(key, recompute, default=None, store=leasedSet):
+    """Return the value cached under key, recomputing it on a miss.
+
+    Only the request that wins the lease (a memcache add) calls
+    recompute(), and writes its value with store(); concurrent readers
+    get the last good value instead of all hitting the datastore at
+    once.
+    """
+    value = memcache.get(key)
+    if value is not None:
+        return value
+
+    lease = key + ':lease'
+    if memcache.add(lease, 1, time=LEASE_SECONDS):
+        try:
+            value = recompute()
+            store(key, value)
+        finally:
+            memcache.delete(lease)
+        return value
+
+    value = memcache.get(key + ':stale')
+    return default if value is None else value
+
+
+class LocalCache(object):
+    """Bounded, thread-safe LRU of values held in instance memory.
+
+    Each value is stored with the version it was read at and is only
+    returned while that version is still current and its TTL has not
+    run out.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[0] != version or item[1] < time.time():
+                self.misses += 1
+                return None
+            # Re-insert as the most recently used
+            self._items[key] = item
+            self.hits += 1
+            return item[2]
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (version, time.time() + self.ttl, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'maxSize': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+_entities = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+_values = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+_adapter = ndb.ModelAdapter()
+
+# Version stamps as last read from memcache, as (version, time read)
+# by name, least recently read first
+_versions = OrderedDict()
+_versions_lock = threading.Lock()
+
+# Version bumps collected by the innermost bumpBatch() of each thread
+_batch = threading.local()
+
+
+def _setVersion(name, version, checked):
+    """Hold a version stamp read at `checked`; call with _versions_lock."""
+    _versions.pop(name, None)
+    _versions[name] = (version, checked)
+    while len(_versions) > VERSION_CACHE_SIZE:
+        _versions.popitem(last=False)
+
+
+def _versionKey(kind):
+    return 'version:' + kind
+
+
+def entityStamp(key):
+    """Name of the version stamp of a LocallyCachedModel entity."""
+    return '%s:%s' % (key.kind(), key.urlsafe())
+
+
+def versionStamps(names):
+    """Return the current value of each named version stamp, read
+    from memcache; stamps are None while memcache is unavailable."""
+    stamps = memcache.get_multi([_versionKey(name) for name in names])
+    for name in names:
+        if _versionKey(name) not in stamps:
+            # Start lost stamps from the clock so that they never repeat
+            # a version entries may have been cached at
+            memcache.add(_versionKey(name), int(time.time() * 1000))
+            stamps[_versionKey(name)] = memcache.get(_versionKey(name))
+    return dict((name, stamps[_versionKey(name)]) for name in names)
+
+
+def kindVersions(kinds):
+    """Return the current version stamp of each kind, re-reading each
+    stamp from memcache at most every VERSION_CHECK_SECONDS. Stamps
+    can also be named after other things than kinds, see localGet()."""
+    now = time.time()
+    with _versions_lock:
+        known = dict((kind, _versions[kind][0]) for kind in kinds
+                     if kind in _versions and
+                     now - _versions[kind][1] < VERSION_CHECK_SECONDS)
+    stale = [kind for kind in kinds if kind not in known]
+    if not stale:
+        return known
+
+    stamps = versionStamps(stale)
+    with _versions_lock:
+        for kind, version in stamps.items():
+            _setVersion(kind, version, now)
+    known.update(stamps)
+    return known
+
+
+def bumpVersion(*names):
+    """Change the named version stamps, e.g. to invalidate every locally
+    cached entity of a kind on all instances within
+    VERSION_CHECK_SECONDS."""
+    versions = memcache.offset_multi(
+        dict((_versionKey(name), 1) for name in names),
+        initial_value=int(time.time() * 1000))
+    with _versions_lock:
+        # Only stamps this instance reads are worth holding
+        for name in names:
+            if (name in _versions and
+                    versions.get(_versionKey(name)) is not None):
+                _setVersion(name, versions[_versionKey(name)], time.time())
+
+
+def bumpVersionOnCommit(*names):
+    """Bump the named version stamps once the current transaction
+    commits, at the end of the enclosing bumpBatch(), or else right
+    away. The stamps of one transaction or batch are bumped with a
+    single offset_multi."""
+    if ndb.in_transaction():
+        ctx = ndb.get_context()
+        pending = getattr(ctx, '_pending_bumps', None)
+        if pending is None:
+            pending = ctx._pending_bumps = set()
+            ctx.call_on_commit(lambda: bumpVersion(*pending))
+        pending.update(names)
+        return
+    pending = getattr(_batch, 'pending', None)
+    if pending is None:
+        bumpVersion(*names)
+    else:
+        pending.update(names)
+
+
+@contextlib.contextmanager
+def bumpBatch():
+    """Collect the version bumps of the writes made outside transactions
+    within the block, e.g. by one put_multi(), and send them at its end."""
+    if getattr(_batch, 'pending', None) is not None:
+        yield
+        return
+    _batch.pending = set()
+    try:
+        yield
+    finally:
+        pending, _batch.pending = _batch.pending, None
+        if pending:
+            bumpVersion(*pending)
+
+
+def cachedGetMulti(keys):
+    """Like ndb.get_multi(), but serve entities from the instance cache
+    while their kind's version is unchanged.
+
+    The entities returned are copies, so callers may modify them, but
+    they can be up to VERSION_CHECK_SECONDS old: read-modify-write paths
+    should keep using ndb directly.
+    """
+    versions = kindVersions(set(key.kind() for key in keys))
+    found = {}
+    for key in keys:
+        pb = _entities.get(key, versions[key.kind()])
+        if pb is not None:
+            found[key] = _adapter.pb_to_entity(pb)
+
+    missing = list(set(key for key in keys if key not in found))
+    for key, entity in zip(missing, ndb.get_multi(missing)):
+        found[key] = entity
+        if entity is not None:
+            # Cache at the version read before the fetch, so a write
+            # racing with it leaves this copy already out of date
+            _entities.set(key, versions[key.kind()],
+                          _adapter.entity_to_pb(entity))
+    return [found[key] for key in keys]
+
+
+def cachedGet(key):
+    """Single key version of cachedGetMulti()."""
+    return cachedGetMulti([key])[0]
+
+
+def localGet(key, stamp, recompute):
+    """Like leasedGet(), but keep the value in instance memory while the
+    version stamp named `stamp` is unchanged; bumpVersion(stamp) after
+    leasedSet() to replace it everywhere. Values are shared between
+    requests and must not be modified."""
+    version = kindVersions([stamp])[stamp]
+    value = _values.get(key, version)
+    if value is None:
+        value = leasedGet(key, recompute)
+        if value is not None:
+            _values.set(key, version, value)
+    return value
+
+
+def localCacheStats():
+    """Return the size and hit rate of this instance's caches."""
+    return {'entities': _entities.stats(), 'values': _values.stats()}
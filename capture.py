@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""capture.py
+
+Conference server-side Python App Engine call capture, recording
+ConferenceApi calls as JSON log lines that replay.py can play back
+
+"""
+
+import functools
+import json
+import logging
+import time
+
+import endpoints
+from protorpc import protojson
+
+import settings
+
+# Captured calls are logged as CAPTURE_PREFIX followed by one JSON object
+CAPTURE_PREFIX = 'CAPTURE '
+
+
+def capturedCall(func):
+    """Log the method, request, user and outcome of each call of an
+    endpoints method when settings.CAPTURE_CALLS is on."""
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if not getattr(settings, 'CAPTURE_CALLS', False):
+            return func(self, request)
+
+        try:
+            user = endpoints.get_current_user()
+        except Exception:
+            # e.g. when called by a main.py handler, not through the API
+            user = None
+        record = {
+            'ts': time.time(),
+            'method': func.__name__,
+            'request': json.loads(protojson.encode_message(request)),
+            'user': user.email() if user else None,
+        }
+        try:
+            return func(self, request)
+        except Exception as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['latency'] = time.time() - record['ts']
+            logging.info(CAPTURE_PREFIX + json.dumps(record))
+    return wrapper
@@ -8,61 +8,230 @@ conference.py -- conference server-side Python App Engine API;
 
 
 
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import deque
+from cStringIO import StringIO
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
 
+import base64
+import csv
+import heapq
 import json
+import logging
+import threading
 import endpoints
 
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import app_identity
+from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import Announcement
+from models import BatchJob
+from models import BatchOutput
+from models import BatchShard
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
 from models import BooleanMessage
+from models import BulkResultForm
+from models import BulkResultForms
+from models import ChangesForm
+from models import NowAndNextForm
+from models import TimelineSessionForm
 
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceKeysForm
+from models import GroupRegistrationForm
 
 from models import TeeShirtSize
+from models import Tombstone
+from models import TombstoneForm
+from models import UniqueValue
+from models import WaitlistEntry
+
+from models import ImportChunk
+from models import ImportForm
+from models import ImportJob
+from models import ImportJobForm
 
 from models import SessionForms
 from models import Session
 from models import SessionForm
 from models import SessionQueryForm
 from models import SessionQueryForms
+from models import SessionNeighbours
 
 from models import Speaker
 from models import SpeakerForm
 from models import SpeakerForms
+from models import SpeakerEntryForm
+from models import SpeakerDirectoryForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
+from cache import leasedGet
+from cache import leasedSet
+from cache import versionedSet
+from cache import bumpVersion
+from cache import entityStamp
+from cache import localGet
+from capture import capturedCall
+from loader import KeyLoader
+from ratelimit import rateLimited
+from storage import getStorage
 from utils import getUserId
+from utils import normalizeName
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+# Cached as (Announcement version, text), see _cacheAnnouncement()
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS_VERSIONED"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+# Conferences with 0 < seatsAvailable <= ANNOUNCEMENT_SEATS are announced
+ANNOUNCEMENT_SEATS = 5
+ANNOUNCEMENT_KEY = ndb.Key(Announcement, 'nearly_sold_out')
 
 FEATURED_SPEAKER_TPL = ('Featured Speaker: %s')
 MEMCACHE_FS_KEY = "FEATURED_SPEAKER"
 
+# Outgoing mail is buffered in a pull queue and drained by a cron job
+MAIL_QUEUE = 'mail'
+MAIL_LEASE_SECONDS = 60
+MAIL_BATCH_SIZE = 100
+MAIL_DRAIN_ROUNDS = 5
+MAIL_SEND_CONCURRENCY = 5
+MAIL_MAX_RETRIES = 5
+CONFIRMATION_EMAIL_SUBJECT = 'You created a new Conference!'
+CONFIRMATION_EMAIL_TPL = ('Hi, you have created a following '
+                          'conference:\r\n\r\n%s')
+
+# Conference timelines compare times as strings in TIMELINE_FORMAT;
+# getNowAndNext returns up to TIMELINE_UPCOMING upcoming sessions
+TIMELINE_FORMAT = '%Y-%m-%dT%H:%M'
+TIMELINE_UPCOMING = 5
+TIMELINE_MAX_UPCOMING = 50
+
+# getChangesSince pages through entities modified up to SYNC_LAG_SECONDS
+# ago, so that writes still becoming visible to queries aren't skipped;
+# tokens older than tombstones are kept for can't be used
+SYNC_PAGE_SIZE = 100
+SYNC_LAG_SECONDS = 30
+SYNC_TOMBSTONE_DAYS = 30
+
+# Largest number of entities written per put_multi() by bulk endpoints
+BULK_PUT_CHUNK = 500
+
+# Most registrations accepted by one bundle registration call, which is
+# also the most conferences or sessions one bulk create call accepts,
+# and most users an organizer may register at once with a group
+# registration
+REGISTRATION_BATCH_MAX = 100
+GROUP_REGISTRATION_MAX = 25
+
+# Waiting users are promoted by tasks in batches of up to
+# WAITLIST_BATCH, WAITLIST_DELAY seconds after seats are freed so that
+# several unregistrations are handled together
+WAITLIST_BATCH = 50
+WAITLIST_DELAY = 5
+WAITLIST_EMAIL_SUBJECT = 'A seat has freed up for you'
+WAITLIST_EMAIL_TPL = ('Hi, a seat at %s has freed up and you have been '
+                      'registered for the conference from its waitlist.')
+
+# Attendees are emailed when a conference's dates or city change; the
+# notify_attendees task buffers the emails of NOTIFY_PAGE_SIZE attendees
+# at a time in the mail queue. The mail cron only sends
+# MAIL_DRAIN_ROUNDS * MAIL_BATCH_SIZE emails a minute, so each page also
+# queues a send_queued_emails task of its own; a notification is then
+# sent as fast as its pages run, up to the Mail API's sending quota
+NOTIFY_PAGE_SIZE = 500
+NOTIFY_FIELDS = [('startDate', 'Start date'), ('endDate', 'End date'),
+                 ('city', 'City')]
+NOTIFY_EMAIL_SUBJECT = 'Conference update: %s'
+NOTIFY_EMAIL_TPL = ('Hi, the following details of %s, which you are '
+                    'registered for, have changed:\r\n\r\n%s')
+
+# Batch sizes of the cleanup tasks of a deleted conference
+CLEANUP_SESSION_BATCH = 100
+CLEANUP_PROFILE_BATCH = 200
+
+# Page sizes of getSpeakerDirectory
+SPEAKER_PAGE_SIZE = 20
+SPEAKER_MAX_PAGE_SIZE = 100
+
+# Number of sessions fetched per batch by the program export
+EXPORT_BATCH_SIZE = 200
+
+# Session imports are written by tasks on the import queue, one task per
+# chunk of IMPORT_CHUNK_SIZE rows
+IMPORT_QUEUE = 'import'
+IMPORT_CHUNK_SIZE = 200
+IMPORT_FIELDS = ['name', 'highlights', 'speaker', 'duration',
+                 'typeOfSession', 'date', 'startTime']
+
+# The speakers of an imported chunk are recounted from a query of their
+# sessions once the chunk is done, after giving the index time to catch up
+SPEAKER_RECOUNT_DELAY = 10
+
+# Session.speaker and the Profile key lists used to hold urlsafe strings;
+# speaker queries also match those until _migrateEntities has rewritten
+# every entity
+MATCH_LEGACY_KEYS = True
+MIGRATION_BATCH_SIZE = 100
+
+# Entities rewritten per migration transaction; a Speaker brings the
+# root entity group of its name marker, and a transaction spans at most
+# 25 groups. New speakers are created in transactions of as many
+UNIQUE_ROOT_BATCH = 12
+
+# Sessions written before session names were claimed with UniqueValue
+# markers have none; new names are also checked against the stored
+# sessions until the Session migration has written the missing markers
+CHECK_LEGACY_SESSION_NAMES = True
+
+# Speakers are found by the UniqueValue markers of their normalized
+# names; those created before the markers existed are also looked up by
+# name until the Speaker migration has written their markers
+CHECK_LEGACY_SPEAKER_NAMES = True
+
+# BatchJobs scan Profiles in BATCH_SHARDS parallel chains of tasks on the
+# batch queue; each task reads pages of BATCH_PAGE_SIZE for about
+# BATCH_STEP_SECONDS, writing its output as BatchOutput parts whenever it
+# holds BATCH_FLUSH_ENTRIES entries. Jobs with large outputs combine them
+# in BATCH_REDUCERS tasks, each reducing the keys of one key range
+BATCH_QUEUE = 'batch'
+BATCH_SHARDS = 32
+BATCH_OVERSAMPLE = 10
+BATCH_PAGE_SIZE = 500
+BATCH_STEP_SECONDS = 60
+BATCH_FLUSH_ENTRIES = 20000
+BATCH_REDUCERS = 8
+BATCH_MAX_MESSAGES = 1000
+
+# Sessions kept per session by the recommend_sessions job; longer
+# wishlists only count their first RECOMMEND_MAX_WISHLIST sessions
+RECOMMEND_TOP_K = 10
+RECOMMEND_MAX_WISHLIST = 100
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -88,6 +257,47 @@ FIELDS = {
             'MAX_ATTENDEES': 'maxAttendees',
 }
 
+# Properties that fill in each projectable form field, for list
+# endpoints called with `fields`; None needs only the key. Other fields,
+# e.g. the repeated topics, need the whole entity
+CONFERENCE_FIELD_PROPERTIES = {
+    'name': 'name',
+    'description': 'description',
+    'organizerUserId': 'organizerUserId',
+    'organizerDisplayName': 'organizerUserId',
+    'city': 'city',
+    'startDate': 'startDate',
+    'month': 'month',
+    'endDate': 'endDate',
+    'maxAttendees': 'maxAttendees',
+    'seatsAvailable': 'seatsAvailable',
+    'websafeKey': None,
+}
+SESSION_FIELD_PROPERTIES = {
+    'name': 'name',
+    'highlights': 'highlights',
+    'speaker': 'speaker',
+    'duration': 'duration',
+    'typeOfSession': 'typeOfSession',
+    'date': 'date',
+    'startTime': 'startTime',
+    'websafeConfKey': None,
+    'sessionKey': None,
+}
+# Session projections that index.yaml declares an ancestor index for;
+# other field sets fetch whole entities instead of failing over to them
+# on NeedIndexError
+SESSION_PROJECTIONS = [
+    ['name'],
+    ['date'],
+    ['date', 'name', 'startTime'],
+    ['date', 'duration', 'name', 'speaker', 'startTime', 'typeOfSession'],
+]
+# Projection queries only return entities that have every projected
+# property; enable once the Conference migration has written `deleted`
+# on every conference
+CONFERENCE_PROJECTIONS = False
+
 SESS_FIELDS = {
     'TYPE': 'typeOfSession',
     'NAME': 'name',
@@ -106,14 +316,37 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1, required=True),
 )
 
+GROUP_REGISTRATION_REQUEST = endpoints.ResourceContainer(
+    GroupRegistrationForm,
+    websafeConferenceKey=messages.StringField(1, required=True),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1, required=True),
 )
 
+NOW_AND_NEXT_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1, required=True),
+    now=messages.StringField(2),
+    count=messages.IntegerField(3, variant=messages.Variant.INT32)
+)
+
+CHANGES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    token=messages.StringField(1)
+)
+
 SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    websafeConfKey=messages.StringField(1, required=True)
+    websafeConfKey=messages.StringField(1, required=True),
+    fields=messages.StringField(2, repeated=True)
+)
+
+FIELDS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True)
 )
 
 SPEAKER_CONF_REQUEST = endpoints.ResourceContainer(
@@ -138,6 +371,29 @@ DATE_REQUEST = endpoints.ResourceContainer(
     startDate=messages.StringField(1, required=True)
 )
 
+IMPORT_JOB_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeJobKey=messages.StringField(1, required=True)
+)
+
+SPEAKER_DIRECTORY_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    websafeCursor=messages.StringField(3)
+)
+
+SPEAKERS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    websafeCursor=messages.StringField(2)
+)
+
+RECOMMENDATIONS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    sessionKey=messages.StringField(1, required=True)
+)
+
 WISHLIST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     sessionKey=messages.StringField(1, required=True)
@@ -158,10 +414,13 @@ class ConferenceApi(remote.Service):
 #----- Session objects -------------------------------------
 
     # Copy a session object object to the SessionForm
-    def _copySessionToForm(self, sess, displayName=None):
-        """Copy relevant fields from Session to SessionForm"""
+    def _copySessionToForm(self, sess, displayName=None, fields=None):
+        """Copy relevant fields from Session to SessionForm, or only
+        those in `fields` if given"""
         sf = SessionForm()
         for field in sf.all_fields():
+            if fields and field.name not in fields:
+                continue
             if hasattr(sess, field.name):
                 # Convert date to date string, copy others
                 if field.name.endswith('date'):
@@ -170,6 +429,9 @@ class ConferenceApi(remote.Service):
                     setattr(sf, field.name, str(getattr(sess, field.name)))
                 elif field.name.endswith('duration'):
                     setattr(sf, field.name, str(getattr(sess, field.name)))
+                elif field.name == 'speaker':
+                    setattr(sf, field.name,
+                            sess.speaker and sess.speaker.urlsafe())
                 else:
                     setattr(sf, field.name, getattr(sess, field.name))
             if field.name == "websafeConfKey":
@@ -190,49 +452,21 @@ class ConferenceApi(remote.Service):
         sf.check_initialized()
         return sf
 
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning SessionForm/request."""
-        # Get the user saved in session
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    def _sessionDataFromForm(self, request):
+        """Copy a SessionForm into a dict of Session properties."""
         if not request.name:
             raise endpoints.BadRequestException(
                 "Session 'name' field required")
-        
-        c_key = ndb.Key(urlsafe=request.websafeConfKey)
-
-        # Check that the name is unique within the conference
-        name_check = Session.query(ancestor=c_key)
-        name_check = name_check.filter(Session.name==request.name).get()
-        
-        if name_check:
-            raise endpoints.BadRequestException(
-                "Entity with name '%s' already exists" % request.name)
-
-
-        # Check that the conference exists
-        conf = c_key.get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conf with key: %s' % request.websafeConferenceKey)
-
-        # Check that the user is the conference organizer
-        if user_id != conf.organizerUserId:
-            raise endpoints.ForbiddenException(
-                'Only the organizer may update the conference')
 
         # Copy SessionForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
-        
+
         # Delete unnecessary fields from the form
         del data['displayName']
-        del data['websafeConfKey'] 
+        del data['websafeConfKey']
         del data['sessionKey']
-        
+
         # Convert date from string into Date object;
         if data['date']:
             data['date'] = datetime.strptime(
@@ -248,130 +482,663 @@ class ConferenceApi(remote.Service):
                     data['duration'][:5], "%H:%M").time()
             except:
                 raise endpoints.BadRequestException("Duration Must be in 'HH:MM' format")
-            
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
+        return data
+
+    @staticmethod
+    def _speakerKeysForNames(names):
+        """Return a dict of speaker name -> Speaker key, creating
+        Speaker entities for the names that don't exist yet. Names are
+        matched normalized, with one get of the markers of all of them;
+        new speakers are put with their markers in transactions, so
+        concurrent requests don't create the same speaker twice."""
+        storage = getStorage()
+        names_by_key = {}
+        for name in set(names):
+            names_by_key.setdefault(
+                ConferenceApi._speakerNameKey(name), []).append(name)
+        m_keys = names_by_key.keys()
+        owners = dict((marker.key, marker.owner)
+                      for marker in storage.getMulti(m_keys) if marker)
+
+        missing = [key for key in m_keys if key not in owners]
+        legacy = {}
+        if missing and CHECK_LEGACY_SPEAKER_NAMES:
+            unmarked = [name for key in missing for name in names_by_key[key]]
+            # IN filters take at most 30 values
+            for i in range(0, len(unmarked), 30):
+                for speaker in storage.query(
+                        Speaker, filters=[('name', 'IN', unmarked[i:i + 30])]):
+                    legacy.setdefault(
+                        ConferenceApi._speakerNameKey(speaker.name),
+                        speaker.key)
+        if not missing:
+            return ConferenceApi._namesToOwners(names_by_key, owners)
+
+        # Allocate the ids of all the new speakers as one range
+        new = [key for key in missing if key not in legacy]
+        first = storage.allocateIds(Speaker, len(new))[0] if new else 0
+        s_ids = dict(zip(new, range(first, first + len(new))))
+
+        def claim(m_keys):
+            claimed = {}
+            entities = []
+            for key, marker in zip(m_keys, storage.getMulti(m_keys)):
+                if marker:
+                    # Created by a concurrent request
+                    claimed[key] = marker.owner
+                    continue
+                owner = legacy.get(key)
+                if owner is None:
+                    name = names_by_key[key][0]
+                    owner = ndb.Key(Speaker, s_ids[key])
+                    entities.append(Speaker(key=owner, name=name,
+                                            normalizedName=normalizeName(name)))
+                entities.append(UniqueValue(key=key, owner=owner))
+                claimed[key] = owner
+            storage.putMulti(entities)
+            return claimed
+
+        for i in range(0, len(missing), UNIQUE_ROOT_BATCH):
+            batch = missing[i:i + UNIQUE_ROOT_BATCH]
+            owners.update(storage.transaction(lambda: claim(batch), xg=True))
+        return ConferenceApi._namesToOwners(names_by_key, owners)
+
+    @staticmethod
+    def _namesToOwners(names_by_key, owners):
+        """Map each name to the owner of its marker."""
+        return dict((name, owners[key])
+                    for key, names in names_by_key.items() for name in names)
+
+    @staticmethod
+    def _countSpeakerSessions(sessions):
+        """Add new sessions to the session and conference counts of
+        their speakers."""
+        by_speaker = {}
+        for sess in sessions:
+            if sess.speaker:
+                by_speaker.setdefault(sess.speaker, []).append(
+                    sess.key.parent())
+
+        storage = getStorage()
+
+        def update(speaker_key, c_keys):
+            speaker = storage.get(speaker_key)
+            if not speaker:
+                return
+            speaker.sessionCount = (speaker.sessionCount or 0) + len(c_keys)
+            for c_key in set(c_keys):
+                if c_key not in speaker.conferenceKeys:
+                    speaker.conferenceKeys.append(c_key)
+            speaker.conferenceCount = len(speaker.conferenceKeys)
+            storage.put(speaker)
+
+        # One transaction per speaker
+        for speaker_key, c_keys in by_speaker.items():
+            storage.transaction(lambda: update(speaker_key, c_keys))
+
+    @staticmethod
+    def _queueSpeakerRecount(speaker_keys):
+        """Queue the recount of speakers; inside a transaction the task
+        only runs if it commits."""
+        taskqueue.add(params={'speakerKey': [speaker_key.urlsafe()
+                                             for speaker_key in speaker_keys]},
+                      url='/tasks/recount_speakers',
+                      countdown=SPEAKER_RECOUNT_DELAY,
+                      transactional=ndb.in_transaction())
+
+    @staticmethod
+    def _recountSpeakers(speaker_keys):
+        """Set the session and conference counts of speakers to those
+        of a query of their sessions; used by the recount_speakers task.
+        Unlike _countSpeakerSessions(), running it again is harmless."""
+        speakers = [s for s in ndb.get_multi(speaker_keys) if s]
+
+        @ndb.transactional
+        def update(speaker_key, values):
+            speaker = speaker_key.get()
+            if speaker:
+                speaker.populate(**values)
+                speaker.put()
+
+        for speaker_key, values in ConferenceApi._speakerCounts(
+                speakers).items():
+            update(speaker_key, values)
+
+    @staticmethod
+    def _speakerCounts(speakers):
+        """Count the sessions and conferences of speakers from a query
+        of their sessions; used to backfill the counts kept on Speaker."""
+        futures = [Session.query(ConferenceApi._keyFilter(
+            Session.speaker, speaker.key)).fetch_async(keys_only=True)
+            for speaker in speakers]
+        counts = {}
+        for speaker, future in zip(speakers, futures):
+            s_keys = future.get_result()
+            c_keys = list(set(s_key.parent() for s_key in s_keys))
+            counts[speaker.key] = {
+                'normalizedName': normalizeName(speaker.name),
+                'sessionCount': len(s_keys),
+                'conferenceKeys': c_keys,
+                'conferenceCount': len(c_keys),
+            }
+        return counts
+
+    @staticmethod
+    def _uniqueValueKey(scope, field, value):
+        """Return the key of the UniqueValue marker of a value of field,
+        unique within the entity group of the scope key, or among all
+        entities if scope is None."""
+        return ndb.Key(UniqueValue, u'%s|%s' % (field, normalizeName(value)),
+                       parent=scope)
+
+    @staticmethod
+    def _claimUniqueValues(claims):
+        """Claim (marker key, owner key) pairs with one get; must run in
+        a transaction on the markers' entity groups, which also puts the
+        owners. Return, per pair, the UniqueValue to put with the owner,
+        or None if the value belongs to another entity."""
+        markers = []
+        claimed = set()
+        keys = [key for key, _ in claims]
+        for (key, owner), marker in zip(claims, getStorage().getMulti(keys)):
+            if key in claimed or (marker and marker.owner != owner):
+                markers.append(None)
+                continue
+            claimed.add(key)
+            markers.append(UniqueValue(key=key, owner=owner))
+        return markers
+
+    @staticmethod
+    def _speakerNameKey(name):
+        """Return the key of the marker of a speaker name."""
+        return ConferenceApi._uniqueValueKey(None, 'Speaker.name', name)
+
+    @staticmethod
+    def _sessionNameKey(c_key, name):
+        """Return the key of the marker of a session name."""
+        return ConferenceApi._uniqueValueKey(c_key, 'Session.name', name)
+
+    @staticmethod
+    def _legacySessionNames(c_key, name=None):
+        """Return a dict of name -> key of the sessions of a conference,
+        or of the one named name if any, for sessions that may predate
+        name markers; empty once CHECK_LEGACY_SESSION_NAMES is off."""
+        if not CHECK_LEGACY_SESSION_NAMES:
+            return {}
+        storage = getStorage()
+        if name is not None:
+            s_key = storage.first(
+                Session, ancestor=c_key, filters=[('name', '=', name)],
+                keysOnly=True)
+            return {name: s_key} if s_key else {}
+        return dict((sess.name, sess.key) for sess in storage.query(
+            Session, ancestor=c_key, projection=['name']))
+
+    @staticmethod
+    def _putNamedSessions(c_key, sessions):
+        """Put new sessions of a conference together with the markers of
+        their names, in one transaction, skipping those whose name is
+        already taken, and return the sessions that were put. Sessions
+        that were put already, e.g. by a retried import chunk, keep
+        their names and are put again."""
+        def put():
+            markers = ConferenceApi._claimUniqueValues(
+                [(ConferenceApi._sessionNameKey(c_key, sess.name), sess.key)
+                 for sess in sessions])
+            legacy = ConferenceApi._legacySessionNames(
+                c_key, sessions[0].name if len(sessions) == 1 else None)
+            named = [(sess, marker) for sess, marker in zip(sessions, markers)
+                     if marker and legacy.get(sess.name, sess.key) == sess.key]
+            getStorage().putMulti([sess for sess, _ in named] +
+                                  [marker for _, marker in named])
+            return [sess for sess, _ in named]
+        return getStorage().transaction(put)
+
+    def _createSessionObject(self, request):
+        """Create or update Session object, returning SessionForm/request."""
+        # Get the user saved in session
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        data = self._sessionDataFromForm(request)
+
+        c_key = ndb.Key(urlsafe=request.websafeConfKey)
+
+        # Check that the conference exists and that the name is free
+        # within it; the name is only claimed when the session is put
+        conf, taken = getStorage().getMulti(
+            [c_key, self._sessionNameKey(c_key, request.name)])
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conf with key: %s' % request.websafeConfKey)
+
+        # Check that the user is the conference organizer
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer may update the conference')
+
+        if taken:
+            raise endpoints.BadRequestException(
+                "Entity with name '%s' already exists" % request.name)
+
+        s_id = getStorage().allocateIds(Session, 1, parent=c_key)[0]
         s_key = ndb.Key(Session, s_id, parent=c_key)
 
         data['key'] = s_key
-        
+
         if data['speaker']:
-            print 'In createSession, there is a speaker...'
-            # Check to see if the speaker already exists
-            speaker = Speaker.query(Speaker.name == data['speaker']).get()
+            # Set the session speaker to the speaker's key,
+            # creating a Speaker entity for new speakers
+            data['speaker'] = self._speakerKeysForNames(
+                [data['speaker']])[data['speaker']]
+
+        #Put the session in the database
+        sess = Session(**data)
+        if not self._putNamedSessions(c_key, [sess]):
+            raise endpoints.BadRequestException(
+                "Entity with name '%s' already exists" % request.name)
+
+        if sess.speaker:
+            self._countSpeakerSessions([sess])
 
-            # If the speaker doesn't exist, create a Speaker entity for them    
-            if not speaker:
-                speaker_id = Speaker.allocate_ids(size=1)[0]
-                speaker_key = ndb.Key(Speaker, speaker_id)
-                speaker = Speaker()
-                speaker.populate(
-                    key=speaker_key,
-                    name=data['speaker']
-                )
-                
-                speaker.put()
-            else:
-                speaker_key = speaker.key
-            
-        
-            # Set the session speaker to the speaker's urlsafe key
-            data['speaker'] = speaker_key.urlsafe()
-            
-            #Put the session in the database
-            Session(**data).put()
-            
             # Use the TaskQueue to check whether the new session's
             # speaker should be the next featured speaker.
             taskqueue.add(
-                params={'sessionKey': s_key.urlsafe()},
+                params={'websafeConferenceKey': c_key.urlsafe()},
                 url='/tasks/set_featured_speaker'
             )
-            
-        else:
-            #Put the session in the database
-            Session(**data).put()
+
+        bumpVersion('sessions:' + c_key.urlsafe())
+        self._queueTimelineUpdate(c_key)
 
         return request
-    
-    
+
+    def _createSessionObjects(self, request):
+        """Create Sessions in bulk, returning a BulkResultForm per item."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        if len(request.items) > REGISTRATION_BATCH_MAX:
+            raise endpoints.BadRequestException(
+                'At most %d sessions per call' % REGISTRATION_BATCH_MAX)
+
+        results = [BulkResultForm(index=i, success=False)
+                   for i in range(len(request.items))]
+
+        # Validate every form and group them by conference
+        by_conf = {}
+        for i, form in enumerate(request.items):
+            try:
+                data = self._sessionDataFromForm(form)
+            except (endpoints.BadRequestException, ValueError) as e:
+                results[i].error = str(e)
+                continue
+            try:
+                c_key = ndb.Key(urlsafe=form.websafeConfKey)
+            except Exception:
+                results[i].error = 'Invalid websafeConfKey: %s' % (
+                    form.websafeConfKey)
+                continue
+            by_conf.setdefault(c_key, []).append((i, data))
+
+        storage = getStorage()
+        c_keys = by_conf.keys()
+        accepted = {}
+        for c_key, conf in zip(c_keys, storage.getMulti(c_keys)):
+            items = by_conf[c_key]
+            if not conf or conf.deleted:
+                error = 'No conf with key: %s' % c_key.urlsafe()
+            elif user_id != conf.organizerUserId:
+                error = 'Only the organizer may update the conference'
+            else:
+                error = None
+            if error:
+                for i, _ in items:
+                    results[i].error = error
+                continue
+
+            # Names must be unique within the conference, both against
+            # the claimed names and within this batch
+            name_keys = [self._sessionNameKey(c_key, data['name'])
+                         for _, data in items]
+            taken = set(marker.key for marker in storage.getMulti(name_keys)
+                        if marker)
+            for (i, data), name_key in zip(items, name_keys):
+                if name_key in taken:
+                    results[i].error = (
+                        "Entity with name '%s' already exists" % data['name'])
+                else:
+                    taken.add(name_key)
+                    accepted.setdefault(c_key, []).append((i, data))
+
+        # Resolve all the speakers with one batched lookup
+        speaker_keys = self._speakerKeysForNames(
+            [data['speaker'] for items in accepted.values()
+             for _, data in items if data['speaker']])
+
+        sessions = []
+        featured = set()
+        for c_key, items in accepted.items():
+            # Allocate the ids for the conference as a single range
+            first, last = storage.allocateIds(Session, len(items),
+                                              parent=c_key)
+            batch = []
+            for s_id, (i, data) in zip(range(first, last + 1), items):
+                data['key'] = ndb.Key(Session, s_id, parent=c_key)
+                if data['speaker']:
+                    data['speaker'] = speaker_keys[data['speaker']]
+                batch.append((i, Session(**data)))
+
+            # Each session is written with the marker of its name, so a
+            # chunk puts twice as many entities
+            step = BULK_PUT_CHUNK // 2
+            for j in range(0, len(batch), step):
+                chunk = batch[j:j + step]
+                put = set(sess.key for sess in self._putNamedSessions(
+                    c_key, [sess for _, sess in chunk]))
+                for i, sess in chunk:
+                    if sess.key not in put:
+                        results[i].error = (
+                            "Entity with name '%s' already exists" % sess.name)
+                        continue
+                    results[i].success = True
+                    results[i].websafeKey = sess.key.urlsafe()
+                    sessions.append(sess)
+                    if sess.speaker:
+                        featured.add(c_key)
+
+        self._countSpeakerSessions(sessions)
+
+        # Recompute the featured speaker once per conference
+        for c_key in featured:
+            taskqueue.add(
+                params={'websafeConferenceKey': c_key.urlsafe()},
+                url='/tasks/set_featured_speaker'
+            )
+        for c_key in set(sess.key.parent() for sess in sessions):
+            bumpVersion('sessions:' + c_key.urlsafe())
+            self._queueTimelineUpdate(c_key)
+
+        return BulkResultForms(items=results)
+
+
     @staticmethod
-    def _cacheFeaturedSpeaker(session_key):
-        """Assign Featured Speaker to memcache; used by getFeaturedSpeaker"""
-        # Use the urlsafe key to grab the session key
-        session = ndb.Key(urlsafe=session_key).get()
-        # Set the key for the memcache based on the confKey
-        featured = 'fs_' + str(session.key.parent().urlsafe())     
-        print 'In cacheFeaturedSpeaker'
-        # Get all of the sessions for the conference
-        sessions = Session.query(ancestor=session.key.parent()).fetch()
-        count = 0
-        # Iterate through the sessions to find the speaker with the most sessions
+    def _featuredSpeakerJson(c_key):
+        """Return the speaker with the most sessions at the conference
+        and their session names as a JSON string, or "" if no session
+        has a speaker."""
+        # One projection query instead of a count per session
+        sessions = getStorage().query(Session, ancestor=c_key,
+                                      projection=['speaker', 'name'])
+        by_speaker = {}
         for sess in sessions:
-            spk_sess = Session.query(ancestor=session.key.parent()).filter(Session.speaker==sess.speaker)
-            spk_count = spk_sess.count()
-            if spk_count > count:
-                count = spk_count
-                # Save the speaker and sessions for the speaker with the most
-                featured_speaker = sess.speaker
-                fs_sessions = spk_sess
-        # Grab the speaker
-        speaker = ndb.Key(urlsafe=featured_speaker).get()
-        # Set the speaker name and their sessions in a string
-        fs_data = {}
-        fs_data['name'] = speaker.name
-        fs_data['sessions'] = []
-        for sess in fs_sessions:
-            fs_data['sessions'].append(sess.name)
-        mem_val = json.dumps(fs_data)
-        # Set the created json string in memcache
-        memcache.set(key=featured, value=fs_data)
-        
+            if sess.speaker:
+                by_speaker.setdefault(sess.speaker, []).append(sess.name)
+        if not by_speaker:
+            return ''
+
+        featured = max(by_speaker, key=lambda spk: len(by_speaker[spk]))
+        speaker = getStorage().get(featured)
+        return json.dumps({'name': speaker.name,
+                           'sessions': by_speaker[featured]})
+
+    @staticmethod
+    def _cacheFeaturedSpeaker(websafeConferenceKey):
+        """Assign Featured Speaker to memcache; used by the
+        set_featured_speaker task"""
+        c_key = ndb.Key(urlsafe=websafeConferenceKey)
+        leasedSet('fs_' + websafeConferenceKey,
+                  ConferenceApi._featuredSpeakerJson(c_key))
+        bumpVersion('featured:' + websafeConferenceKey)
+
     @endpoints.method(CONF_GET_REQUEST, StringMessage,
                       path='conference/{websafeConferenceKey}/getFeaturedSpeaker',
                       http_method='GET',
                       name='getFeaturedSpeaker')
+    @capturedCall
     def getFeaturedSpeaker(self, request):
-        fs_conf = 'fs_' + str(request.websafeConferenceKey)
-        return StringMessage(data=json.dumps(memcache.get(fs_conf)) or 'No featured speaker found.')
-        
+        """Return the featured speaker of the conference, recomputing it
+        if memcache lost it."""
+        wsck = request.websafeConferenceKey
+        featured = leasedGet(
+            'fs_' + wsck,
+            lambda: self._featuredSpeakerJson(ndb.Key(urlsafe=wsck)))
+        return StringMessage(data=featured or 'No featured speaker found.')
+
+    @staticmethod
+    def _timeline(c_key):
+        """Return the timeline of a conference: its sessions that have a
+        date and startTime as (start, end, sessionKey, name, speaker)
+        tuples sorted by start, their starts alone for bisecting, and
+        the longest session in minutes."""
+        storage = getStorage()
+        sessions = [sess for sess in storage.query(Session, ancestor=c_key)
+                    if sess.date and sess.startTime]
+        speaker_keys = list(set(sess.speaker for sess in sessions
+                                if sess.speaker))
+        speakers = dict(zip(speaker_keys, storage.getMulti(speaker_keys)))
+
+        entries = []
+        longest = 0
+        for sess in sessions:
+            start = datetime.combine(sess.date, sess.startTime)
+            minutes = 0
+            if sess.duration:
+                hours, mins = sess.duration[:5].split(':')
+                minutes = int(hours) * 60 + int(mins)
+            longest = max(longest, minutes)
+            speaker = speakers.get(sess.speaker)
+            entries.append((
+                start.strftime(TIMELINE_FORMAT),
+                (start + timedelta(minutes=minutes)).strftime(TIMELINE_FORMAT),
+                sess.key.urlsafe(), sess.name,
+                speaker.name if speaker else None))
+        entries.sort()
+        return {'starts': [entry[0] for entry in entries],
+                'sessions': entries,
+                'longest': longest}
+
+    @staticmethod
+    def _queueTimelineUpdate(c_key):
+        """Queue a rebuild of a conference's timeline; inside a
+        transaction the task only runs if it commits."""
+        taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                      url='/tasks/update_timeline',
+                      transactional=ndb.in_transaction())
+
+    @staticmethod
+    def _cacheTimeline(websafeConferenceKey):
+        """Rebuild a conference's timeline in memcache and drop the
+        copies held by instances; used by the update_timeline task."""
+        leasedSet('timeline_' + websafeConferenceKey, ConferenceApi._timeline(
+            ndb.Key(urlsafe=websafeConferenceKey)))
+        bumpVersion('timeline:' + websafeConferenceKey)
+
+    def _copyTimelineEntryToForm(self, entry):
+        start, end, sessionKey, name, speaker = entry
+        return TimelineSessionForm(sessionKey=sessionKey, name=name,
+                                   speaker=speaker, start=start, end=end)
+
+    @endpoints.method(NOW_AND_NEXT_REQUEST, NowAndNextForm,
+                      path='conference/{websafeConferenceKey}/now',
+                      http_method='GET',
+                      name='getNowAndNext')
+    @capturedCall
+    def getNowAndNext(self, request):
+        """Return the sessions running at `now` (YYYY-MM-DDTHH:MM in the
+        conference's local time, UTC now by default) and those starting
+        next, from the conference's precomputed timeline."""
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = getStorage().get(c_key)
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        try:
+            now = datetime.strptime(request.now, TIMELINE_FORMAT) \
+                if request.now else datetime.utcnow()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "now must be in 'YYYY-MM-DDTHH:MM' format")
+        count = min(request.count or TIMELINE_UPCOMING, TIMELINE_MAX_UPCOMING)
+
+        timeline = localGet('timeline_' + wsck, 'timeline:' + wsck,
+                            lambda: self._timeline(c_key))
+        if timeline is None:
+            # Another request is building it and there's no stale copy
+            timeline = self._timeline(c_key)
+        starts, sessions = timeline['starts'], timeline['sessions']
+
+        # Sessions running now started after now - the longest session
+        started = bisect_right(starts, now.strftime(TIMELINE_FORMAT))
+        earliest = bisect_left(starts, (now - timedelta(
+            minutes=timeline['longest'])).strftime(TIMELINE_FORMAT))
+        now = now.strftime(TIMELINE_FORMAT)
+        return NowAndNextForm(
+            now=now,
+            running=[self._copyTimelineEntryToForm(entry)
+                     for entry in sessions[earliest:started]
+                     if entry[1] > now],
+            upcoming=[self._copyTimelineEntryToForm(entry)
+                      for entry in sessions[started:started + count]])
+
+
+    @staticmethod
+    def _speakerPage(q, request):
+        """Fetch the page of q at the request's websafeCursor, returning
+        the speakers and the cursor of the next page, if any."""
+        try:
+            cursor = Cursor(urlsafe=request.websafeCursor) \
+                if request.websafeCursor else None
+        except Exception:
+            raise endpoints.BadRequestException('Invalid websafeCursor')
+        page_size = min(request.pageSize or SPEAKER_PAGE_SIZE,
+                        SPEAKER_MAX_PAGE_SIZE)
+        speakers, cursor, more = q.fetch_page(page_size, start_cursor=cursor)
+        return speakers, cursor.urlsafe() if more and cursor else None
 
     # Task 3 - Additional Queries - Get All speakers
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @endpoints.method(SPEAKERS_REQUEST, SpeakerForms,
                       path='getAllSpeakers',
                       http_method='GET',
                       name='getAllSpeakers')
+    @capturedCall
+    @rateLimited(10)
     def getAllSpeakers(self, request):
-        """Get all speakers using the speaker entity(Allows for checking featuredSpeaker)"""
-        speakers = Speaker.query().fetch()
+        """Get all speakers using the speaker entity(Allows for checking
+        featuredSpeaker), a page at a time in the order of their names"""
+        speakers, cursor = self._speakerPage(
+            Speaker.query().order(Speaker.normalizedName), request)
         return SpeakerForms(
-            items=[self._copySpeakerToForm(speaker) for speaker in speakers]
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+            nextCursor=cursor
+        )
+
+    def _copySpeakerToEntryForm(self, speaker):
+        """Copy relevant fields from Speaker to SpeakerEntryForm."""
+        ef = SpeakerEntryForm()
+        for field in ef.all_fields():
+            if hasattr(speaker, field.name):
+                setattr(ef, field.name, getattr(speaker, field.name))
+            elif field.name == "websafeKey":
+                setattr(ef, field.name, speaker.key.urlsafe())
+        ef.check_initialized()
+        return ef
+
+    @endpoints.method(SPEAKER_DIRECTORY_REQUEST, SpeakerDirectoryForm,
+                      path='speakers',
+                      http_method='GET',
+                      name='getSpeakerDirectory')
+    @capturedCall
+    def getSpeakerDirectory(self, request):
+        """Page through speakers by name, optionally only those whose
+        name starts with prefix, with their session and conference
+        counts."""
+        q = Speaker.query().order(Speaker.normalizedName)
+        if request.prefix:
+            prefix = normalizeName(request.prefix)
+            q = q.filter(Speaker.normalizedName >= prefix)
+            q = q.filter(Speaker.normalizedName < prefix + u'\ufffd')
+        speakers, cursor = self._speakerPage(q, request)
+        return SpeakerDirectoryForm(
+            items=[self._copySpeakerToEntryForm(spk) for spk in speakers],
+            nextCursor=cursor
         )
 
     # Session Implementation - Create Session
     @endpoints.method(SessionForm, SessionForm, path='session',
                       http_method='POST', name='createSession')
+    @capturedCall
     def createSession(self, request):
         """Create a new session."""
         return self._createSessionObject(request)
 
+    # Create Sessions in bulk
+    @endpoints.method(SessionForms, BulkResultForms, path='sessions',
+                      http_method='POST', name='createSessions')
+    @capturedCall
+    def createSessions(self, request):
+        """Create several sessions in one call."""
+        return self._createSessionObjects(request)
+
     # Session Implementation - Get Sessions for Conference
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
                       path='conference/sessions/{websafeConfKey}',
                       http_method='GET', name='getConferenceSessions')
+    @capturedCall
     def getConferenceSessions(self, request):
         """ Return requested sessions (by websafeConfKey)"""
+        fields = self._parseFields(request.fields, SessionForm)
         c_key = ndb.Key(urlsafe=request.websafeConfKey)
-        conf = c_key.get()
-        if not conf:
+        conf = getStorage().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conf found with key: %s' % request.websafeConfKey)
         # Get all of the sessions associated with the key
-        sessions = Session.query(ancestor=c_key)
+        sessions = getStorage().query(
+            Session, ancestor=c_key,
+            projection=self._projectionFor(fields, SESSION_FIELD_PROPERTIES,
+                                           indexed=SESSION_PROJECTIONS))
         # Populate a SessionForm for each session
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
+            items=[self._copySessionToForm(sess, fields=fields)
+                   for sess in sessions]
         )
 
+    @staticmethod
+    def _exportSessionBatches(c_key=None, startDate=None, endDate=None):
+        """Yield the sessions of a conference and/or date range in
+        batches of EXPORT_BATCH_SIZE, as lists of (Session, speaker name).
+        Used by the export handler so that it never holds more than one
+        batch in memory.
+        """
+        q = Session.query(ancestor=c_key) if c_key else Session.query()
+        if startDate or endDate:
+            if startDate:
+                q = q.filter(Session.date >= startDate)
+            if endDate:
+                q = q.filter(Session.date <= endDate)
+            q = q.order(Session.date)
+
+        cursor, more = None, True
+        while more:
+            # Skip the context cache, which would keep every entity
+            # fetched during the request alive
+            sessions, cursor, more = q.fetch_page(
+                EXPORT_BATCH_SIZE, start_cursor=cursor, use_cache=False)
+            if not sessions:
+                break
+            speaker_keys = list(set(sess.speaker for sess in sessions
+                                    if sess.speaker))
+            names = {}
+            for speaker in ndb.get_multi(speaker_keys, use_cache=False):
+                if speaker:
+                    names[speaker.key] = speaker.name
+            yield [(sess, names.get(sess.speaker)) for sess in sessions]
+
     # Format filters for SessionQuery
     def _formatSessionFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
@@ -408,29 +1175,53 @@ class ConferenceApi(remote.Service):
 
     # Adds filters to SessionQuery
     def _getSessionQuery(self, request):
-        """Return formatted query from submitted filters"""
-        q = Session.query()
+        """Return the sessions matching the submitted filters"""
         inequality_filter, filters = self._formatSessionFilters(
             request.filters)
 
         # if exists sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Session.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Session.name)
+        orders = ['name']
+        if inequality_filter:
+            orders.insert(0, inequality_filter)
 
+        query_filters = []
         for filtr in filters:
-            formatted_query = ndb.query.FilterNode(
-                filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+            if filtr["field"] == "speaker":
+                # Speakers are given by their urlsafe key
+                speaker_key = ndb.Key(urlsafe=filtr["value"])
+                if filtr["operator"] == "=":
+                    query_filters.append(
+                        self._storageKeyFilter('speaker', speaker_key))
+                    continue
+                filtr["value"] = speaker_key
+            query_filters.append(
+                (filtr["field"], filtr["operator"], filtr["value"]))
+        return getStorage().query(Session, filters=query_filters,
+                                  orders=orders)
+
+    @staticmethod
+    def _keyFilter(prop, key):
+        """Return a filter matching a LegacyKeyProperty against key,
+        including entities that still store it as a urlsafe string."""
+        if not MATCH_LEGACY_KEYS:
+            return prop == key
+        return ndb.OR(prop == key,
+                      ndb.query.FilterNode(prop._name, '=', key.urlsafe()))
+
+    @staticmethod
+    def _storageKeyFilter(name, key):
+        """Like _keyFilter(), as a filter for getStorage().query()."""
+        if not MATCH_LEGACY_KEYS:
+            return (name, '=', key)
+        return (name, 'IN', [key, key.urlsafe()])
 
     # Task 3 - Additional Queries - Query of Session based on user params
     @endpoints.method(SessionQueryForms, SessionForms,
                       path='querySessions',
                       http_method='POST',
                       name='querySessions')
+    @capturedCall
+    @rateLimited(5)
     def querySessions(self, request):
         """Query for sessions based on user-specified filters"""
         sessions = self._getSessionQuery(request)
@@ -444,17 +1235,19 @@ class ConferenceApi(remote.Service):
                       path='conference/sessions/{websafeConfKey}/{sessionType}',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @capturedCall
     def getConferenceSessionsByType(self, request):
         """Query Sessions In a conference by type"""
         c_key = ndb.Key(urlsafe=request.websafeConfKey)
-        conf = c_key.get()
-        if not conf:
+        conf = getStorage().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conf found with key: %s' % request.websafeConfKey)
-        q = Session.query(ancestor=c_key)
-        q = q.filter(Session.typeOfSession == request.sessionType)
+        sessions = getStorage().query(
+            Session, ancestor=c_key,
+            filters=[('typeOfSession', '=', request.sessionType)])
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=[self._copySessionToForm(sess) for sess in sessions]
         )
     
     # Task 3 - Additional Query - All Conferences For Speaker
@@ -462,22 +1255,26 @@ class ConferenceApi(remote.Service):
                       path='getAllConferencesBySpeaker',
                       http_method='GET',
                       name='getAllConferencesBySpeaker')
+    @capturedCall
+    @rateLimited(3)
     def getAllConferencesBySpeaker(self, request):
         """Query for conferences by speaker using the Speaker entity"""
-        q = Speaker.query()
-        q = q.filter(Speaker.name == request.speaker).get()
+        storage = getStorage()
+        q = storage.first(Speaker, filters=[('name', '=', request.speaker)])
 
         if not q:
             raise endpoints.BadRequestException(
                 "No speaker by the name of '%s'" % request.speaker)
         
-        spk_sessions = Session.query().filter(Session.speaker==q.key.urlsafe())
-        confs = []
-            
-        for sess in spk_sessions:
-            conf = sess.key.parent().get()
-            if conf not in confs:
-                confs.append(conf)
+        spk_sessions = storage.query(
+            Session, filters=[self._storageKeyFilter('speaker', q.key)],
+            keysOnly=True)
+        c_keys = []
+        for s_key in spk_sessions:
+            if s_key.parent() not in c_keys:
+                c_keys.append(s_key.parent())
+        confs = [conf for conf in storage.getMulti(c_keys)
+                 if conf and not conf.deleted]
 
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, '') for conf in confs]
@@ -488,22 +1285,22 @@ class ConferenceApi(remote.Service):
                       path='getConferenceSessionsBySpeaker',
                       http_method='GET',
                       name='getConferenceSessionsBySpeaker')
+    @capturedCall
     def getConferenceSessionsBySpeaker(self, request):
         """Query for sessions in a particular conference by speaker using the Session entity"""
-        speaker = Speaker.query(Speaker.name==request.speaker).get()
+        speaker = getStorage().first(
+            Speaker, filters=[('name', '=', request.speaker)])
         if not speaker:
             raise endpoints.BadRequestException(
                 "No speaker by the name of '%s'" % request.speaker)
 
         c_key = ndb.Key(urlsafe=request.websafeConfKey)
-        q = Session.query(ancestor=c_key)
-        q = q.filter(Session.speaker == speaker.key.urlsafe())
-        if not q:
-            raise endpoints.BadRequestException(
-                "No record with that key")
+        sessions = getStorage().query(
+            Session, ancestor=c_key,
+            filters=[self._storageKeyFilter('speaker', speaker.key)])
 
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=[self._copySessionToForm(sess) for sess in sessions]
         )
 
     # Session Implementation - Sessions By Speaker
@@ -511,15 +1308,18 @@ class ConferenceApi(remote.Service):
                       path='getAllSessionsForSpeaker',
                       http_method='GET',
                       name='getAllSessionsForSpeaker')
+    @capturedCall
+    @rateLimited(2)
     def getAllSessionsForSpeaker(self, request):
         """Retrieve all sessions for a given speaker using the Speaker entity"""
-        speaker = Speaker.query()
-        speaker = speaker.filter(Speaker.name == request.speaker).get()
+        storage = getStorage()
+        speaker = storage.first(Speaker, filters=[('name', '=', request.speaker)])
         
         if not speaker:
             raise endpoints.BadRequestException(
                 "No speaker by the name of '%s'" % request.speaker)
-        sessions = Session.query().filter(Session.speaker==speaker.key.urlsafe())
+        sessions = storage.query(
+            Session, filters=[self._storageKeyFilter('speaker', speaker.key)])
 
         return SessionForms(
             items=[self._copySessionToForm(sess) for sess in sessions]
@@ -530,17 +1330,18 @@ class ConferenceApi(remote.Service):
                       path='getSessionsBeforeDate',
                       http_method='GET',
                       name='getSessionsBeforeDate')
+    @capturedCall
+    @rateLimited(3)
     def getSessionsBeforeDate(self, request):
         """Get all sessions before a given date"""
         if not request.startDate:
             raise endpoints.BadRequestException(
                 "Session 'startDate' is required for query")
         startDate = datetime.strptime(request.startDate[:10], "%Y-%m-%d")
-        q = Session.query()
-        q = q.filter(Session.date < startDate)
-        q = q.filter(Session.date != None)
+        sessions = getStorage().query(Session, filters=[
+            ('date', '<', startDate), ('date', '!=', None)])
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=[self._copySessionToForm(sess) for sess in sessions]
         )
 
     # Task 3 - Additional Query - Conferences By date
@@ -548,6 +1349,8 @@ class ConferenceApi(remote.Service):
                       path='getConferencesBeforeDate',
                       http_method='GET',
                       name='getConferencesBeforeDate')
+    @capturedCall
+    @rateLimited(3)
     def getConferencesBeforeDate(self, request):
         """Get all Conferences starting before a given date"""
         if not request.startDate:
@@ -556,11 +1359,11 @@ class ConferenceApi(remote.Service):
 
         startDate = datetime.strptime(request.startDate[:10], "%Y-%m-%d")
 
-        q = Conference.query()
-        q = q.filter(Conference.startDate < startDate)
-        q = q.filter(Conference.startDate != None)
+        confs = getStorage().query(Conference, filters=[
+            ('startDate', '<', startDate), ('startDate', '!=', None)])
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, '') for conf in q]
+            items=[self._copyConferenceToForm(conf, '') for conf in confs
+                   if not conf.deleted]
         )
 
     def _checkType(self, session):
@@ -574,15 +1377,16 @@ class ConferenceApi(remote.Service):
                       path='getSpecialQuerySessions',
                       http_method='GET',
                       name='getSpecialQuerySessions')
+    @capturedCall
+    @rateLimited(5)
     def getSpecialQuerySessions(self, request):
         """Query for sessions which are not workshops and
         where the startTime is before 7pm"""
         checkTime = '19:00'
         time = datetime.strptime(checkTime[:5], "%H:%M").time()
-        q = Session.query()
-        q = q.filter(Session.startTime < time)
-        q = q.filter(Session.startTime != None)
-        sessions = [i for i in q if not self._checkType(i)]
+        sessions = [sess for sess in getStorage().query(Session, filters=[
+            ('startTime', '<', time), ('startTime', '!=', None)])
+            if not self._checkType(sess)]
 
         return SessionForms(
             items=[self._copySessionToForm(sess) for sess in sessions]
@@ -592,6 +1396,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='getSessionsCreated',
                       http_method='POST', name='getSessionsCreated')
+    @capturedCall
     def getSessionsCreated(self, request):
         """Return sessions created by user."""
         # check that user is authed
@@ -601,8 +1406,9 @@ class ConferenceApi(remote.Service):
         user_id = getUserId(user)
 
         # create an ancestor query for all key matches to the user
-        sessions = Session.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        sessions = getStorage().query(
+            Session, ancestor=ndb.Key(Profile, user_id))
+        prof = getStorage().get(ndb.Key(Profile, user_id))
 
         # return set of ConferenceForm objects per Conference
         return SessionForms(
@@ -611,20 +1417,242 @@ class ConferenceApi(remote.Service):
         )
 
 
+# - - - - Session Import - - - - - -
+
+    def _copyImportJobToForm(self, job):
+        """Copy relevant fields from ImportJob to ImportJobForm."""
+        jf = ImportJobForm()
+        for field in jf.all_fields():
+            if hasattr(job, field.name):
+                setattr(jf, field.name, getattr(job, field.name))
+            elif field.name == "websafeKey":
+                setattr(jf, field.name, job.key.urlsafe())
+        jf.check_initialized()
+        return jf
+
+    @staticmethod
+    def _parseImportRows(fmt, data):
+        """Parse CSV or JSONL import data into a list of dicts of
+        SessionForm field values."""
+        if fmt == 'csv':
+            reader = csv.DictReader(StringIO(data.encode('utf-8')))
+            rows = [{k: v.decode('utf-8') for k, v in row.items()
+                     if k and v} for row in reader]
+        elif fmt == 'jsonl':
+            try:
+                rows = [json.loads(line) for line in data.splitlines()
+                        if line.strip()]
+            except ValueError as e:
+                raise endpoints.BadRequestException('Invalid JSONL: %s' % e)
+        else:
+            raise endpoints.BadRequestException(
+                "Import format must be 'csv' or 'jsonl'")
+        if not all(isinstance(row, dict) for row in rows):
+            raise endpoints.BadRequestException(
+                'Every JSONL line must be an object')
+        return [{f: unicode(row[f]) for f in IMPORT_FIELDS if row.get(f)}
+                for row in rows]
+
+    def _startImportJob(self, request):
+        """Validate an uploaded program, split it into ImportChunks and
+        queue a task per chunk."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        c_key = ndb.Key(urlsafe=request.websafeConfKey)
+        conf = c_key.get()
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conf with key: %s' % request.websafeConfKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer may update the conference')
+
+        # Validate all the rows up front; rejected rows are reported on
+        # the job instead of failing the whole import
+        valid, errors = [], []
+        for n, row in enumerate(self._parseImportRows(request.format,
+                                                      request.data), 1):
+            try:
+                self._sessionDataFromForm(SessionForm(**row))
+            except (endpoints.BadRequestException, ValueError) as e:
+                errors.append('Row %d: %s' % (n, e))
+                continue
+            valid.append((n, row))
+
+        # Names must be free within the conference and the program
+        name_keys = [self._sessionNameKey(c_key, row['name'])
+                     for _, row in valid]
+        taken = set(marker.key for marker in ndb.get_multi(name_keys)
+                    if marker)
+        legacy = self._legacySessionNames(c_key)
+        rows = []
+        for (n, row), name_key in zip(valid, name_keys):
+            if name_key in taken or row['name'] in legacy:
+                errors.append("Row %d: Entity with name '%s' already exists"
+                              % (n, row['name']))
+                continue
+            taken.add(name_key)
+            rows.append(row)
+
+        job = ImportJob(conference=c_key, organizerUserId=user_id,
+                        totalRows=len(rows), errors=errors,
+                        hasSpeakers=any(row.get('speaker') for row in rows))
+        if not rows:
+            job.status = 'DONE'
+            job.put()
+            return self._copyImportJobToForm(job)
+
+        # Allocate the session ids up front, so that a chunk writes the
+        # same keys however often it is retried
+        first, _ = Session.allocate_ids(size=len(rows), parent=c_key)
+        job.key = ndb.Key(ImportJob, ImportJob.allocate_ids(size=1)[0])
+        chunks = []
+        for n, i in enumerate(range(0, len(rows), IMPORT_CHUNK_SIZE), 1):
+            chunks.append(ImportChunk(
+                key=ndb.Key(ImportChunk, n, parent=job.key),
+                rows=rows[i:i + IMPORT_CHUNK_SIZE],
+                firstSessionId=first + i))
+        job.totalChunks = len(chunks)
+        ndb.put_multi([job] + chunks)
+        self._queueImportChunks(job.key, [chunk.key for chunk in chunks])
+        return self._copyImportJobToForm(job)
+
+    @staticmethod
+    def _queueImportChunks(job_key, chunk_keys):
+        """Queue a task per ImportChunk on the import queue."""
+        tasks = [taskqueue.Task(url='/tasks/import_chunk',
+                                params={'jobKey': job_key.urlsafe(),
+                                        'chunk': chunk_key.id()})
+                 for chunk_key in chunk_keys]
+        queue = taskqueue.Queue(IMPORT_QUEUE)
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+    @staticmethod
+    def _importChunk(job_key, chunk_id):
+        """Write the sessions of one ImportChunk; used by the import
+        task. Chunks that are already done are skipped.
+        """
+        job_key = ndb.Key(urlsafe=job_key)
+        chunk_key = ndb.Key(ImportChunk, chunk_id, parent=job_key)
+        job, chunk = ndb.get_multi([job_key, chunk_key])
+        if not job or not chunk or chunk.done:
+            return
+
+        api = ConferenceApi()
+        datas = [api._sessionDataFromForm(SessionForm(**row))
+                 for row in chunk.rows]
+        speaker_keys = api._speakerKeysForNames(
+            [data['speaker'] for data in datas if data['speaker']])
+        sessions = []
+        for s_id, data in enumerate(datas, chunk.firstSessionId):
+            data['key'] = ndb.Key(Session, s_id, parent=job.conference)
+            if data['speaker']:
+                data['speaker'] = speaker_keys[data['speaker']]
+            sessions.append(Session(**data))
+        # Names were checked when the job started, but sessions created
+        # since may have taken some; those rows are reported on the job.
+        # A retried chunk finds its own sessions under the names and
+        # writes them again
+        put = api._putNamedSessions(job.conference, sessions)
+        put_keys = set(sess.key for sess in put)
+        errors = ["Entity with name '%s' already exists" % sess.name
+                  for sess in sessions if sess.key not in put_keys]
+        sessions = put
+        bumpVersion('sessions:' + job.conference.urlsafe())
+        speaker_keys = list(set(sess.speaker for sess in sessions
+                                if sess.speaker))
+
+        @ndb.transactional
+        def finish():
+            job, chunk = ndb.get_multi([job_key, chunk_key])
+            if chunk.done:
+                return
+            chunk.done = True
+            job.doneChunks += 1
+            job.importedRows += len(sessions)
+            job.errors.extend(errors)
+            # Counting is left to a task that recomputes the counts, so
+            # a retried chunk can't count its sessions twice
+            if speaker_keys:
+                api._queueSpeakerRecount(speaker_keys)
+            if job.doneChunks == job.totalChunks:
+                job.status = 'DONE'
+                # Recompute the featured speaker once for the whole import
+                if job.hasSpeakers:
+                    taskqueue.add(params={'websafeConferenceKey':
+                                          job.conference.urlsafe()},
+                                  url='/tasks/set_featured_speaker',
+                                  transactional=True)
+                api._queueTimelineUpdate(job.conference)
+            ndb.put_multi([job, chunk])
+        finish()
+
+    def _getImportJob(self, request):
+        """Return the ImportJob for the request, checking ownership."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        job = getStorage().get(ndb.Key(urlsafe=request.websafeJobKey))
+        if not job:
+            raise endpoints.NotFoundException(
+                'No import job found with key: %s' % request.websafeJobKey)
+        if getUserId(user) != job.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer may view the import job')
+        return job
+
+    @endpoints.method(ImportForm, ImportJobForm,
+                      path='sessions/import',
+                      http_method='POST', name='importSessions')
+    @capturedCall
+    def importSessions(self, request):
+        """Import a CSV or JSONL session program in the background."""
+        return self._startImportJob(request)
+
+    @endpoints.method(IMPORT_JOB_REQUEST, ImportJobForm,
+                      path='sessions/import/{websafeJobKey}',
+                      http_method='GET', name='getImportJob')
+    @capturedCall
+    def getImportJob(self, request):
+        """Return the progress of a session import."""
+        return self._copyImportJobToForm(self._getImportJob(request))
+
+    @endpoints.method(IMPORT_JOB_REQUEST, ImportJobForm,
+                      path='sessions/import/{websafeJobKey}/resume',
+                      http_method='POST', name='resumeImportJob')
+    @capturedCall
+    def resumeImportJob(self, request):
+        """Queue again the chunks of an import that haven't finished."""
+        job = self._getImportJob(request)
+        chunk_keys = [ndb.Key(ImportChunk, n, parent=job.key)
+                      for n in range(1, job.totalChunks + 1)]
+        self._queueImportChunks(job.key, [
+            chunk.key for chunk in ndb.get_multi(chunk_keys)
+            if chunk and not chunk.done])
+        return self._copyImportJobToForm(job)
+
+
 # - - - - Session WishList - - - - - -
 
-    @ndb.transactional(xg=True)
     def _wishListAddition(self, request, add=True):
         """Handles addition/removal of selected session from the user's wishlist"""
+        return getStorage().transaction(
+            lambda: self._updateWishlist(request, add), xg=True)
+
+    def _updateWishlist(self, request, add):
         retval = None
         prof = self._getProfileFromUser()
 
-        s_key = request.sessionKey
-        sess = ndb.Key(urlsafe=s_key).get()
+        s_key = ndb.Key(urlsafe=request.sessionKey)
+        sess = getStorage().get(s_key)
 
         if not sess:
             raise endpoints.NotFoundException(
-                'No session found with key: %s' % s_key
+                'No session found with key: %s' % request.sessionKey
             )
 
         # Add
@@ -647,7 +1675,7 @@ class ConferenceApi(remote.Service):
             else:
                 retval = False
         # Write back to datastore and return
-        prof.put()
+        getStorage().put(prof)
 
         return BooleanMessage(data=retval)
 
@@ -656,6 +1684,7 @@ class ConferenceApi(remote.Service):
                       path='wishlist/add/{sessionKey}',
                       http_method='POST',
                       name='addSessionToWishlist')
+    @capturedCall
     def addSessionToWishlist(self, request):
         """Add session to user's wishlist"""
         return self._wishListAddition(request)
@@ -665,20 +1694,50 @@ class ConferenceApi(remote.Service):
                       path='sessions/wishlist',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @capturedCall
     def getSessionsInWishlist(self, request):
         """Get user's wishlist of sessions"""
         prof = self._getProfileFromUser()
-        sess_keys = [ndb.Key(urlsafe=s_key)
-                     for s_key in prof.sessionKeysToAttend]
-        sessions = ndb.get_multi(sess_keys)
+        sessions = getStorage().getMulti(prof.sessionKeysToAttend)
 
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
+        return SessionForms(items=[self._copySessionToForm(sess)
+                                   for sess in sessions if sess])
+
+    @endpoints.method(RECOMMENDATIONS_REQUEST, SessionForms,
+                      path='session/{sessionKey}/recommended',
+                      http_method='GET',
+                      name='getRecommendedSessions')
+    @capturedCall
+    def getRecommendedSessions(self, request):
+        """Sessions most often saved together with the given one, other
+        than those already in the user's wishlist."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        try:
+            s_key = ndb.Key(urlsafe=request.sessionKey)
+        except Exception:
+            raise endpoints.BadRequestException('Invalid sessionKey')
+
+        # Neighbours are precomputed by the recommend_sessions job
+        storage = getStorage()
+        prof, neighbours = storage.getMulti([
+            ndb.Key(Profile, getUserId(user)),
+            ndb.Key(SessionNeighbours, 1, parent=s_key)])
+        if not neighbours:
+            return SessionForms(items=[])
+        saved = set(prof.sessionKeysToAttend) if prof else set()
+        sessions = storage.getMulti([k for k in neighbours.sessionKeys
+                                     if k not in saved])
+        return SessionForms(items=[self._copySessionToForm(sess)
+                                   for sess in sessions if sess])
 
     # Wishlist Implementation - Delete session from Wishlist
     @endpoints.method(WISHLIST_REQUEST, BooleanMessage,
                       path='wishlist/remove/{sessionKey}',
                       http_method='POST',
                       name='deleteSessionInWishlist')
+    @capturedCall
     def deleteSessionInWishlist(self, request):
         """Remove a session from the user's wishlist"""
         return self._wishListAddition(request, add=False)
@@ -686,10 +1745,13 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _copyConferenceToForm(self, conf, displayName, fields=None):
+        """Copy relevant fields from Conference to ConferenceForm, or
+        only those in `fields` if given."""
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if fields and field.name not in fields:
+                continue
             if hasattr(conf, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -698,19 +1760,65 @@ class ConferenceApi(remote.Service):
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
                 setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
+        if displayName and (not fields or 'organizerDisplayName' in fields):
             setattr(cf, 'organizerDisplayName', displayName)
         cf.check_initialized()
         return cf
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    def _parseFields(self, fields, form):
+        """Return the set of form fields asked for in a `fields`
+        parameter, given repeated and/or comma separated, or None if
+        every field is wanted."""
+        names = set(name.strip() for value in fields or []
+                    for name in value.split(',') if name.strip())
+        if not names:
+            return None
+        unknown = names - set(field.name for field in form.all_fields())
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields: %s' % ', '.join(sorted(unknown)))
+        return names
 
+    @staticmethod
+    def _projectionFor(fields, field_properties, required=(), indexed=None):
+        """Return the properties to project to fill in `fields`, or None
+        if some field needs the whole entity, or if the projection isn't
+        one of the `indexed` ones when those are given."""
+        if not fields:
+            return None
+        projection = set(required)
+        for name in fields:
+            if name not in field_properties:
+                return None
+            if field_properties[name]:
+                projection.add(field_properties[name])
+        projection = sorted(projection)
+        if not projection or (indexed is not None and
+                              projection not in indexed):
+            return None
+        return projection
+
+    def _loader(self):
+        """Return the KeyLoader of this request; the service is created
+        anew for every request."""
+        if not hasattr(self, '_keyLoader'):
+            self._keyLoader = KeyLoader()
+        return self._keyLoader
+
+    def _organizerNames(self, conferences):
+        """Return the display names of the organizers of conferences."""
+        # need to fetch organiser displayName from profiles
+        organisers = [ndb.Key(Profile, conf.organizerUserId)
+                      for conf in conferences]
+        names = {}
+        for profile in self._loader().getMulti(organisers):
+            if profile:
+                names[profile.key.id()] = profile.displayName
+        return names
+
+    def _conferenceDataFromForm(self, request):
+        """Copy a ConferenceForm into a dict of Conference properties,
+        filling in defaults on both."""
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
@@ -730,9 +1838,7 @@ class ConferenceApi(remote.Service):
 
         # convert dates from strings to Date objects; set month based on
         # start_date
-        print '----ABOUT TO PRINT STARTDATE-----'
         if data['startDate']:
-            print '  startDate', data['startDate']
             data['startDate'] = datetime.strptime(
                 data['startDate'][:10], "%Y-%m-%d").date()
             data['month'] = data['startDate'].month
@@ -745,26 +1851,83 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        return data
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        data = self._conferenceDataFromForm(request)
+
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        c_id = getStorage().allocateIds(Conference, 1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        getStorage().put(Conference(**data))
+        self._queueEmails([(user.email(), CONFIRMATION_EMAIL_SUBJECT,
+                            CONFIRMATION_EMAIL_TPL % repr(request))])
         return request
 
+    def _createConferenceObjects(self, request):
+        """Create Conferences in bulk, returning a BulkResultForm per item."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        if len(request.items) > REGISTRATION_BATCH_MAX:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per call' % REGISTRATION_BATCH_MAX)
+
+        results = [BulkResultForm(index=i, success=False)
+                   for i in range(len(request.items))]
+        accepted = []
+        for i, form in enumerate(request.items):
+            try:
+                accepted.append((i, form, self._conferenceDataFromForm(form)))
+            except (endpoints.BadRequestException, ValueError) as e:
+                results[i].error = str(e)
+
+        if not accepted:
+            return BulkResultForms(items=results)
+
+        # Allocate the ids for the whole batch as a single range
+        storage = getStorage()
+        p_key = ndb.Key(Profile, user_id)
+        first, last = storage.allocateIds(Conference, len(accepted),
+                                          parent=p_key)
+        confs = []
+        emails = []
+        for c_id, (i, form, data) in zip(range(first, last + 1), accepted):
+            data['key'] = ndb.Key(Conference, c_id, parent=p_key)
+            data['organizerUserId'] = form.organizerUserId = user_id
+            confs.append(Conference(**data))
+            emails.append((user.email(), CONFIRMATION_EMAIL_SUBJECT,
+                           CONFIRMATION_EMAIL_TPL % repr(form)))
+            results[i].success = True
+            results[i].websafeKey = data['key'].urlsafe()
+
+        for i in range(0, len(confs), BULK_PUT_CHUNK):
+            storage.putMulti(confs[i:i + BULK_PUT_CHUNK])
+        self._queueEmails(emails)
+        return BulkResultForms(items=results)
+
     # Update a Conference
-    @ndb.transactional()
     def _updateConferenceObject(self, request):
+        """Update a conference in one transaction on its entity group."""
+        return getStorage().transaction(
+            lambda: self._updateConference(request))
+
+    def _updateConference(self, request):
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
@@ -775,9 +1938,10 @@ class ConferenceApi(remote.Service):
                 for field in request.all_fields()}
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        storage = getStorage()
+        conf = storage.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         # check that conference exists
-        if not conf:
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
@@ -786,6 +1950,11 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        announced = self._isNearlySoldOut(conf)
+        name = conf.name
+        before = dict((field, getattr(conf, field))
+                      for field, _ in NOTIFY_FIELDS)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -799,43 +1968,217 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        if announced != self._isNearlySoldOut(conf) or (
+                announced and name != conf.name):
+            self._queueAnnouncementUpdate([conf.key])
+        storage.put(conf)
+
+        # Attendees are told by a chain of tasks, however many there are;
+        # the first one is only queued if the update commits. The chain
+        # is named after the updated version of the conference
+        changes = self._conferenceChanges(before, conf)
+        if changes:
+            self._queueAttendeeNotification(
+                conf.key.urlsafe(), NOTIFY_EMAIL_SUBJECT % conf.name,
+                NOTIFY_EMAIL_TPL % (conf.name, '\r\n'.join(changes)),
+                '%d-%d' % (conf.key.id(), self._toMicros(conf.modified)))
+        prof = storage.get(ndb.Key(Profile, user_id))
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
+    def _deleteConferenceObject(self, request):
+        """Mark a conference deleted and queue the removal of its
+        sessions and of the references to it."""
+        return getStorage().transaction(
+            lambda: self._deleteConference(request))
+
+    def _deleteConference(self, request):
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        wsck = request.websafeConferenceKey
+        storage = getStorage()
+        conf = storage.get(ndb.Key(urlsafe=wsck))
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+
+        if self._isNearlySoldOut(conf):
+            self._queueAnnouncementUpdate([conf.key])
+        conf.deleted = True
+        storage.put(conf)
+        self._queueConferenceCleanup(wsck, 'sessions')
+        return BooleanMessage(data=True)
+
+    @staticmethod
+    def _queueConferenceCleanup(wsck, phase, countdown=0):
+        """Queue the next batch of a deleted conference's cleanup;
+        inside a transaction the task only runs if it commits."""
+        taskqueue.add(params={'websafeConferenceKey': wsck, 'phase': phase},
+                      url='/tasks/delete_conference', countdown=countdown,
+                      transactional=ndb.in_transaction())
+
+    @staticmethod
+    def _scrubProfiles(p_keys, c_key):
+        """Remove a conference and its sessions from Profiles, in
+        transactions of at most 25 Profiles. Returns how many Profiles
+        changed."""
+        @ndb.transactional(xg=True)
+        def scrub(p_keys):
+            changed = []
+            for prof in ndb.get_multi(p_keys):
+                if not prof:
+                    continue
+                confs = [k for k in prof.conferenceKeysToAttend if k != c_key]
+                sessions = [k for k in prof.sessionKeysToAttend
+                            if k.parent() != c_key]
+                if (len(confs) != len(prof.conferenceKeysToAttend) or
+                        len(sessions) != len(prof.sessionKeysToAttend)):
+                    prof.conferenceKeysToAttend = confs
+                    prof.sessionKeysToAttend = sessions
+                    changed.append(prof)
+            ndb.put_multi(changed)
+            return len(changed)
+
+        p_keys = list(set(p_keys))
+        return sum(scrub(p_keys[i:i + 25]) for i in range(0, len(p_keys), 25))
+
+    @staticmethod
+    def _cleanupConference(wsck, phase):
+        """Remove one batch of a deleted conference's data and queue the
+        next one; used by the delete_conference task.
+
+        sessions: delete sessions and their neighbours, after taking
+            them out of wishlists, then the waitlist and the timeline
+        profiles: take the conference out of registered Profiles
+        conference: delete the conference and its cached data
+
+        Each batch removes what it handled, so the next one simply asks
+        for the first batch again instead of carrying a cursor.
+        Tombstones are keyed by the deleted entity's key, so a retried
+        batch rewrites them rather than adding more.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        if phase == 'sessions':
+            sessions = Session.query(ancestor=c_key).fetch(
+                CLEANUP_SESSION_BATCH)
+            if not sessions:
+                w_keys = WaitlistEntry.query(
+                    WaitlistEntry.conference == c_key).fetch(
+                        CLEANUP_PROFILE_BATCH, keys_only=True)
+                if w_keys:
+                    ndb.delete_multi(w_keys)
+                    return ConferenceApi._queueConferenceCleanup(
+                        wsck, 'sessions')
+                memcache.delete_multi(['timeline_' + wsck,
+                                       'timeline_' + wsck + ':stale'])
+                bumpVersion('timeline:' + wsck)
+                return ConferenceApi._queueConferenceCleanup(wsck, 'profiles')
+            s_keys = [sess.key for sess in sessions]
+            ndb.put_multi([Tombstone(id=s_key.urlsafe(), kind='Session',
+                                     websafeKey=s_key.urlsafe())
+                           for s_key in s_keys])
+            futures = [Profile.query(ConferenceApi._keyFilter(
+                Profile.sessionKeysToAttend, s_key)).fetch_async(keys_only=True)
+                for s_key in s_keys]
+            ConferenceApi._scrubProfiles(
+                [p_key for f in futures for p_key in f.get_result()], c_key)
+            s_keys += [ConferenceApi._sessionNameKey(c_key, sess.name)
+                       for sess in sessions]
+            s_keys += [ndb.Key(SessionNeighbours, 1, parent=sess.key)
+                       for sess in sessions]
+            for i in range(0, len(s_keys), BULK_PUT_CHUNK):
+                ndb.delete_multi(s_keys[i:i + BULK_PUT_CHUNK])
+            # Recounted from a query, so a retried batch can't take the
+            # sessions off their speakers twice
+            speaker_keys = list(set(sess.speaker for sess in sessions
+                                    if sess.speaker))
+            if speaker_keys:
+                ConferenceApi._queueSpeakerRecount(speaker_keys)
+            return ConferenceApi._queueConferenceCleanup(wsck, 'sessions')
+
+        if phase == 'profiles':
+            p_keys = Profile.query(ConferenceApi._keyFilter(
+                Profile.conferenceKeysToAttend, c_key)).fetch(
+                    CLEANUP_PROFILE_BATCH, keys_only=True)
+            if not p_keys:
+                return ConferenceApi._queueConferenceCleanup(
+                    wsck, 'conference')
+            # The query is eventually consistent and may still return
+            # Profiles that were already scrubbed; give the index time
+            # to catch up before asking again
+            changed = ConferenceApi._scrubProfiles(p_keys, c_key)
+            return ConferenceApi._queueConferenceCleanup(
+                wsck, 'profiles', countdown=0 if changed else 10)
+
+        if phase == 'conference':
+            Tombstone(id=wsck, kind='Conference', websafeKey=wsck).put()
+            c_key.delete()
+            memcache.delete_multi(['fs_' + wsck, 'fs_' + wsck + ':stale'])
+            bumpVersion('sessions:' + wsck, 'featured:' + wsck)
+
     # Create a Conference endpoint
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
+    @capturedCall
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
 
+    # Create Conferences in bulk
+    @endpoints.method(ConferenceForms, BulkResultForms, path='conferences',
+                      http_method='POST', name='createConferences')
+    @capturedCall
+    def createConferences(self, request):
+        """Create several conferences in one call."""
+        return self._createConferenceObjects(request)
+
     # Update a Conference endpoint
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT', name='updateConference')
+    @capturedCall
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
+    # Delete a Conference endpoint
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/delete',
+                      http_method='POST', name='deleteConference')
+    @capturedCall
+    def deleteConference(self, request):
+        """Delete a conference along with its sessions."""
+        return self._deleteConferenceObject(request)
+
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
+    @capturedCall
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        # get Conference object from request; bail if not found. The
+        # organizer's Profile is the parent of the Conference, so it is
+        # fetched at the same time
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        prof = self._loader().load(c_key.parent())
+        conf = getStorage().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(
+            conf, getattr(prof.get_result(), 'displayName', None))
 
     # Get conferences created by User
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
+    @capturedCall
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -844,34 +2187,34 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # create ancestor query for all key matches for this user; the
+        # Profile is fetched while the query runs
+        prof = self._loader().load(ndb.Key(Profile, user_id))
+        confs = getStorage().query(Conference,
+                                   ancestor=ndb.Key(Profile, user_id))
+        displayName = getattr(prof.get_result(), 'displayName', None)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(
-                conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, displayName)
+                   for conf in confs if not conf.deleted]
         )
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
+    def _getQuery(self, request, projection=None):
+        """Return the conferences matching the submitted filters."""
         inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+        orders = ['name']
+        if inequality_filter:
+            orders.insert(0, inequality_filter)
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
                 filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(
-                filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+        return getStorage().query(
+            Conference, orders=orders, projection=projection,
+            filters=[(filtr["field"], filtr["operator"], filtr["value"])
+                     for filtr in filters])
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
@@ -908,25 +2251,32 @@ class ConferenceApi(remote.Service):
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @capturedCall
+    @rateLimited(3)
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        fields = self._parseFields(request.fields, ConferenceForm)
+        projection = None
+        if CONFERENCE_PROJECTIONS:
+            projection = self._projectionFor(
+                fields, CONFERENCE_FIELD_PROPERTIES, required=['deleted'])
+            # Properties in equality filters can't be projected
+            _, filters = self._formatFilters(request.filters)
+            if projection and set(projection) & set(
+                    f['field'] for f in filters if f['operator'] == '='):
+                projection = None
+        conferences = [conf for conf in self._getQuery(request, projection)
+                       if not conf.deleted]
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if not fields or 'organizerDisplayName' in fields:
+            names = self._organizerNames(conferences)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in
-                   conferences]
+            items=[self._copyConferenceToForm(
+                conf, names and names.get(conf.organizerUserId), fields)
+                for conf in conferences]
         )
 
 
@@ -942,6 +2292,9 @@ class ConferenceApi(remote.Service):
                 if field.name == 'teeShirtSize':
                     setattr(pf, field.name, getattr(
                         TeeShirtSize, getattr(prof, field.name)))
+                elif field.name == 'conferenceKeysToAttend':
+                    setattr(pf, field.name, [
+                        c_key.urlsafe() for c_key in prof.conferenceKeysToAttend])
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
         pf.check_initialized()
@@ -957,7 +2310,7 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = getStorage().get(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -966,7 +2319,7 @@ class ConferenceApi(remote.Service):
                 mainEmail=user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            getStorage().put(profile)
 
         return profile      # return Profile
 
@@ -977,6 +2330,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -986,19 +2340,25 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         # else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        getStorage().put(prof)
+            # Conference reads show the organizer's name, see
+            # ConferenceReadHandler
+            if prof.displayName != displayName:
+                bumpVersion(entityStamp(prof.key))
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
+    @capturedCall
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
+    @capturedCall
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -1007,57 +2367,655 @@ class ConferenceApi(remote.Service):
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+    def _isNearlySoldOut(conf):
+        """Return True if the conference belongs in the announcement."""
+        return (not conf.deleted and
+                0 < (conf.seatsAvailable or 0) <= ANNOUNCEMENT_SEATS)
+
+    @staticmethod
+    def _queueAnnouncementUpdate(c_keys):
+        """Queue an update of the announcement for the given conferences;
+        inside a transaction the task only runs if it commits."""
+        taskqueue.add(params={'websafeConferenceKey':
+                              [c_key.urlsafe() for c_key in c_keys]},
+                      url='/tasks/update_announcement',
+                      transactional=ndb.in_transaction())
+
+    @staticmethod
+    def _updateAnnouncement(c_keys):
+        """Add or remove the given conferences from the Announcement
+        according to their current seatsAvailable; used by the
+        update_announcement task."""
+        @ndb.transactional(xg=True)
+        def update(c_keys):
+            ann = ANNOUNCEMENT_KEY.get() or Announcement(key=ANNOUNCEMENT_KEY)
+            confs = dict(zip(ann.conferenceKeys, ann.conferenceNames))
+            for c_key, conf in zip(c_keys, ndb.get_multi(c_keys)):
+                if conf and ConferenceApi._isNearlySoldOut(conf):
+                    if c_key not in confs:
+                        ann.conferenceKeys.append(c_key)
+                    confs[c_key] = conf.name
+                else:
+                    confs.pop(c_key, None)
+            ann.conferenceKeys = [k for k in ann.conferenceKeys if k in confs]
+            ann.conferenceNames = [confs[k] for k in ann.conferenceKeys]
+            ann.version += 1
+            ann.put()
+            return ann
+
+        # Stay under the limit of 25 entity groups per transaction
+        ann = None
+        for i in range(0, len(c_keys), 24):
+            ann = update(c_keys[i:i + 24])
+        return ConferenceApi._cacheAnnouncement(ann)
+
+    @staticmethod
+    def _reconcileAnnouncement(full=False):
+        """Repair the Announcement if an update was missed; used by the
+        announcement cron jobs. The hourly run only rechecks the
+        announced conferences against their entities; the daily full run
+        also queries for nearly sold out conferences missing from it."""
+        ann = ANNOUNCEMENT_KEY.get()
+        names = dict(zip(ann.conferenceKeys, ann.conferenceNames)) \
+            if ann else {}
+        stored = names.keys()
+        changed = [c_key for c_key, conf in zip(stored, ndb.get_multi(stored))
+                   if not conf or not ConferenceApi._isNearlySoldOut(conf) or
+                   conf.name != names[c_key]]
+        if full:
+            # The query is eventually consistent, so the conferences it
+            # adds are rechecked against their entities
+            changed += [c_key for c_key in Conference.query(ndb.AND(
+                Conference.seatsAvailable <= ANNOUNCEMENT_SEATS,
+                Conference.seatsAvailable > 0)).fetch(keys_only=True)
+                if c_key not in names]
+        if changed:
+            return ConferenceApi._updateAnnouncement(changed)
+        return ConferenceApi._cacheAnnouncement(ann)
+
+    @staticmethod
+    def _announcementValue(ann=None):
+        """Return the version of the Announcement entity and the
+        announcement formatted from it."""
+        if ann is None:
+            ann = ANNOUNCEMENT_KEY.get()
+        return (ann.version if ann else 0,
+                ConferenceApi._announcementText(ann))
 
-        if confs:
+    @staticmethod
+    def _announcementText(ann):
+        """Format the announcement from the Announcement entity."""
+        if ann and ann.conferenceNames:
             # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            # format announcement
+            return ANNOUNCEMENT_TPL % (', '.join(ann.conferenceNames))
+        # If there are no sold out conferences, the announcement is empty
+        return ""
 
-        return announcement
+    @staticmethod
+    def _cacheAnnouncement(ann=None):
+        """Create Announcement & assign to memcache; used by the
+        announcement cron job and tasks. Tasks finishing out of order
+        don't replace the announcement with an older one, as it is only
+        cached over that of an earlier version of the entity.
+        """
+        value = ConferenceApi._announcementValue(ann)
+        versionedSet(MEMCACHE_ANNOUNCEMENTS_KEY, value)
+        bumpVersion('announcement')
+        return value[1]
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
+    @capturedCall
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from memcache, recomputing it if
+        memcache lost it."""
+        _, announcement = leasedGet(
+            MEMCACHE_ANNOUNCEMENTS_KEY, self._announcementValue,
+            default=(0, ''), store=versionedSet)
+        return StringMessage(data=announcement)
+
+
+# - - - Batch jobs - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _batchJobTypes():
+        """Return the map and reduce functions of each BatchJob type,
+        and the model whose urlsafe keys its output is keyed by, or None
+        if a single reducer combines the output. map(output, profile)
+        folds a Profile into the dict of output and returns how many
+        entries it added; reduce(job, partition, outputs) combines the
+        parts of the output whose keys fall in the key range of one
+        partition and returns the messages to store on the job.
+        """
+        return {
+            'reconcile_seats': (ConferenceApi._mapSeatCounts,
+                                ConferenceApi._reduceSeatCounts, None),
+            'recommend_sessions': (ConferenceApi._mapCoSaves,
+                                   ConferenceApi._reduceCoSaves, Session),
+        }
+
+    @staticmethod
+    def _batchPartition(key, bounds):
+        """Return the reducer of an output key: the key range of the
+        job's partitionBounds it falls in."""
+        if not bounds:
+            return 0
+        return bisect_right(bounds, ndb.Key(urlsafe=key))
+
+    @staticmethod
+    def _partitionRange(job, partition):
+        """Return the first key of a partition and the first key after
+        it, None for the ends of the key space."""
+        bounds = [None] + job.partitionBounds + [None]
+        return bounds[partition], bounds[partition + 1]
+
+    @staticmethod
+    def _batchOutputKey(job_key, shard, step, flush, partition):
+        return ndb.Key(BatchOutput, '%d-%d-%d-%d' % (
+            shard, step, flush, partition), parent=job_key)
+
+    @staticmethod
+    def _keyRanges(model, shards):
+        """Split the key space of model into at most `shards` ranges of
+        similar size, using the datastore's __scatter__ sample."""
+        sample = model.query().order(
+            ndb.GenericProperty('__scatter__')).fetch(
+                shards * BATCH_OVERSAMPLE, keys_only=True)
+        sample.sort()
+        splits = sample[BATCH_OVERSAMPLE - 1::BATCH_OVERSAMPLE][:shards - 1]
+        bounds = [None] + splits + [None]
+        return zip(bounds[:-1], bounds[1:])
+
+    @staticmethod
+    def _startBatchJob(jobType, repair=False):
+        """Create a BatchJob and queue the first step of every shard."""
+        # Reducers take key ranges of the output's model, so each can
+        # find the entities it stored in earlier runs with a key query
+        model = ConferenceApi._batchJobTypes()[jobType][2]
+        bounds = [start for start, _ in ConferenceApi._keyRanges(
+            model, BATCH_REDUCERS)[1:]] if model else []
+        job = BatchJob(jobType=jobType, repair=repair,
+                       partitionBounds=bounds, totalReducers=len(bounds) + 1)
+        job.key = ndb.Key(BatchJob, BatchJob.allocate_ids(size=1)[0])
+        shards = [BatchShard(key=ndb.Key(BatchShard, n, parent=job.key),
+                             startKey=start, endKey=end)
+                  for n, (start, end) in enumerate(
+                      ConferenceApi._keyRanges(Profile, BATCH_SHARDS), 1)]
+        job.totalShards = len(shards)
+        ndb.put_multi([job] + shards)
+        taskqueue.Queue(BATCH_QUEUE).add([
+            taskqueue.Task(url='/tasks/batch_shard',
+                           params={'shardKey': shard.key.urlsafe(),
+                                   'step': 0})
+            for shard in shards])
+        return job
+
+    @staticmethod
+    def _runBatchShard(shard_key, step):
+        """Scan the next part of a shard's key range; used by the
+        batch_shard task. A step runs for about BATCH_STEP_SECONDS,
+        writing its output in BatchOutput parts as soon as it holds
+        BATCH_FLUSH_ENTRIES entries, then saves its cursor
+        and number of flushes and queues the next step in one
+        transaction. Steps that already ran are ignored, so duplicate or
+        retried tasks don't count Profiles twice.
+        """
+        shard_key = ndb.Key(urlsafe=shard_key)
+        job, shard = ndb.get_multi([shard_key.parent(), shard_key])
+        if not job or not shard or shard.done or shard.step != step:
+            return
+        map_fn = ConferenceApi._batchJobTypes()[job.jobType][0]
+        flushes = [0]
+
+        def flush(output):
+            # Every partition gets a part, so a retried step overwrites
+            # all the parts an earlier attempt wrote under its ids
+            parts = [{} for _ in range(job.totalReducers)]
+            for key, value in output.items():
+                parts[ConferenceApi._batchPartition(
+                    key, job.partitionBounds)][key] = value
+            ndb.put_multi([
+                BatchOutput(key=ConferenceApi._batchOutputKey(
+                    job.key, shard_key.id(), step, flushes[0], partition),
+                    output=part)
+                for partition, part in enumerate(parts)])
+            flushes[0] += 1
+
+        q = Profile.query()
+        if shard.startKey:
+            q = q.filter(Profile.key >= shard.startKey)
+        if shard.endKey:
+            q = q.filter(Profile.key < shard.endKey)
+        cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+        output, entries = {}, 0
+        started = datetime.now()
+        more = True
+        while more and (datetime.now() - started).seconds < BATCH_STEP_SECONDS:
+            profiles, cursor, more = q.fetch_page(
+                BATCH_PAGE_SIZE, start_cursor=cursor, use_cache=False)
+            # A page of large wishlists adds far more than a flush's
+            # worth of pairs, so the size is checked after each Profile
+            for prof in profiles:
+                entries += map_fn(output, prof)
+                if entries >= BATCH_FLUSH_ENTRIES:
+                    flush(output)
+                    output, entries = {}, 0
+        if output:
+            flush(output)
+        more = more and cursor
+
+        @ndb.transactional
+        def save():
+            job, shard = ndb.get_multi([shard_key.parent(), shard_key])
+            if shard.step != step:
+                return
+            shard.flushes.append(flushes[0])
+            shard.step += 1
+            if more:
+                shard.cursor = cursor.urlsafe()
+                taskqueue.add(url='/tasks/batch_shard',
+                              params={'shardKey': shard_key.urlsafe(),
+                                      'step': shard.step},
+                              queue_name=BATCH_QUEUE, transactional=True)
+                shard.put()
+                return
+            shard.done = True
+            job.doneShards += 1
+            if job.doneShards == job.totalShards:
+                taskqueue.add(url='/tasks/batch_reduce',
+                              params={'jobKey': job.key.urlsafe()},
+                              queue_name=BATCH_QUEUE, transactional=True)
+            ndb.put_multi([job, shard])
+        save()
+
+    @staticmethod
+    def _reduceBatchJob(job_key, partition=None):
+        """Combine the output parts of one partition of a job; used by
+        the batch_reduce task once every shard is done. Without a
+        partition, queue a reduce task for each of them. The job is done
+        once every partition is, and partitions reduced already are
+        ignored."""
+        job = ndb.Key(urlsafe=job_key).get()
+        if not job or job.status != 'RUNNING':
+            return
+        if partition is None:
+            for partition in range(job.totalReducers):
+                try:
+                    taskqueue.add(
+                        url='/tasks/batch_reduce', queue_name=BATCH_QUEUE,
+                        name='reduce-%d-%d' % (job.key.id(), partition),
+                        params={'jobKey': job_key, 'partition': partition})
+                except (taskqueue.TaskAlreadyExistsError,
+                        taskqueue.TombstonedTaskError):
+                    pass
+            return
+        if partition in job.donePartitions:
+            return
+
+        reduce_fn = ConferenceApi._batchJobTypes()[job.jobType][1]
+        shards = ndb.get_multi([ndb.Key(BatchShard, n, parent=job.key)
+                                for n in range(1, job.totalShards + 1)])
+        part_keys = [
+            ConferenceApi._batchOutputKey(
+                job.key, shard.key.id(), step, flush, partition)
+            for shard in shards
+            for step, flushes in enumerate(shard.flushes)
+            for flush in range(flushes)]
+
+        def outputs():
+            for i in range(0, len(part_keys), BULK_PUT_CHUNK):
+                for part in ndb.get_multi(part_keys[i:i + BULK_PUT_CHUNK],
+                                          use_cache=False):
+                    if part and part.output:
+                        yield part.output
+        messages = reduce_fn(job, partition, outputs())
+        logging.info('%s job %s partition %d finished with %d messages',
+                     job.jobType, job.key.id(), partition, len(messages))
+
+        @ndb.transactional
+        def finish():
+            job = ndb.Key(urlsafe=job_key).get()
+            if partition in job.donePartitions:
+                return
+            room = max(0, BATCH_MAX_MESSAGES - len(job.messages))
+            if len(messages) > room:
+                job.messages.extend(messages[:room] + [
+                    '... and %d more' % (len(messages) - room)])
+            else:
+                job.messages.extend(messages)
+            job.donePartitions.append(partition)
+            if len(job.donePartitions) == job.totalReducers:
+                job.status = 'DONE'
+            job.put()
+        finish()
+        for i in range(0, len(part_keys), BULK_PUT_CHUNK):
+            ndb.delete_multi(part_keys[i:i + BULK_PUT_CHUNK])
+
+    @staticmethod
+    def _mapSeatCounts(counts, prof):
+        """Count the registrations of a Profile per conference."""
+        added = 0
+        for c_key in set(prof.conferenceKeysToAttend):
+            wsck = c_key.urlsafe()
+            added += wsck not in counts
+            counts[wsck] = counts.get(wsck, 0) + 1
+        return added
+
+    @staticmethod
+    def _reduceSeatCounts(job, partition, outputs):
+        """Compare the registrations counted by every shard against
+        maxAttendees - seatsAvailable of each conference, repairing
+        seatsAvailable if the job was started with repair. The job has a
+        single reducer, so every conference is in its partition."""
+        counts = {}
+        for output in outputs:
+            for wsck, n in output.items():
+                counts[wsck] = counts.get(wsck, 0) + n
+
+        messages = []
+        cursor, more = None, True
+        while more:
+            confs, cursor, more = Conference.query().fetch_page(
+                BATCH_PAGE_SIZE, start_cursor=cursor, use_cache=False)
+            for conf in confs:
+                if conf.deleted:
+                    continue
+                registered = counts.get(conf.key.urlsafe(), 0)
+                expected = (conf.maxAttendees or 0) - (conf.seatsAvailable or 0)
+                if registered == expected:
+                    continue
+                messages.append('%s (%s): %d registered, seats imply %d' % (
+                    conf.name, conf.key.urlsafe(), registered, expected))
+                if job.repair:
+                    ConferenceApi._repairSeats(conf.key, registered)
+        return messages
+
+    @staticmethod
+    @ndb.transactional
+    def _repairSeats(c_key, registered):
+        """Set seatsAvailable from the number of registered Profiles.
+        Registrations made while the job was scanning aren't counted,
+        so repairs are best run while registration is quiet."""
+        conf = c_key.get()
+        announced = ConferenceApi._isNearlySoldOut(conf)
+        conf.seatsAvailable = max(0, (conf.maxAttendees or 0) - registered)
+        if announced != ConferenceApi._isNearlySoldOut(conf):
+            ConferenceApi._queueAnnouncementUpdate([c_key])
+        conf.put()
+
+
+    @staticmethod
+    def _mapCoSaves(counts, prof):
+        """Count the pairs of sessions saved to a Profile's wishlist.
+        Pairs are counted under both of their sessions, so each reducer
+        finds every neighbour of the sessions in its partition."""
+        added = 0
+        wishlist = set(s_key.urlsafe() for s_key in
+                       prof.sessionKeysToAttend[:RECOMMEND_MAX_WISHLIST])
+        for a in wishlist:
+            row = counts.setdefault(a, {})
+            for b in wishlist:
+                if b != a:
+                    added += b not in row
+                    row[b] = row.get(b, 0) + 1
+        return added
+
+    @staticmethod
+    def _reduceCoSaves(job, partition, outputs):
+        """Combine the pair counts of the sessions in a partition and
+        store the top RECOMMEND_TOP_K neighbours of each; neighbours in
+        the partition's key range left from earlier runs that this one
+        didn't rewrite are deleted."""
+        counts = {}
+        for output in outputs:
+            for a, row in output.items():
+                neighbours = counts.setdefault(a, {})
+                for b, n in row.items():
+                    neighbours[b] = neighbours.get(b, 0) + n
+
+        entities = []
+        for wssk, neighbours in counts.items():
+            top = heapq.nlargest(RECOMMEND_TOP_K, neighbours.items(),
+                                 key=lambda item: item[1])
+            entities.append(SessionNeighbours(
+                key=ndb.Key(SessionNeighbours, 1,
+                            parent=ndb.Key(urlsafe=wssk)),
+                sessionKeys=[ndb.Key(urlsafe=b) for b, _ in top],
+                counts=[n for _, n in top]))
+        for i in range(0, len(entities), BULK_PUT_CHUNK):
+            ndb.put_multi(entities[i:i + BULK_PUT_CHUNK])
+
+        # The neighbours of a Session sort right after it, so those of
+        # the partition's sessions are between its Session bounds
+        start, end = ConferenceApi._partitionRange(job, partition)
+        q = SessionNeighbours.query()
+        if start:
+            q = q.filter(ndb.query.FilterNode('__key__', '>=', start))
+        if end:
+            q = q.filter(ndb.query.FilterNode('__key__', '<', end))
+        written = set(entity.key for entity in entities)
+        stale = [key for key in q.fetch(keys_only=True)
+                 if key not in written]
+        for i in range(0, len(stale), BULK_PUT_CHUNK):
+            ndb.delete_multi(stale[i:i + BULK_PUT_CHUNK])
+        return ['Stored neighbours of %d sessions, removed %d stale' % (
+            len(entities), len(stale))]
+
+
+# - - - Migrations - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _migrationModels():
+        """Return the kinds rewritten by _migrateEntities, each with an
+        optional function that computes, outside of the transaction,
+        the property values to set on a batch of entities."""
+        return {
+            'Session': (Session, None),
+            'Profile': (Profile, None),
+            'Conference': (Conference, None),
+            'Speaker': (Speaker, ConferenceApi._speakerCounts),
+        }
+
+    @staticmethod
+    def _missingUniqueValues(entities):
+        """Return the UniqueValue markers that entities written before
+        markers existed lack; the migration puts them, in the same
+        entity groups, along with the entities."""
+        claims = [(ConferenceApi._sessionNameKey(e.key.parent(), e.name),
+                   e.key) for e in entities if isinstance(e, Session)]
+        claims += [(ConferenceApi._speakerNameKey(e.name), e.key)
+                   for e in entities if isinstance(e, Speaker)]
+        markers = ndb.get_multi([key for key, _ in claims])
+        missing = {}
+        for (key, owner), marker in zip(claims, markers):
+            # Of speakers with the same normalized name, the first keeps
+            # it; the others are no longer found by name
+            if not marker and key not in missing:
+                missing[key] = UniqueValue(key=key, owner=owner)
+        return missing.values()
+
+    @staticmethod
+    def _queueMigration(kind, cursor=None):
+        """Queue the migration of the batch of a kind that starts at
+        the given urlsafe cursor."""
+        params = {'kind': kind}
+        if cursor:
+            params['cursor'] = cursor
+        taskqueue.add(params=params, url='/tasks/migrate_entities')
+
+    @staticmethod
+    def _migrateEntities(kind, cursor=None):
+        """Rewrite one batch of entities of a kind and queue the next
+        one; used by the migrate_entities task. Saving an entity writes
+        every property in its current format, e.g. LegacyKeyProperty
+        values as keys. The task carries the query cursor, so a failed
+        batch is retried from where it stopped.
+        """
+        model, compute = ConferenceApi._migrationModels()[kind]
+        keys, cursor, more = model.query().fetch_page(
+            MIGRATION_BATCH_SIZE, keys_only=True,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        # Re-read and write in transactions so concurrent updates of
+        # the same entities aren't lost
+        @ndb.transactional(xg=True)
+        def rewrite(keys, values):
+            entities = [e for e in ndb.get_multi(keys) if e]
+            for entity in entities:
+                entity.populate(**values.get(entity.key, {}))
+            ndb.put_multi(entities +
+                          ConferenceApi._missingUniqueValues(entities))
+
+        for i in range(0, len(keys), UNIQUE_ROOT_BATCH):
+            batch = keys[i:i + UNIQUE_ROOT_BATCH]
+            values = compute([e for e in ndb.get_multi(batch) if e]) \
+                if compute else {}
+            rewrite(batch, values)
+        if more and cursor:
+            ConferenceApi._queueMigration(kind, cursor.urlsafe())
+        return len(keys)
+
+
+# - - - Mail - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _queueEmails(emails, name=None):
+        """Buffer (to, subject, body) tuples in the mail pull queue;
+        sent in batches by _sendQueuedEmails(). Given a name, the tasks
+        are named after it and their position, so a retried caller
+        doesn't buffer the same emails twice.
+        """
+        tasks = [taskqueue.Task(
+                     method='PULL', name='%s-%d' % (name, i) if name else None,
+                     payload=json.dumps(
+                         {'to': to, 'subject': subject, 'body': body}))
+                 for i, (to, subject, body) in enumerate(emails)]
+        queue = taskqueue.Queue(MAIL_QUEUE)
+        # Queue.add() accepts at most 100 tasks per call
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            try:
+                queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                # Buffered by an earlier attempt; the other tasks of the
+                # call are still added
+                pass
+
+    @staticmethod
+    def _queueMailDrain(name):
+        """Queue a run of _sendQueuedEmails() besides the mail cron's,
+        named so that a retried caller queues it once."""
+        try:
+            taskqueue.add(name=name, url='/tasks/send_queued_emails')
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def _sendEmailGroups(groups):
+        """Send grouped emails using a bounded number of threads.
+        Returns the lists of tasks that were sent and that failed.
+        """
+        sender = 'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id())
+        pending = deque(groups.items())
+        sent, failed = [], []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    (to, subject), items = pending.popleft()
+                except IndexError:
+                    return
+                body = '\r\n\r\n- - -\r\n\r\n'.join(
+                    item[1] for item in items)
+                tasks = [item[0] for item in items]
+                try:
+                    mail.send_mail(sender, to, subject, body)
+                except Exception:
+                    logging.exception('Sending mail to %s failed', to)
+                    with lock:
+                        failed.extend(tasks)
+                else:
+                    with lock:
+                        sent.extend(tasks)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(MAIL_SEND_CONCURRENCY, len(pending)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return sent, failed
+
+    @staticmethod
+    def _sendQueuedEmails():
+        """Drain the mail pull queue; used by the mail cron job.
+        Messages to the same recipient with the same subject are
+        combined into one email. A failed email only returns its own
+        tasks to the queue, where they are retried on a later run.
+        Returns the number of tasks sent and failed.
+        """
+        queue = taskqueue.Queue(MAIL_QUEUE)
+        total_sent = total_failed = 0
+        for _ in range(MAIL_DRAIN_ROUNDS):
+            tasks = queue.lease_tasks(MAIL_LEASE_SECONDS, MAIL_BATCH_SIZE)
+            if not tasks:
+                break
+
+            groups = {}
+            dropped = []
+            for task in tasks:
+                if task.retry_count > MAIL_MAX_RETRIES:
+                    logging.error('Dropping mail task %s after %d retries',
+                                  task.name, task.retry_count)
+                    dropped.append(task)
+                    continue
+                msg = json.loads(task.payload)
+                groups.setdefault((msg['to'], msg['subject']), []).append(
+                    (task, msg['body']))
+
+            sent, failed = ConferenceApi._sendEmailGroups(groups)
+            # Failed tasks stay leased and are retried once the lease
+            # runs out
+            if sent or dropped:
+                queue.delete_tasks(sent + dropped)
+            total_sent += len(sent)
+            total_failed += len(failed)
+            if len(tasks) < MAIL_BATCH_SIZE:
+                break
+        return total_sent, total_failed
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+        """Register or unregister user for selected conference, in one
+        transaction on the Profile and the Conference."""
+        return getStorage().transaction(
+            lambda: self._updateRegistration(request, reg), xg=True)
+
+    def _updateRegistration(self, request, reg):
         retval = None
         prof = self._getProfileFromUser()  # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = getStorage().get(c_key)
+        if not conf or conf.deleted:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        announced = self._isNearlySoldOut(conf)
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if c_key in prof.conferenceKeysToAttend:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -1067,55 +3025,61 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            prof.conferenceKeysToAttend.append(c_key)
             conf.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if c_key in prof.conferenceKeysToAttend:
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                # unregister user, add back one seat and offer it to
+                # the waitlist
+                prof.conferenceKeysToAttend.remove(c_key)
                 conf.seatsAvailable += 1
+                self._queueWaitlistPromotion(wsck)
                 retval = True
             else:
                 retval = False
 
+        # update the announcement if the conference crossed the
+        # nearly sold out threshold
+        if announced != self._isNearlySoldOut(conf):
+            self._queueAnnouncementUpdate([conf.key])
+
         # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        getStorage().putMulti([prof, conf])
         return BooleanMessage(data=retval)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(FIELDS_REQUEST, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
+    @capturedCall
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
+        fields = self._parseFields(request.fields, ConferenceForm)
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conferences = [conf for conf in
+                       getStorage().getMulti(prof.conferenceKeysToAttend)
+                       if conf and not conf.deleted]
 
         # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        if not fields or 'organizerDisplayName' in fields:
+            names = self._organizerNames(conferences)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])
+        return ConferenceForms(items=[self._copyConferenceToForm(
+                                          conf, names.get(conf.organizerUserId),
+                                          fields)
                                       for conf in conferences]
                                )
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
+    @capturedCall
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -1123,28 +3087,516 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
+    @capturedCall
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+    @staticmethod
+    def _claimSeats(c_key, wanted):
+        """Take up to `wanted` seats of a conference, returning how many
+        were taken; a negative number gives seats back."""
+        storage = getStorage()
+
+        def claim():
+            conf = storage.get(c_key)
+            if not conf or conf.deleted:
+                return 0
+            announced = ConferenceApi._isNearlySoldOut(conf)
+            claimed = min(wanted, max(0, conf.seatsAvailable))
+            if claimed:
+                conf.seatsAvailable -= claimed
+                if announced != ConferenceApi._isNearlySoldOut(conf):
+                    ConferenceApi._queueAnnouncementUpdate([c_key])
+                storage.put(conf)
+            return claimed
+        return storage.transaction(claim)
+
+    @staticmethod
+    def _registerMany(registrations):
+        """Register (Profile, conference key) pairs, returning a
+        BulkResultForm per pair. Seats are claimed in one transaction
+        per conference, then the Profiles are written with put_multi in
+        transactions of up to 25; seats of registrations that fail to
+        be written are given back."""
+        results = [BulkResultForm(index=i, success=False)
+                   for i in range(len(registrations))]
+        storage = getStorage()
+        c_keys = list(set(c_key for _, c_key in registrations if c_key))
+        confs = dict(zip(c_keys, storage.getMulti(c_keys)))
+
+        # Check everything that can be checked before taking seats
+        wanted = {}
+        seen = set()
+        for i, (prof, c_key) in enumerate(registrations):
+            if not c_key:
+                results[i].error = 'Invalid websafeConferenceKey'
+                continue
+            results[i].websafeKey = c_key.urlsafe()
+            conf = confs.get(c_key)
+            if not conf or conf.deleted:
+                results[i].error = 'No conference found with key: %s' % (
+                    c_key.urlsafe())
+            elif (c_key in prof.conferenceKeysToAttend or
+                    (prof.key, c_key) in seen):
+                results[i].error = ('Already registered for this '
+                                    'conference')
+            else:
+                seen.add((prof.key, c_key))
+                wanted.setdefault(c_key, []).append(i)
+
+        granted = []
+        for c_key, indexes in wanted.items():
+            claimed = ConferenceApi._claimSeats(c_key, len(indexes))
+            granted.extend(indexes[:claimed])
+            for i in indexes[claimed:]:
+                results[i].error = 'There are no seats available.'
+
+        # Re-read the Profiles in the transactions, so concurrent
+        # changes to them are kept
+        by_profile = {}
+        for i in sorted(granted):
+            prof = registrations[i][0]
+            by_profile.setdefault(prof.key, (prof, []))[1].append(i)
+
+        def register(entries):
+            stored = storage.getMulti([prof.key for prof, _ in entries])
+            profiles, duplicates = [], []
+            for (prof, indexes), current in zip(entries, stored):
+                current = current or prof
+                for i in indexes:
+                    c_key = registrations[i][1]
+                    if c_key in current.conferenceKeysToAttend:
+                        duplicates.append(i)
+                    else:
+                        current.conferenceKeysToAttend.append(c_key)
+                profiles.append(current)
+            storage.putMulti(profiles)
+            return duplicates
+
+        entries = by_profile.values()
+        released = []
+        for n in range(0, len(entries), 25):
+            chunk = entries[n:n + 25]
+            try:
+                duplicates = storage.transaction(
+                    lambda: register(chunk), xg=True)
+            except Exception as e:
+                logging.exception('Writing registrations failed')
+                duplicates = [i for _, indexes in chunk for i in indexes]
+                for i in duplicates:
+                    results[i].error = str(e) or type(e).__name__
+            else:
+                for i in duplicates:
+                    results[i].error = ('Already registered for this '
+                                        'conference')
+            released.extend(duplicates)
+            for _, indexes in chunk:
+                for i in indexes:
+                    results[i].success = i not in duplicates
+
+        counts = {}
+        for i in released:
+            c_key = registrations[i][1]
+            counts[c_key] = counts.get(c_key, 0) + 1
+        for c_key, n in counts.items():
+            ConferenceApi._claimSeats(c_key, -n)
+        return BulkResultForms(items=results)
+
+    @endpoints.method(ConferenceKeysForm, BulkResultForms,
+                      path='conferences/register',
+                      http_method='POST', name='registerForConferences')
+    @capturedCall
+    def registerForConferences(self, request):
+        """Register user for several conferences in one call."""
+        if len(request.websafeConferenceKeys) > REGISTRATION_BATCH_MAX:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per call' % REGISTRATION_BATCH_MAX)
+        prof = self._getProfileFromUser()
+        registrations = []
+        for wsck in request.websafeConferenceKeys:
+            try:
+                c_key = ndb.Key(urlsafe=wsck)
+            except Exception:
+                c_key = None
+            registrations.append((prof, c_key))
+        return self._registerMany(registrations)
+
+    @endpoints.method(GROUP_REGISTRATION_REQUEST, BulkResultForms,
+                      path='conference/{websafeConferenceKey}/registrations',
+                      http_method='POST', name='registerGroupForConference')
+    @capturedCall
+    def registerGroupForConference(self, request):
+        """Register several users, by email, for a conference; Profiles
+        are created for users who don't have one yet. Only the organizer
+        of the conference may register a group."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if len(request.emails) > GROUP_REGISTRATION_MAX:
+            raise endpoints.BadRequestException(
+                'At most %d users per call' % GROUP_REGISTRATION_MAX)
+        try:
+            c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        except Exception:
+            raise endpoints.BadRequestException(
+                'Invalid websafeConferenceKey')
+
+        conf = getStorage().get(c_key)
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        if getUserId(user) != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer may register a group')
+
+        # Profiles are keyed by email, see getUserId()
+        p_keys = [ndb.Key(Profile, email) for email in request.emails]
+        profiles = dict(zip(p_keys, getStorage().getMulti(p_keys)))
+        registrations = []
+        for email, p_key in zip(request.emails, p_keys):
+            if not profiles[p_key]:
+                profiles[p_key] = Profile(
+                    key=p_key,
+                    displayName=email.split('@')[0],
+                    mainEmail=email,
+                    teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+                )
+            registrations.append((profiles[p_key], c_key))
+        return self._registerMany(registrations)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground',
                       http_method='GET', name='filterPlayground')
+    @capturedCall
+    @rateLimited(3)
     def filterPlayground(self, request):
         """Filter Playground"""
-        q = Conference.query()
-        # field = "city"
-        # operator = "="
-        # value = "London"
-        # f = ndb.query.FilterNode(field, operator, value)
-        # q = q.filter(f)
-        q = q.filter(Conference.city == "London")
-        q = q.filter(Conference.topics == "Medical Innovations")
-        q = q.filter(Conference.month == 6)
+        confs = getStorage().query(Conference, filters=[
+            ('city', '=', "London"),
+            ('topics', '=', "Medical Innovations"),
+            ('month', '=', 6)])
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf, "") for conf in confs]
         )
 
 
+# - - - Waitlist - - - - - - - - - - - - - - - - - - - - - -
+
+    def _waitlistEntryKey(self, c_key, user_id):
+        return ndb.Key(WaitlistEntry, '%s|%s' % (c_key.urlsafe(), user_id))
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='POST', name='joinWaitlist')
+    @capturedCall
+    def joinWaitlist(self, request):
+        """Wait for a seat at a conference; waiting users are registered
+        in the order they joined as seats free up."""
+        prof = self._getProfileFromUser()
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        storage = getStorage()
+        conf = storage.get(c_key)
+        if not conf or conf.deleted:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if c_key in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        def join():
+            e_key = self._waitlistEntryKey(c_key, prof.key.id())
+            if storage.get(e_key):
+                raise ConflictException(
+                    "You are already on the waitlist for this conference")
+            storage.put(WaitlistEntry(key=e_key, conference=c_key,
+                                      userId=prof.key.id()))
+        storage.transaction(join)
+
+        # Seats may have freed up since the user saw it sold out
+        if conf.seatsAvailable > 0:
+            self._queueWaitlistPromotion(wsck)
+        return BooleanMessage(data=True)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='DELETE', name='leaveWaitlist')
+    @capturedCall
+    def leaveWaitlist(self, request):
+        """Stop waiting for a seat at a conference."""
+        prof = self._getProfileFromUser()
+        e_key = self._waitlistEntryKey(
+            ndb.Key(urlsafe=request.websafeConferenceKey), prof.key.id())
+        storage = getStorage()
+        if not storage.get(e_key):
+            return BooleanMessage(data=False)
+        storage.deleteMulti([e_key])
+        return BooleanMessage(data=True)
+
+    @staticmethod
+    def _queueWaitlistPromotion(wsck):
+        """Queue the promotion of a conference's waiting users; inside a
+        transaction the task only runs if it commits."""
+        taskqueue.add(params={'websafeConferenceKey': wsck},
+                      url='/tasks/promote_waitlist',
+                      countdown=WAITLIST_DELAY,
+                      transactional=ndb.in_transaction())
+
+    @staticmethod
+    def _queueWaitlistPromotions():
+        """Queue a promotion for every conference with waiting users;
+        used by the promote_waitlists cron job to pick up seats freed
+        other than by unregistering, e.g. a raised maxAttendees."""
+        entries = WaitlistEntry.query(
+            projection=[WaitlistEntry.conference], distinct=True)
+        for entry in entries:
+            ConferenceApi._queueWaitlistPromotion(entry.conference.urlsafe())
+
+    @staticmethod
+    def _promoteWaitlist(wsck):
+        """Register the first waiting users of a conference for its
+        available seats, one batch per task; used by the promote_waitlist
+        task. Duplicate tasks are harmless: _registerMany() skips users
+        who are already registered and gives their seats back."""
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
+        q = WaitlistEntry.query(WaitlistEntry.conference == c_key).order(
+            WaitlistEntry.created)
+        if not conf or conf.deleted:
+            e_keys = q.fetch(WAITLIST_BATCH, keys_only=True)
+            ndb.delete_multi(e_keys)
+            if len(e_keys) == WAITLIST_BATCH:
+                ConferenceApi._queueWaitlistPromotion(wsck)
+            return
+        if conf.seatsAvailable <= 0:
+            return
+
+        entries = q.fetch(min(conf.seatsAvailable, WAITLIST_BATCH))
+        profiles = ndb.get_multi([ndb.Key(Profile, entry.userId)
+                                  for entry in entries])
+        done, waiting = [], []
+        for entry, prof in zip(entries, profiles):
+            if not prof or c_key in prof.conferenceKeysToAttend:
+                done.append(entry.key)
+            else:
+                waiting.append((entry, prof))
+
+        results = ConferenceApi._registerMany(
+            [(prof, c_key) for _, prof in waiting]).items
+        emails = []
+        for (entry, prof), result in zip(waiting, results):
+            if result.success:
+                done.append(entry.key)
+                emails.append((prof.mainEmail, WAITLIST_EMAIL_SUBJECT,
+                               WAITLIST_EMAIL_TPL % conf.name))
+        ndb.delete_multi(done)
+        ConferenceApi._queueEmails([e for e in emails if e[0]])
+
+        # A full batch may mean more seats and more users are left
+        if len(entries) == WAITLIST_BATCH and done:
+            ConferenceApi._queueWaitlistPromotion(wsck)
+
+
+# - - - Sync - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _syncStreams():
+        """Return the queries getChangesSince pages through in order,
+        each with the timestamp property it's ordered by."""
+        return [(Conference, Conference.modified),
+                (Session, Session.modified),
+                (Tombstone, Tombstone.deleted)]
+
+    @staticmethod
+    def _encodeSyncToken(token):
+        return base64.urlsafe_b64encode(json.dumps(token))
+
+    def _decodeSyncToken(self, value):
+        """Return the state saved in a sync token: the `since` and
+        `until` timestamps, in microseconds, of the sync in progress,
+        the stream it's in and the cursor within that stream."""
+        token = {'since': None, 'until': None, 'stream': 0, 'cursor': None}
+        if value:
+            try:
+                token.update(json.loads(base64.urlsafe_b64decode(
+                    str(value))))
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException('Invalid sync token')
+        oldest = datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS)
+        if token['since'] and self._fromMicros(token['since']) < oldest:
+            raise endpoints.BadRequestException(
+                'Sync token expired; sync again without a token')
+        return token
+
+    @staticmethod
+    def _toMicros(dt):
+        delta = dt - datetime(1970, 1, 1)
+        return (delta.days * 86400 + delta.seconds) * 1000000 + \
+            delta.microseconds
+
+    @staticmethod
+    def _fromMicros(micros):
+        return datetime(1970, 1, 1) + timedelta(microseconds=micros)
+
+    @endpoints.method(CHANGES_REQUEST, ChangesForm,
+                      path='changes',
+                      http_method='GET',
+                      name='getChangesSince')
+    @capturedCall
+    def getChangesSince(self, request):
+        """Return the conferences and sessions changed or deleted, and
+        the user's profile if it changed, since the sync that returned
+        `token`; without a token, everything. Pages of a sync are
+        chained with nextToken while `more` is set; the last page's
+        nextToken starts the next sync."""
+        prof = self._getProfileFromUser()
+        token = self._decodeSyncToken(request.token)
+        if not token['until']:
+            token['until'] = self._toMicros(
+                datetime.utcnow() - timedelta(seconds=SYNC_LAG_SECONDS))
+        since = token['since'] and self._fromMicros(token['since'])
+        until = self._fromMicros(token['until'])
+
+        changes = ChangesForm(more=False)
+        streams = self._syncStreams()
+        stream, cursor = token['stream'], token['cursor']
+        budget = SYNC_PAGE_SIZE
+        while stream < len(streams) and budget > 0:
+            model, prop = streams[stream]
+            q = model.query(prop <= until)
+            if since:
+                q = q.filter(prop > since)
+            results, cursor, more = q.order(prop).fetch_page(
+                budget, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+            budget -= len(results)
+            self._addChanges(changes, results)
+            if more and cursor:
+                cursor = cursor.urlsafe()
+                break
+            stream, cursor = stream + 1, None
+
+        if stream < len(streams):
+            changes.more = True
+            token.update(stream=stream, cursor=cursor)
+            changes.nextToken = self._encodeSyncToken(token)
+            return changes
+
+        if prof.modified and (not since or prof.modified > since):
+            changes.profile = self._copyProfileToForm(prof)
+        changes.nextToken = self._encodeSyncToken(
+            {'since': token['until'], 'until': None, 'stream': 0,
+             'cursor': None})
+        return changes
+
+    def _addChanges(self, changes, results):
+        """Add a page of Conferences, Sessions or Tombstones to changes."""
+        conferences = [e for e in results if isinstance(e, Conference)]
+        names = self._organizerNames(
+            [conf for conf in conferences if not conf.deleted])
+        for entity in results:
+            if isinstance(entity, Tombstone):
+                changes.deleted.append(TombstoneForm(
+                    kind=entity.kind, websafeKey=entity.websafeKey))
+            elif isinstance(entity, Session):
+                changes.sessions.append(self._copySessionToForm(entity))
+            elif entity.deleted:
+                changes.deleted.append(TombstoneForm(
+                    kind='Conference', websafeKey=entity.key.urlsafe()))
+            else:
+                changes.conferences.append(self._copyConferenceToForm(
+                    entity, names.get(entity.organizerUserId)))
+
+    @staticmethod
+    def _expireTombstones():
+        """Delete tombstones older than any usable sync token; used by
+        the expire_tombstones cron job."""
+        oldest = datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS)
+        t_keys = Tombstone.query(Tombstone.deleted < oldest).fetch(
+            keys_only=True)
+        for i in range(0, len(t_keys), BULK_PUT_CHUNK):
+            ndb.delete_multi(t_keys[i:i + BULK_PUT_CHUNK])
+
+
+# - - - Attendee notifications - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _conferenceChanges(before, conf):
+        """Return a line per NOTIFY_FIELDS property of conf whose value
+        differs from the one in the dict before."""
+        changes = []
+        for field, label in NOTIFY_FIELDS:
+            if getattr(conf, field) != before[field]:
+                changes.append('%s: %s (was %s)' % (
+                    label, getattr(conf, field) or 'none',
+                    before[field] or 'none'))
+        return changes
+
+    @staticmethod
+    def _queueAttendeeNotification(wsck, subject, body, notification,
+                                   legacy=False, cursor=None, page=0):
+        """Queue the step of an attendee notification that emails the
+        page of attendees at cursor. Inside a transaction the step only
+        runs if it commits; the steps queued by other steps are named
+        after the notification and the page, so a retried step doesn't
+        queue the next one twice."""
+        params = {'websafeConferenceKey': wsck, 'subject': subject,
+                  'body': body, 'notification': notification,
+                  'page': page}
+        if legacy:
+            params['legacy'] = 1
+        if cursor:
+            params['cursor'] = cursor
+        if ndb.in_transaction():
+            # Transactional tasks can't be named
+            taskqueue.add(params=params, url='/tasks/notify_attendees',
+                          transactional=True)
+            return
+        try:
+            taskqueue.add(name='notify-%s-%d-%d' % (notification, legacy, page),
+                          params=params, url='/tasks/notify_attendees')
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def _notifyAttendees(wsck, subject, body, notification, legacy=False,
+                         cursor=None, page=0):
+        """Buffer the emails of one page of a conference's attendees in
+        the mail queue and queue the next page; used by the
+        notify_attendees task. Profiles still holding the conference key
+        as a urlsafe string are paged through after the others while
+        MATCH_LEGACY_KEYS is on. The emails and the run that sends them
+        are named after the notification and the page, so a retried page
+        doesn't email its attendees twice.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
+        if not conf or conf.deleted:
+            return
+
+        q = Profile.query(ndb.query.FilterNode(
+            'conferenceKeysToAttend', '=', wsck) if legacy
+            else Profile.conferenceKeysToAttend == c_key)
+        profiles, next_cursor, more = q.fetch_page(
+            NOTIFY_PAGE_SIZE, projection=[Profile.mainEmail],
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        emails = [(prof.mainEmail, subject, body)
+                  for prof in profiles if prof.mainEmail]
+        if emails:
+            name = 'notify-%s-%d-%d' % (notification, legacy, page)
+            ConferenceApi._queueEmails(emails, name=name)
+            ConferenceApi._queueMailDrain('send-' + name)
+
+        if more and next_cursor:
+            ConferenceApi._queueAttendeeNotification(
+                wsck, subject, body, notification, legacy,
+                next_cursor.urlsafe(), page + 1)
+        elif not legacy and MATCH_LEGACY_KEYS:
+            ConferenceApi._queueAttendeeNotification(
+                wsck, subject, body, notification, legacy=True)
+
+
 api = endpoints.api_server([ConferenceApi])  # register API
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""loader.py
+
+Conference server-side Python App Engine request-scoped batching of
+entity fetches
+
+"""
+
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
+
+from storage import getStorage
+
+
+class KeyLoader(object):
+    """Collects the keys asked for while building a response and fetches
+    them together.
+
+    load() returns a Future at once; the keys requested before the ndb
+    event loop next runs, e.g. by tasklets converting a list of entities
+    or before the first get_result(), are deduplicated and fetched with
+    a single get_multi. Entities are remembered for the life of the
+    loader, so create one per request.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._loaded = {}
+
+    def load(self, key):
+        """Return a Future for the entity of key (None if missing)."""
+        if key in self._loaded:
+            future = ndb.Future()
+            future.set_result(self._loaded[key])
+            return future
+        if key not in self._pending:
+            if not self._pending:
+                eventloop.queue_call(None, self._flush)
+            self._pending[key] = ndb.Future()
+        return self._pending[key]
+
+    def loadMulti(self, keys):
+        """Return a Future for the entity of each key."""
+        return [self.load(key) for key in keys]
+
+    def getMulti(self, keys):
+        """Like ndb.get_multi(), through the loader."""
+        return [future.get_result() for future in self.loadMulti(keys)]
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        keys = pending.keys()
+        for key, rpc in zip(keys, getStorage().getMultiAsync(keys)):
+            rpc.add_callback(self._resolve, key, rpc, pending[key])
+
+    def _resolve(self, key, rpc, future):
+        exception = rpc.get_exception()
+        if exception:
+            future.set_exception(exception)
+            return
+        self._loaded[key] = rpc.get_result()
+        future.set_result(self._loaded[key])
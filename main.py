@@ -7,33 +7,219 @@ Conference server-side Python App Engine
 """
 
 
+import csv
+import json
+import endpoints
 import webapp2
+from cStringIO import StringIO
+from datetime import datetime
+from datetime import timedelta
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.ext import ndb
+from protorpc import message_types
+from protorpc import protojson
+from cache import entityStamp
+from cache import localCacheStats
+from cache import versionStamps
+from conference import CONF_GET_REQUEST
+from conference import SESS_GET_REQUEST
 from conference import ConferenceApi
 
 from models import Speaker
+from ratelimit import rateLimitedHandler
 
 import random
 
+EXPORT_FIELDS = ['name', 'highlights', 'speaker', 'duration',
+                 'typeOfSession', 'date', 'startTime',
+                 'websafeConfKey', 'sessionKey']
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
 
     def get(self):
-        """Set Announcement in Memcache."""
-        ConferenceApi._cacheAnnouncement()
+        """Reconcile the Announcement and set it in Memcache; full=1
+        also looks for conferences missing from it."""
+        ConferenceApi._reconcileAnnouncement(
+            full=self.request.get('full') == '1')
         self.response.set_status(204)
 
 
+class UpdateAnnouncementHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Update the Announcement for conferences whose seats changed."""
+        ConferenceApi._updateAnnouncement(
+            [ndb.Key(urlsafe=wsck) for wsck in
+             self.request.get_all('websafeConferenceKey')])
+
+
 class SetFeaturedSpeaker(webapp2.RequestHandler):
     # Using post seems to be triggered more often?
     def post(self):
         """Set the featured speaker in Memcache"""
-        ConferenceApi._cacheFeaturedSpeaker(self.request.get('sessionKey'))
+        wsck = self.request.get('websafeConferenceKey')
+        if not wsck:
+            # Tasks queued before the conference key was passed
+            wsck = ndb.Key(
+                urlsafe=self.request.get('sessionKey')).parent().urlsafe()
+        ConferenceApi._cacheFeaturedSpeaker(wsck)
 
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
+class UpdateTimelineHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Rebuild a conference's now and next timeline in memcache."""
+        ConferenceApi._cacheTimeline(self.request.get('websafeConferenceKey'))
+
+
+class ImportChunkHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Write one chunk of a session import."""
+        ConferenceApi._importChunk(self.request.get('jobKey'),
+                                   int(self.request.get('chunk')))
+
+
+class RecountSpeakersHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Recompute the session counts of speakers."""
+        ConferenceApi._recountSpeakers(
+            [ndb.Key(urlsafe=k) for k in self.request.get_all('speakerKey')])
+
+
+class StartMigrationHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Start rewriting the entities of every migrated kind, or of
+        one kind from a cursor to resume a stopped migration."""
+        kind = self.request.get('kind')
+        if kind:
+            ConferenceApi._queueMigration(
+                kind, self.request.get('cursor') or None)
+        else:
+            for kind in ConferenceApi._migrationModels():
+                ConferenceApi._queueMigration(kind)
+        self.response.set_status(204)
+
+
+class MigrateEntitiesHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Rewrite one batch of entities."""
+        ConferenceApi._migrateEntities(self.request.get('kind'),
+                                       self.request.get('cursor') or None)
+
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Start a seat count reconciliation job; it only reports
+        mismatches unless repair=1 is given."""
+        ConferenceApi._startBatchJob(
+            'reconcile_seats', repair=self.request.get('repair') == '1')
+        self.response.set_status(204)
+
+
+class RecommendSessionsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Start a job rebuilding the co-wishlist session neighbours."""
+        ConferenceApi._startBatchJob('recommend_sessions')
+        self.response.set_status(204)
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Report the entity cache of the instance serving the request."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(localCacheStats()))
+
+
+class BatchShardHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Run one step of a BatchJob shard."""
+        ConferenceApi._runBatchShard(self.request.get('shardKey'),
+                                     int(self.request.get('step')))
+
+
+class BatchReduceHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Combine the shard outputs of a BatchJob, one partition at a
+        time."""
+        partition = self.request.get('partition')
+        ConferenceApi._reduceBatchJob(self.request.get('jobKey'),
+                                      int(partition) if partition else None)
+
+
+class DeleteConferenceHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Remove one batch of a deleted conference's data."""
+        ConferenceApi._cleanupConference(
+            self.request.get('websafeConferenceKey'),
+            self.request.get('phase'))
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Register waiting users for a conference's free seats."""
+        ConferenceApi._promoteWaitlist(
+            self.request.get('websafeConferenceKey'))
+
+
+class NotifyAttendeesHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Email a page of a conference's attendees about a change."""
+        ConferenceApi._notifyAttendees(
+            self.request.get('websafeConferenceKey'),
+            self.request.get('subject'),
+            self.request.get('body'),
+            self.request.get('notification'),
+            legacy=bool(self.request.get('legacy')),
+            cursor=self.request.get('cursor') or None,
+            page=int(self.request.get('page') or 0))
+
+
+class ExpireTombstonesHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Delete tombstones that no sync token can ask for anymore."""
+        ConferenceApi._expireTombstones()
+        self.response.set_status(204)
+
+
+class PromoteWaitlistsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Queue a promotion for every conference with a waitlist."""
+        ConferenceApi._queueWaitlistPromotions()
+        self.response.set_status(204)
+
+
+class SendQueuedEmailsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """Send the emails buffered in the mail pull queue."""
+        ConferenceApi._sendQueuedEmails()
+        self.response.set_status(204)
 
+    def post(self):
+        """Send the emails buffered in the mail pull queue, as a task
+        queued after a large batch of them."""
+        ConferenceApi._sendQueuedEmails()
+
+
+class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    # Only serves push tasks enqueued before mail went through the
+    # mail pull queue
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -47,8 +233,230 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+def _exportRow(sess, speaker_name):
+    """Flatten a Session into a dict of EXPORT_FIELDS strings."""
+    return {
+        'name': sess.name,
+        'highlights': sess.highlights,
+        'speaker': speaker_name,
+        'duration': sess.duration,
+        'typeOfSession': sess.typeOfSession,
+        'date': sess.date and str(sess.date),
+        'startTime': sess.startTime and sess.startTime.strftime('%H:%M'),
+        'websafeConfKey': sess.key.parent().urlsafe(),
+        'sessionKey': sess.key.urlsafe(),
+    }
+
+
+def _icalText(value):
+    """Escape a value for use in an iCalendar TEXT property."""
+    value = (value or u'').replace('\\', '\\\\').replace(';', '\\;')
+    value = value.replace(',', '\\,').replace('\n', '\\n')
+    return value.encode('utf-8')
+
+
+def _exportCsv(batches):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    for batch in batches:
+        for sess, speaker_name in batch:
+            row = _exportRow(sess, speaker_name)
+            writer.writerow([(row[f] or u'').encode('utf-8')
+                             for f in EXPORT_FIELDS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _exportJsonl(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(_exportRow(sess, speaker_name)) + '\n'
+                      for sess, speaker_name in batch)
+
+
+def _exportIcal(batches):
+    domain = '%s.appspot.com' % app_identity.get_application_id()
+    yield ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n'
+           'PRODID:-//%s//Conference Central//EN\r\n' % domain)
+    for batch in batches:
+        lines = []
+        for sess, speaker_name in batch:
+            # Sessions without a date can't be placed in a calendar
+            if not sess.date:
+                continue
+            lines.append('BEGIN:VEVENT')
+            lines.append('UID:%s@%s' % (sess.key.urlsafe(), domain))
+            if sess.startTime:
+                start = datetime.combine(sess.date, sess.startTime)
+                lines.append('DTSTART:%s' % start.strftime('%Y%m%dT%H%M%S'))
+                if sess.duration:
+                    hours, minutes = sess.duration[:5].split(':')
+                    end = start + timedelta(hours=int(hours),
+                                            minutes=int(minutes))
+                    lines.append('DTEND:%s' % end.strftime('%Y%m%dT%H%M%S'))
+            else:
+                lines.append('DTSTART;VALUE=DATE:%s' %
+                             sess.date.strftime('%Y%m%d'))
+            lines.append('SUMMARY:%s' % _icalText(sess.name))
+            if sess.highlights:
+                lines.append('DESCRIPTION:%s' % _icalText(sess.highlights))
+            if speaker_name:
+                lines.append('X-SPEAKER:%s' % _icalText(speaker_name))
+            lines.append('END:VEVENT')
+        if lines:
+            yield '\r\n'.join(lines) + '\r\n'
+    yield 'END:VCALENDAR\r\n'
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', _exportCsv),
+    'jsonl': ('application/x-ndjson; charset=utf-8', _exportJsonl),
+    'ics': ('text/calendar; charset=utf-8', _exportIcal),
+}
+
+
+class ExportSessionsHandler(webapp2.RequestHandler):
+
+    @rateLimitedHandler(10)
+    def get(self, fmt):
+        """Export the sessions of a conference and/or date range.
+        The body is produced batch by batch by a generator instead of
+        being built up in memory.
+        """
+        wsck = self.request.get('websafeConferenceKey')
+        try:
+            c_key = ndb.Key(urlsafe=wsck) if wsck else None
+            startDate, endDate = [
+                datetime.strptime(d[:10], '%Y-%m-%d').date() if d else None
+                for d in (self.request.get('startDate'),
+                          self.request.get('endDate'))]
+        except Exception:
+            self.abort(400, 'Invalid websafeConferenceKey or date')
+        if not (c_key or startDate or endDate):
+            self.abort(400, 'websafeConferenceKey, startDate or '
+                            'endDate is required')
+
+        content_type, writer = EXPORT_FORMATS[fmt]
+        self.response.headers['Content-Type'] = content_type
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename=sessions.%s' % fmt)
+        self.response.app_iter = writer(
+            ConferenceApi._exportSessionBatches(c_key, startDate, endDate))
+
+
+class ConditionalReadHandler(webapp2.RequestHandler):
+    """Serve the response of a ConferenceApi read method as JSON, with
+    an ETag made of the version stamps the response depends on. Requests
+    whose If-None-Match still matches get a 304 without the method being
+    called, so without any datastore reads. Endpoints can't answer 304
+    themselves, hence these plain handlers next to the API. While
+    memcache is unavailable there are no stamps to build the ETag from,
+    so responses are served whole and without one."""
+
+    def stamps(self, *args):
+        """Return the names of the version stamps of the resource."""
+        raise NotImplementedError
+
+    def call(self, api, *args):
+        """Return the response message of the resource."""
+        raise NotImplementedError
+
+    def get(self, *args):
+        # Read the stamps first: a write racing with the call below
+        # then at worst makes the next request do the work again
+        stamps = versionStamps(self.stamps(*args))
+        self.response.headers['Cache-Control'] = 'no-cache'
+        if None not in stamps.values():
+            etag = '-'.join(str(stamps[name]) for name in sorted(stamps))
+            self.response.etag = etag
+            if etag in self.request.if_none_match:
+                self.response.set_status(304)
+                return
+        try:
+            message = self.call(ConferenceApi(), *args)
+        except endpoints.ServiceException as e:
+            self.abort(e.http_status, str(e))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(protojson.encode_message(message))
+
+
+class ConferenceReadHandler(ConditionalReadHandler):
+
+    def stamps(self, wsck):
+        # The organizer's Profile, whose displayName is in the response,
+        # is the parent of the Conference
+        c_key = self.conferenceKey(wsck)
+        return [entityStamp(key) for key in (c_key, c_key.parent()) if key]
+
+    def conferenceKey(self, wsck):
+        try:
+            return ndb.Key(urlsafe=wsck)
+        except Exception:
+            self.abort(400, 'Invalid websafeConferenceKey')
+
+    def call(self, api, wsck):
+        return api.getConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck))
+
+
+class ConferenceSessionsReadHandler(ConferenceReadHandler):
+
+    def stamps(self, wsck):
+        return [entityStamp(self.conferenceKey(wsck)), 'sessions:' + wsck]
+
+    def call(self, api, wsck):
+        return api.getConferenceSessions(
+            SESS_GET_REQUEST.combined_message_class(websafeConfKey=wsck))
+
+
+class FeaturedSpeakerReadHandler(ConditionalReadHandler):
+
+    def stamps(self, wsck):
+        return ['featured:' + wsck]
+
+    def call(self, api, wsck):
+        return api.getFeaturedSpeaker(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck))
+
+
+class AnnouncementReadHandler(ConditionalReadHandler):
+
+    def stamps(self):
+        return ['announcement']
+
+    def call(self, api):
+        return api.getAnnouncement(message_types.VoidMessage())
+
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_queued_emails', SendQueuedEmailsHandler),
+    ('/crons/reconcile_seats', ReconcileSeatsHandler),
+    ('/crons/recommend_sessions', RecommendSessionsHandler),
+    ('/crons/promote_waitlists', PromoteWaitlistsHandler),
+    ('/crons/expire_tombstones', ExpireTombstonesHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeaker)
+    ('/tasks/set_featured_speaker', SetFeaturedSpeaker),
+    ('/tasks/update_timeline', UpdateTimelineHandler),
+    ('/tasks/import_chunk', ImportChunkHandler),
+    ('/tasks/recount_speakers', RecountSpeakersHandler),
+    ('/tasks/update_announcement', UpdateAnnouncementHandler),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/notify_attendees', NotifyAttendeesHandler),
+    ('/tasks/send_queued_emails', SendQueuedEmailsHandler),
+    ('/tasks/migrate_entities', MigrateEntitiesHandler),
+    ('/tasks/batch_shard', BatchShardHandler),
+    ('/tasks/batch_reduce', BatchReduceHandler),
+    ('/admin/migrate_entities', StartMigrationHandler),
+    ('/admin/reconcile_seats', ReconcileSeatsHandler),
+    ('/admin/recommend_sessions', RecommendSessionsHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    (r'/export/sessions\.(csv|jsonl|ics)', ExportSessionsHandler),
+    ('/read/conference/([^/]+)', ConferenceReadHandler),
+    ('/read/conference/([^/]+)/sessions', ConferenceSessionsReadHandler),
+    ('/read/conference/([^/]+)/featured_speaker', FeaturedSpeakerReadHandler),
+    ('/read/announcement', AnnouncementReadHandler)
 ], debug=True)
@@ -12,19 +12,40 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from cache import bumpVersionOnCommit
+from cache import entityStamp
+
 
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
 
+class TooManyRequestsException(endpoints.ForbiddenException):
+    """TooManyRequestsException -- exception mapped to HTTP 403 response;
+    Endpoints v1 turns any status it doesn't know, 429 included, into a
+    503, so rate limited clients are told apart by the message"""
+
+
+class LegacyKeyProperty(ndb.KeyProperty):
+    """LegacyKeyProperty -- KeyProperty that also loads keys stored as
+    urlsafe strings, as they were before the switch to KeyProperty"""
+
+    def _db_get_value(self, v, unused_p):
+        if v.has_stringvalue():
+            return ndb.Key(urlsafe=v.stringvalue())
+        return super(LegacyKeyProperty, self)._db_get_value(v, unused_p)
+
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    sessionKeysToAttend = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = LegacyKeyProperty(kind='Conference',
+                                               repeated=True)
+    sessionKeysToAttend = LegacyKeyProperty(kind='Session', repeated=True)
+    modified = ndb.DateTimeProperty(auto_now=True)
 
 
 class ProfileMiniForm(messages.Message):
@@ -51,7 +72,20 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
-class Conference(ndb.Model):
+class LocallyCachedModel(ndb.Model):
+    """LocallyCachedModel -- model read through cache.cachedGet(); every
+    write bumps the version of its kind and of the entity itself, once
+    the transaction commits, batched per transaction or bumpBatch()"""
+
+    def _post_put_hook(self, future):
+        bumpVersionOnCommit(self.key.kind(), entityStamp(self.key))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        bumpVersionOnCommit(key.kind(), entityStamp(key))
+
+
+class Conference(LocallyCachedModel):
     """Conference -- Conference object"""
     name = ndb.StringProperty(required=True)
     description = ndb.StringProperty()
@@ -63,6 +97,17 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    deleted = ndb.BooleanProperty(default=False)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+
+class Announcement(ndb.Model):
+    """Announcement -- conferences that are nearly sold out; a single
+    entity kept up to date as registrations change"""
+    conferenceKeys = ndb.KeyProperty(kind='Conference', repeated=True)
+    conferenceNames = ndb.StringProperty(repeated=True, indexed=False)
+    # Incremented by every update, so older copies aren't cached over it
+    version = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -89,21 +134,70 @@ class SpeakerForm(messages.Message):
 
 class SpeakerForms(messages.Message):
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
+
+class SpeakerEntryForm(messages.Message):
+    """SpeakerEntryForm -- speaker directory entry outbound form message"""
+    name = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+    sessionCount = messages.IntegerField(3, variant=messages.Variant.INT32)
+    conferenceCount = messages.IntegerField(4, variant=messages.Variant.INT32)
+
+
+class SpeakerDirectoryForm(messages.Message):
+    """SpeakerDirectoryForm -- page of the speaker directory"""
+    items = messages.MessageField(SpeakerEntryForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
 
 
-class Speaker(ndb.Model):
+class Speaker(LocallyCachedModel):
     """Speaker"""
     name = ndb.StringProperty(required=True)
+    # Lowercased name with collapsed whitespace, for prefix search
+    normalizedName = ndb.StringProperty()
+    # Kept up to date as sessions are created and deleted
+    sessionCount = ndb.IntegerProperty(default=0, indexed=False)
+    conferenceKeys = ndb.KeyProperty(kind='Conference', repeated=True,
+                                     indexed=False)
+    conferenceCount = ndb.IntegerProperty(default=0, indexed=False)
     
 class Session(ndb.Model):
     """Session -- Session object"""
     name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
-    speaker = ndb.StringProperty()
+    speaker = LegacyKeyProperty(kind='Speaker')
     duration = ndb.StringProperty()
     typeOfSession = ndb.StringProperty()
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+
+class Tombstone(ndb.Model):
+    """Tombstone -- record of a deleted Conference or Session, reported
+    by getChangesSince until it expires; keyed by the entity's urlsafe
+    key"""
+    kind = ndb.StringProperty(indexed=False)
+    websafeKey = ndb.StringProperty(indexed=False)
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class UniqueValue(ndb.Model):
+    """UniqueValue -- claim on a value of a unique field within the entity
+    group of its parent, e.g. a session name within a conference; keyed
+    by the field and the normalized value"""
+    owner = ndb.KeyProperty(indexed=False)
+
+
+class SessionNeighbours(ndb.Model):
+    """SessionNeighbours -- sessions most often saved to the same
+    wishlists as the parent Session, most often first; rebuilt by the
+    recommend_sessions BatchJob"""
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True,
+                                  indexed=False)
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
 
 
 class SessionForm(messages.Message):
@@ -120,6 +214,91 @@ class SessionForm(messages.Message):
     sessionKey = messages.StringField(10)
 
 
+class BatchJob(ndb.Model):
+    """BatchJob -- background job that scans all Profiles in parallel
+    shards and combines their results"""
+    jobType = ndb.StringProperty()
+    repair = ndb.BooleanProperty(default=False)
+    status = ndb.StringProperty(default='RUNNING')
+    totalShards = ndb.IntegerProperty(default=0)
+    doneShards = ndb.IntegerProperty(default=0)
+    totalReducers = ndb.IntegerProperty(default=1)
+    # First key of each partition after the first, see _batchJobTypes()
+    partitionBounds = ndb.KeyProperty(repeated=True, indexed=False)
+    donePartitions = ndb.IntegerProperty(repeated=True, indexed=False)
+    messages = ndb.StringProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class BatchShard(ndb.Model):
+    """BatchShard -- Profile key range scanned by one chain of tasks;
+    child of the BatchJob, keyed by its position starting at 1"""
+    startKey = ndb.KeyProperty(indexed=False)
+    endKey = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    flushes = ndb.IntegerProperty(repeated=True, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+
+
+class BatchOutput(ndb.Model):
+    """BatchOutput -- part of the output of a BatchShard step that goes
+    to one reducer; child of the BatchJob, keyed by the shard, step,
+    flush and partition. Each step records in BatchShard.flushes how
+    many times it flushed, so parts left by failed attempts are not
+    reduced."""
+    output = ndb.JsonProperty(compressed=True)
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- user waiting for a seat at a sold out conference;
+    keyed by the conference's urlsafe key and the user id, so each user
+    waits at most once per conference"""
+    conference = ndb.KeyProperty(kind='Conference')
+    userId = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ImportJob(ndb.Model):
+    """ImportJob -- progress of a background session program import"""
+    conference = ndb.KeyProperty(kind='Conference')
+    organizerUserId = ndb.StringProperty()
+    status = ndb.StringProperty(default='RUNNING')
+    totalRows = ndb.IntegerProperty(default=0)
+    importedRows = ndb.IntegerProperty(default=0)
+    totalChunks = ndb.IntegerProperty(default=0)
+    doneChunks = ndb.IntegerProperty(default=0)
+    hasSpeakers = ndb.BooleanProperty(default=False)
+    errors = ndb.StringProperty(repeated=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ImportChunk(ndb.Model):
+    """ImportChunk -- rows of an ImportJob written by one task;
+    child of the ImportJob, keyed by its position starting at 1"""
+    rows = ndb.JsonProperty(compressed=True)
+    firstSessionId = ndb.IntegerProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False)
+
+
+class ImportForm(messages.Message):
+    """ImportForm -- session program import inbound form message"""
+    websafeConfKey = messages.StringField(1, required=True)
+    format = messages.StringField(2, default='csv')
+    data = messages.StringField(3, required=True)
+
+
+class ImportJobForm(messages.Message):
+    """ImportJobForm -- ImportJob outbound form message"""
+    websafeKey = messages.StringField(1)
+    status = messages.StringField(2)
+    totalRows = messages.IntegerField(3, variant=messages.Variant.INT32)
+    importedRows = messages.IntegerField(4, variant=messages.Variant.INT32)
+    totalChunks = messages.IntegerField(5, variant=messages.Variant.INT32)
+    doneChunks = messages.IntegerField(6, variant=messages.Variant.INT32)
+    errors = messages.StringField(7, repeated=True)
+
+
 class SessionForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
@@ -142,6 +321,62 @@ class ConferenceForms(messages.Message):
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
 
 
+class GroupRegistrationForm(messages.Message):
+    """GroupRegistrationForm -- emails of the users to register for a
+    conference"""
+    emails = messages.StringField(1, repeated=True)
+
+
+class ConferenceKeysForm(messages.Message):
+    """ConferenceKeysForm -- conferences to register the user for"""
+    websafeConferenceKeys = messages.StringField(1, repeated=True)
+
+
+class TimelineSessionForm(messages.Message):
+    """TimelineSessionForm -- session on a conference timeline"""
+    sessionKey = messages.StringField(1)
+    name = messages.StringField(2)
+    speaker = messages.StringField(3)
+    start = messages.StringField(4)
+    end = messages.StringField(5)
+
+
+class NowAndNextForm(messages.Message):
+    """NowAndNextForm -- sessions running at and starting after a time"""
+    now = messages.StringField(1)
+    running = messages.MessageField(TimelineSessionForm, 2, repeated=True)
+    upcoming = messages.MessageField(TimelineSessionForm, 3, repeated=True)
+
+
+class TombstoneForm(messages.Message):
+    """TombstoneForm -- entity deleted since the last sync"""
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- page of the changes since a sync token"""
+    conferences = messages.MessageField('ConferenceForm', 1, repeated=True)
+    sessions = messages.MessageField('SessionForm', 2, repeated=True)
+    profile = messages.MessageField(ProfileForm, 3)
+    deleted = messages.MessageField(TombstoneForm, 4, repeated=True)
+    nextToken = messages.StringField(5)
+    more = messages.BooleanField(6)
+
+
+class BulkResultForm(messages.Message):
+    """BulkResultForm -- outcome of one item of a bulk request"""
+    index = messages.IntegerField(1, variant=messages.Variant.INT32)
+    success = messages.BooleanField(2)
+    websafeKey = messages.StringField(3)
+    error = messages.StringField(4)
+
+
+class BulkResultForms(messages.Message):
+    """BulkResultForms -- per-item outcomes of a bulk request"""
+    items = messages.MessageField(BulkResultForm, 1, repeated=True)
+
+
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
     NOT_SPECIFIED = 1
@@ -171,3 +406,4 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    fields = messages.StringField(2, repeated=True)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Conference server-side Python App Engine per-client rate limiting of
+expensive endpoints methods
+
+"""
+
+import functools
+import os
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from models import TooManyRequestsException
+from utils import getUserId
+
+# Each client may spend RATE_LIMIT_TOKENS tokens per RATE_LIMIT_WINDOW
+# seconds; methods cost the number of tokens given to rateLimited()
+RATE_LIMIT_TOKENS = 60
+RATE_LIMIT_WINDOW = 60
+
+# Message of the 403 that endpoints methods refuse calls with
+RATE_LIMIT_MESSAGE = 'Rate limit exceeded; try again later'
+
+
+def takeTokens(client_id, cost):
+    """Spend cost tokens of a client's bucket, returning False if it is
+    empty.
+
+    The bucket is kept as memcache counters of the tokens spent per
+    window, updated with atomic incr; the previous window's counter
+    weighs in for the part of it that is still within the last
+    RATE_LIMIT_WINDOW seconds, so the bucket refills gradually instead
+    of all at once. Calls that are refused still spend their tokens.
+    """
+    now = time.time()
+    window = int(now // RATE_LIMIT_WINDOW)
+    key = 'ratelimit:%s:%d' % (client_id, window)
+    spent = memcache.incr(key, cost)
+    if spent is None:
+        if memcache.add(key, cost, time=2 * RATE_LIMIT_WINDOW):
+            spent = cost
+        else:
+            # Added by a concurrent call, or memcache is unavailable;
+            # fail open in the latter case
+            spent = memcache.incr(key, cost) or cost
+    previous = memcache.get('ratelimit:%s:%d' % (client_id, window - 1)) or 0
+    overlap = 1 - (now / RATE_LIMIT_WINDOW - window)
+    return previous * overlap + spent <= RATE_LIMIT_TOKENS
+
+
+def _clientId(service):
+    """Identify the caller by user id, or by address when anonymous."""
+    try:
+        user = endpoints.get_current_user()
+    except Exception:
+        # e.g. when called by a main.py handler, not through the API
+        user = None
+    if user:
+        return 'user:' + getUserId(user)
+    state = getattr(service, 'request_state', None)
+    return 'ip:' + (getattr(state, 'remote_address', None) or
+                    os.environ.get('REMOTE_ADDR', ''))
+
+
+def rateLimited(cost):
+    """Refuse calls of an endpoints method once the caller's bucket is
+    empty, before the method does any work. Endpoints v1 only passes
+    some statuses through, so clients get a 403 with
+    RATE_LIMIT_MESSAGE rather than a 429."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request):
+            if not takeTokens(_clientId(self), cost):
+                raise TooManyRequestsException(RATE_LIMIT_MESSAGE)
+            return func(self, request)
+        return wrapper
+    return decorator
+
+
+def rateLimitedHandler(cost):
+    """Like rateLimited(), for the get or post method of a webapp2
+    handler, which can answer 429 with a Retry-After itself. Callers
+    are identified by address."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args):
+            if not takeTokens('ip:' + (self.request.remote_addr or ''), cost):
+                self.response.set_status(429, 'Too Many Requests')
+                self.response.headers['Retry-After'] = str(RATE_LIMIT_WINDOW)
+                self.response.write('Too many requests; try again later')
+                return
+            return func(self, *args)
+        return wrapper
+    return decorator
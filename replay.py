@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""replay.py
+
+Replay a log of ConferenceApi calls, as captured by capture.py, and
+report per-method throughput, latency percentiles and error rates.
+
+Against a running dev server (calls go to the /_ah/spi backend, as
+the user whose OAuth token is given, if any):
+
+    python replay.py calls.jsonl --target http://localhost:8080
+
+Or directly against the service class on App Engine testbed stubs,
+as the user each call was captured from:
+
+    python replay.py calls.jsonl --direct --sdk $SDK/platform/google_appengine
+
+Add --memory to keep conferences, sessions, speakers and profiles in a
+storage.MemoryStorage instead of the datastore stub. Logs with calls of
+the methods in MEMORY_UNSUPPORTED, which still use ndb directly, are
+refused.
+
+Captured lines are read as they come out of the request logs, so the
+log text before each JSON object is ignored.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib2
+from Queue import Queue
+
+# ConferenceApi methods that read or write the datastore without
+# storage.getStorage(); replayed with --memory they would see only part
+# of the data
+MEMORY_UNSUPPORTED = [
+    'getAllSpeakers', 'getChangesSince', 'getSpeakerDirectory',
+    'importSessions', 'resumeImportJob',
+]
+
+
+def readCalls(path):
+    """Return the calls logged in path, oldest first."""
+    calls = []
+    with open(path) as f:
+        for line in f:
+            start = line.find('{')
+            if start < 0:
+                continue
+            call = json.loads(line[start:])
+            if 'method' in call:
+                calls.append(call)
+    calls.sort(key=lambda call: call.get('ts', 0))
+    return calls
+
+
+class HttpTarget(object):
+    """Sends calls to the endpoints backend of a dev server."""
+
+    def __init__(self, base, token=None):
+        self.base = base.rstrip('/')
+        self.token = token
+
+    def call(self, method, request, user):
+        req = urllib2.Request(
+            '%s/_ah/spi/ConferenceApi.%s' % (self.base, method),
+            json.dumps(request), {'Content-Type': 'application/json'})
+        if self.token:
+            req.add_header('Authorization', 'Bearer ' + self.token)
+        try:
+            urllib2.urlopen(req, timeout=60).read()
+        except urllib2.HTTPError as e:
+            return 'HTTP %d' % e.code
+
+
+class DirectTarget(object):
+    """Calls ConferenceApi in this process, on testbed stubs.
+
+    os.environ is made request-local the way the python27 runtime does
+    it, so concurrent calls each see their own user. Tasks are queued
+    on the taskqueue stub but not run.
+    """
+
+    def __init__(self, sdk, memory=False):
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        from google.appengine.runtime import request_environment
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_user_stub()
+
+        self.environ = dict(os.environ)
+        self.request_environment = request_environment
+        request_environment.PatchOsEnviron()
+
+        if memory:
+            import storage
+            storage.setStorage(storage.MemoryStorage())
+
+        from conference import ConferenceApi
+        from protorpc import protojson
+        self.service = ConferenceApi
+        self.protojson = protojson
+
+    def call(self, method, request, user):
+        environ = dict(self.environ)
+        environ['ENDPOINTS_AUTH_EMAIL'] = user or ''
+        environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+        self.request_environment.current_request.Init(None, environ)
+        try:
+            remote_method = getattr(self.service(), method)
+            message = self.protojson.decode_message(
+                remote_method.remote.request_type, json.dumps(request))
+            remote_method(message)
+        except Exception as e:
+            return type(e).__name__
+        finally:
+            self.request_environment.current_request.Clear()
+
+
+def replay(calls, target, concurrency, speedup):
+    """Play calls against target, keeping their original spacing divided
+    by speedup (or as fast as possible when speedup is 0), and return
+    a list of (method, seconds, error) results and the elapsed time."""
+    pending = Queue(maxsize=concurrency * 2)
+    results = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            call = pending.get()
+            if call is None:
+                return
+            start = time.time()
+            try:
+                error = target.call(call['method'], call.get('request', {}),
+                                    call.get('user'))
+            except Exception as e:
+                error = type(e).__name__
+            with lock:
+                results.append((call['method'], time.time() - start, error))
+
+    workers = [threading.Thread(target=work) for _ in range(concurrency)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    start = time.time()
+    first = calls[0].get('ts', 0) if calls else 0
+    for call in calls:
+        if speedup > 0:
+            delay = (call.get('ts', first) - first) / speedup - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        pending.put(call)
+    for _ in workers:
+        pending.put(None)
+    for worker in workers:
+        worker.join()
+    return results, time.time() - start
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(results, elapsed):
+    """Return per-method, and overall, throughput, latency and errors."""
+    by_method = {}
+    for method, seconds, error in results:
+        by_method.setdefault(method, []).append((seconds, error))
+    by_method['ALL'] = [(seconds, error) for _, seconds, error in results]
+
+    summary = {}
+    for method, timings in by_method.items():
+        latencies = sorted(seconds for seconds, _ in timings)
+        errors = [error for _, error in timings if error]
+        summary[method] = {
+            'calls': len(timings),
+            'throughput': len(timings) / elapsed if elapsed else 0.0,
+            'errorRate': float(len(errors)) / len(timings),
+            'errors': dict((e, errors.count(e)) for e in set(errors)),
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+        }
+    return summary
+
+
+def printSummary(summary):
+    print '%-32s %7s %8s %7s %9s %9s %9s' % (
+        'method', 'calls', 'calls/s', 'err%', 'p50 ms', 'p95 ms', 'p99 ms')
+    for method in sorted(summary, key=lambda m: (m == 'ALL', m)):
+        s = summary[method]
+        print '%-32s %7d %8.1f %7.1f %9.1f %9.1f %9.1f' % (
+            method, s['calls'], s['throughput'], s['errorRate'] * 100,
+            s['p50'], s['p95'], s['p99'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay captured ConferenceApi calls.')
+    parser.add_argument('log', help='JSONL call log written by capture.py')
+    parser.add_argument('--target', default='http://localhost:8080',
+                        help='base URL of the dev server')
+    parser.add_argument('--token', help='OAuth token to call the dev '
+                        'server with')
+    parser.add_argument('--direct', action='store_true',
+                        help='call ConferenceApi in process on stubs')
+    parser.add_argument('--sdk', help='path of the App Engine SDK '
+                        '(google_appengine), for --direct')
+    parser.add_argument('--memory', action='store_true',
+                        help='with --direct, keep entities in memory '
+                        'instead of the datastore stub')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--speedup', type=float, default=1.0,
+                        help='replay speed multiple; 0 replays as fast '
+                        'as possible')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    calls = readCalls(args.log)
+    if args.direct:
+        if not args.sdk:
+            parser.error('--direct needs --sdk')
+        unsupported = sorted(set(call['method'] for call in calls
+                                 if call['method'] in MEMORY_UNSUPPORTED))
+        if args.memory and unsupported:
+            parser.error('--memory does not support %s; replay without '
+                         'it' % ', '.join(unsupported))
+        target = DirectTarget(args.sdk, args.memory)
+    else:
+        target = HttpTarget(args.target, args.token)
+
+    results, elapsed = replay(calls, target, args.concurrency, args.speedup)
+    summary = summarize(results, elapsed)
+    if args.json:
+        print json.dumps(summary, indent=2, sort_keys=True)
+    else:
+        printSummary(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,3 +12,10 @@ WEB_CLIENT_ID = 'replace with Web client ID'
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Log every ConferenceApi call for replay.py (see capture.py)
+CAPTURE_CALLS = False
+
+# Where ConferenceApi keeps its entities: 'ndb', or 'memory' to load test
+# endpoint logic without the datastore (see storage.py)
+STORAGE_BACKEND = 'ndb'
@@ -76,6 +76,241 @@ app.constant('HTTP_ERRORS', {
 });
 
 
+/**
+ * @ngdoc constant
+ * @name CONFERENCE_LIST_FIELDS
+ *
+ * @description
+ * Holds the conference fields shown by the conference lists; list requests ask only for these.
+ *
+ */
+app.constant('CONFERENCE_LIST_FIELDS', [
+    'websafeKey', 'name', 'city', 'startDate', 'organizerDisplayName',
+    'maxAttendees', 'seatsAvailable'
+]);
+
+
+/**
+ * @ngdoc constant
+ * @name CONFERENCE_RENDER_CHUNK
+ *
+ * @description
+ * Holds the number of conferences added to a list per digest, so that long lists render incrementally.
+ *
+ */
+app.constant('CONFERENCE_RENDER_CHUNK', 50);
+
+
+/**
+ * @ngdoc service
+ * @name conferenceApi
+ *
+ * @description
+ * Calls the conference API, caching the responses of read methods in memory and in sessionStorage.
+ * A cached response is reused until it expires or a mutation that invalidates it succeeds, and
+ * identical requests in flight share a single call. Responses are cached for the signed-in user,
+ * and kept across page loads until another user signs in or the user signs out.
+ *
+ */
+app.factory('conferenceApi', function ($window) {
+    var STORAGE_PREFIX = 'conferenceApi:';
+    var USER_KEY = 'conferenceApiUser';
+
+    /**
+     * Seconds a response of each cached method stays fresh.
+     * @type {{}}
+     */
+    var CACHE_TTL = {
+        getProfile: 300,
+        getConference: 60,
+        getConferencesCreated: 60,
+        getConferencesToAttend: 60,
+        queryConferences: 60
+    };
+
+    /**
+     * Cached methods whose responses are dropped when each mutation succeeds.
+     * @type {{}}
+     */
+    var INVALIDATES = {
+        saveProfile: ['getProfile'],
+        createConference: ['getConferencesCreated', 'queryConferences'],
+        registerForConference: ['getProfile', 'getConference', 'getConferencesToAttend',
+            'queryConferences'],
+        unregisterFromConference: ['getProfile', 'getConference', 'getConferencesToAttend',
+            'queryConferences']
+    };
+
+    var conferenceApi = {};
+    var entries = {};
+    var inFlight = {};
+
+    /**
+     * Counts the invalidations, so that a response requested before one isn't cached after it.
+     * @type {number}
+     */
+    var generation = 0;
+
+    var storage = null;
+    try {
+        storage = $window.sessionStorage;
+    } catch (e) {
+        // sessionStorage is disabled; cache in memory only.
+    }
+
+    /**
+     * The user the cached responses are those of, as of the last page if it isn't known yet.
+     * @type {string}
+     */
+    var user = storage ? storage.getItem(USER_KEY) : null;
+
+    var cacheKey = function (method, params) {
+        return method + ':' + (user || '') + ':' + angular.toJson(params || {});
+    };
+
+    var lookup = function (key) {
+        var entry = entries[key];
+        if (!entry && storage) {
+            try {
+                entry = angular.fromJson(storage.getItem(STORAGE_PREFIX + key));
+            } catch (e) {
+                entry = null;
+            }
+            if (entry) {
+                entries[key] = entry;
+            }
+        }
+        if (entry && entry.expires > Date.now()) {
+            return entry.resp;
+        }
+        return null;
+    };
+
+    var store = function (key, method, resp) {
+        var entry = {expires: Date.now() + CACHE_TTL[method] * 1000, resp: resp};
+        entries[key] = entry;
+        if (storage) {
+            try {
+                storage.setItem(STORAGE_PREFIX + key, angular.toJson(entry));
+            } catch (e) {
+                // sessionStorage is full; the entry stays in memory.
+            }
+        }
+    };
+
+    /**
+     * Drops the cached responses of the given methods, or of every method if none are given.
+     *
+     * @param {Array} methods
+     */
+    conferenceApi.invalidate = function (methods) {
+        var matches = function (key) {
+            if (!methods) {
+                return true;
+            }
+            for (var i = 0; i < methods.length; i++) {
+                if (key.indexOf(methods[i] + ':') == 0) {
+                    return true;
+                }
+            }
+            return false;
+        };
+        generation++;
+        angular.forEach(Object.keys(entries), function (key) {
+            if (matches(key)) {
+                delete entries[key];
+            }
+        });
+        if (storage) {
+            for (var i = storage.length - 1; i >= 0; i--) {
+                var key = storage.key(i);
+                if (key && key.indexOf(STORAGE_PREFIX) == 0 && matches(key.substring(STORAGE_PREFIX.length))) {
+                    storage.removeItem(key);
+                }
+            }
+        }
+    };
+
+    /**
+     * Makes the cached responses those of the signed-in user, dropping every cached response if
+     * they are another user's.
+     *
+     * @param {string} email the email of the signed-in user, or null once signed out.
+     */
+    conferenceApi.setUser = function (email) {
+        email = email || null;
+        if (email === user) {
+            return;
+        }
+        conferenceApi.invalidate();
+        user = email;
+        if (storage) {
+            try {
+                if (email) {
+                    storage.setItem(USER_KEY, email);
+                } else {
+                    storage.removeItem(USER_KEY);
+                }
+            } catch (e) {
+                // sessionStorage is full; the user is kept in memory.
+            }
+        }
+    };
+
+    /**
+     * Returns a request for the API method, executed like a gapi.client request.
+     * Callbacks receive their own copy of the response, and are always called asynchronously.
+     *
+     * @param {string} method
+     * @param {{}} params
+     * @returns {{execute: Function}}
+     */
+    conferenceApi.request = function (method, params) {
+        return {
+            execute: function (callback) {
+                var cached = CACHE_TTL[method];
+                var key = cacheKey(method, params);
+                if (cached) {
+                    var resp = lookup(key);
+                    if (resp) {
+                        $window.setTimeout(function () {
+                            callback(angular.copy(resp));
+                        }, 0);
+                        return;
+                    }
+                    if (inFlight[key]) {
+                        inFlight[key].push(callback);
+                        return;
+                    }
+                    inFlight[key] = [callback];
+                }
+                var requested = generation;
+                gapi.client.conference[method](params).execute(function (resp) {
+                    var callbacks = [callback];
+                    if (cached) {
+                        callbacks = inFlight[key];
+                        delete inFlight[key];
+                    }
+                    if (!resp.error) {
+                        if (cached && requested == generation) {
+                            store(key, method, resp);
+                        }
+                        if (INVALIDATES[method]) {
+                            conferenceApi.invalidate(INVALIDATES[method]);
+                        }
+                    }
+                    angular.forEach(callbacks, function (cb) {
+                        cb(angular.copy(resp));
+                    });
+                });
+            }
+        };
+    };
+
+    return conferenceApi;
+});
+
+
 /**
  * @ngdoc service
  * @name oauth2Provider
@@ -84,7 +319,7 @@ app.constant('HTTP_ERRORS', {
  * Service that holds the OAuth2 information shared across all the pages.
  *
  */
-app.factory('oauth2Provider', function ($modal) {
+app.factory('oauth2Provider', function ($modal, conferenceApi) {
     var oauth2Provider = {
         CLIENT_ID: '644749591407-bivfp2gjq1mmliajlcf17qj4kubsdr1o.apps.googleusercontent.com',
         SCOPES: 'email profile',
@@ -113,6 +348,7 @@ app.factory('oauth2Provider', function ($modal) {
         // Explicitly set the invalid access token in order to make the API calls fail.
         gapi.auth.setToken({access_token: ''})
         oauth2Provider.signedIn = false;
+        conferenceApi.setUser(null);
     };
 
     /**
@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, conferenceApi, HTTP_ERRORS) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -63,7 +63,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
             var retrieveProfileCallback = function () {
                 $scope.profile = {};
                 $scope.loading = true;
-                gapi.client.conference.getProfile().
+                conferenceApi.request('getProfile').
                     execute(function (resp) {
                         $scope.$apply(function () {
                             $scope.loading = false;
@@ -94,7 +94,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
         $scope.saveProfile = function () {
             $scope.submitted = true;
             $scope.loading = true;
-            gapi.client.conference.saveProfile($scope.profile).
+            conferenceApi.request('saveProfile', $scope.profile).
                 execute(function (resp) {
                     $scope.$apply(function () {
                         $scope.loading = false;
@@ -135,7 +135,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
  * A controller used for the Create conferences page.
  */
 conferenceApp.controllers.controller('CreateConferenceCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, conferenceApi, HTTP_ERRORS) {
 
         /**
          * The conference object being edited in the page.
@@ -214,7 +214,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
             }
 
             $scope.loading = true;
-            gapi.client.conference.createConference($scope.conference).
+            conferenceApi.request('createConference', $scope.conference).
                 execute(function (resp) {
                     $scope.$apply(function () {
                         $scope.loading = false;
@@ -249,7 +249,10 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $timeout, oauth2Provider,
+                                                                    conferenceApi, HTTP_ERRORS,
+                                                                    CONFERENCE_LIST_FIELDS,
+                                                                    CONFERENCE_RENDER_CHUNK) {
 
     /**
      * Holds the status if the query is being executed.
@@ -293,6 +296,38 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Counts the lists shown, so that the rendering of a list stops once another one is shown.
+     * @type {number}
+     */
+    var renderedList = 0;
+
+    /**
+     * Shows the conferences, adding CONFERENCE_RENDER_CHUNK of them per digest so that a long
+     * list doesn't block the page while it renders.
+     *
+     * @param {Array} items
+     */
+    $scope.showConferences = function (items) {
+        var list = ++renderedList;
+        items = items || [];
+        $scope.conferences = items.slice(0, CONFERENCE_RENDER_CHUNK);
+        var renderFrom = function (start) {
+            if (start >= items.length) {
+                return;
+            }
+            $timeout(function () {
+                if (list != renderedList) {
+                    return;
+                }
+                Array.prototype.push.apply($scope.conferences,
+                    items.slice(start, start + CONFERENCE_RENDER_CHUNK));
+                renderFrom(start + CONFERENCE_RENDER_CHUNK);
+            });
+        };
+        renderFrom(CONFERENCE_RENDER_CHUNK);
+    };
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -428,7 +463,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            fields: CONFERENCE_LIST_FIELDS
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -441,7 +477,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             }
         }
         $scope.loading = true;
-        gapi.client.conference.queryConferences(sendFilters).
+        conferenceApi.request('queryConferences', sendFilters).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -458,10 +494,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
+                        $scope.showConferences(resp.items);
                     }
                     $scope.submitted = true;
                 });
@@ -473,7 +506,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        conferenceApi.request('getConferencesCreated').
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -495,10 +528,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
+                        $scope.showConferences(resp.items);
                     }
                     $scope.submitted = true;
                 });
@@ -511,7 +541,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        conferenceApi.request('getConferencesToAttend', {fields: CONFERENCE_LIST_FIELDS}).
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
@@ -527,7 +557,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        $scope.showConferences(resp.result.items);
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
@@ -547,7 +577,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, conferenceApi,
+                                                                      HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
@@ -559,7 +590,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        conferenceApi.request('getConference', {
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -581,7 +612,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
         $scope.loading = true;
         // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
+        conferenceApi.request('getProfile').execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
@@ -607,7 +638,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
      */
     $scope.registerForConference = function () {
         $scope.loading = true;
-        gapi.client.conference.registerForConference({
+        conferenceApi.request('registerForConference', {
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -644,7 +675,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
      */
     $scope.unregisterFromConference = function () {
         $scope.loading = true;
-        gapi.client.conference.unregisterFromConference({
+        conferenceApi.request('unregisterFromConference', {
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -691,7 +722,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
  * such as user authentications.
  *
  */
-conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider) {
+conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider, conferenceApi) {
 
     /**
      * Returns if the viewLocation is the currently viewed page.
@@ -718,6 +749,8 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
     $scope.signIn = function () {
         oauth2Provider.signIn(function () {
             gapi.client.oauth2.userinfo.get().execute(function (resp) {
+                // Responses cached for another user must not be shown.
+                conferenceApi.setUser(resp.email);
                 $scope.$apply(function () {
                     if (resp.email) {
                         oauth2Provider.signedIn = true;
@@ -742,6 +775,11 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
                     $scope.$apply(function () {
                         oauth2Provider.signedIn = true;
                     });
+                    // Responses cached for another user must not be shown; those of the same
+                    // user are kept across page loads.
+                    gapi.client.oauth2.userinfo.get().execute(function (resp) {
+                        conferenceApi.setUser(resp.email);
+                    });
                 }
             },
             'clientid': oauth2Provider.CLIENT_ID,
@@ -778,10 +816,12 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
  *
  */
 conferenceApp.controllers.controller('OAuth2LoginModalCtrl',
-    function ($scope, $modalInstance, $rootScope, oauth2Provider) {
+    function ($scope, $modalInstance, $rootScope, oauth2Provider, conferenceApi) {
         $scope.singInViaModal = function () {
             oauth2Provider.signIn(function () {
                 gapi.client.oauth2.userinfo.get().execute(function (resp) {
+                    // Responses cached for another user must not be shown.
+                    conferenceApi.setUser(resp.email);
                     $scope.$root.$apply(function () {
                         oauth2Provider.signedIn = true;
                         $scope.$root.alertStatus = 'success';
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""storage.py
+
+Conference server-side Python App Engine storage backends
+
+ConferenceApi reads and writes Conferences, Sessions, Speakers and
+Profiles through getStorage(): an NdbStorage on the Datastore, or a
+MemoryStorage, which keeps the entities in instance memory and answers
+the same queries, for load testing and profiling endpoint logic without
+the datastore stub. Pick one with STORAGE_BACKEND in settings.py, or
+call setStorage() before the first request.
+
+"""
+
+import logging
+import operator
+import threading
+from datetime import date
+from datetime import datetime
+from datetime import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from cache import bumpBatch
+from cache import cachedGetMulti
+from models import LocallyCachedModel
+from settings import STORAGE_BACKEND
+
+
+class Storage(object):
+    """Storage -- interface of the storage backends.
+
+    Entities are ndb model instances with either backend. Queries take
+    filters as (property, operator, value) tuples, the operators being
+    =, !=, <, <=, >, >= and IN, and orders as property names, prefixed
+    with - for descending; results are sorted by key last.
+    """
+
+    def getMulti(self, keys):
+        """Return the entity of each key, or None if there is none."""
+        raise NotImplementedError
+
+    def getMultiAsync(self, keys):
+        """Return a Future for the entity of each key."""
+        raise NotImplementedError
+
+    def get(self, key):
+        return self.getMulti([key])[0]
+
+    def putMulti(self, entities):
+        """Store entities, completing their keys, and return the keys."""
+        raise NotImplementedError
+
+    def put(self, entity):
+        return self.putMulti([entity])[0]
+
+    def deleteMulti(self, keys):
+        raise NotImplementedError
+
+    def allocateIds(self, model, size, parent=None):
+        """Return the first and last of `size` new ids for model."""
+        raise NotImplementedError
+
+    def query(self, model, ancestor=None, filters=(), orders=(), limit=None,
+              keysOnly=False, projection=None):
+        """Return the entities of model, or their keys, that descend
+        from ancestor and match every filter. Entities may be returned
+        whole even if a projection is asked for."""
+        raise NotImplementedError
+
+    def first(self, model, ancestor=None, filters=(), orders=(),
+              keysOnly=False):
+        """Return the first result of query(), or None."""
+        results = self.query(model, ancestor, filters, orders, limit=1,
+                             keysOnly=keysOnly)
+        return results[0] if results else None
+
+    def transaction(self, func, xg=False):
+        """Run func in a transaction and return its result."""
+        raise NotImplementedError
+
+
+class NdbStorage(Storage):
+    """NdbStorage -- the Datastore, through ndb. Outside transactions,
+    LocallyCachedModel kinds are read through cache.cachedGetMulti()."""
+
+    def getMulti(self, keys):
+        found = {}
+        if not ndb.in_transaction():
+            cached = [key for key in keys if issubclass(
+                ndb.Model._lookup_model(key.kind()), LocallyCachedModel)]
+            if cached:
+                found.update(zip(cached, cachedGetMulti(cached)))
+        others = [key for key in keys if key not in found]
+        found.update(zip(others, ndb.get_multi(others)))
+        return [found[key] for key in keys]
+
+    def getMultiAsync(self, keys):
+        return ndb.get_multi_async(keys)
+
+    def putMulti(self, entities):
+        with bumpBatch():
+            return ndb.put_multi(entities)
+
+    def deleteMulti(self, keys):
+        with bumpBatch():
+            ndb.delete_multi(keys)
+
+    def allocateIds(self, model, size, parent=None):
+        return model.allocate_ids(size=size, parent=parent)
+
+    def query(self, model, ancestor=None, filters=(), orders=(), limit=None,
+              keysOnly=False, projection=None):
+        q = model.query(ancestor=ancestor)
+        for name, op, value in filters:
+            q = q.filter(self._filter(model, name, op, value))
+        for name in orders:
+            prop = ndb.GenericProperty(name.lstrip('-'))
+            q = q.order(-prop if name.startswith('-') else prop)
+
+        if keysOnly:
+            return q.fetch(limit, keys_only=True)
+        if projection:
+            try:
+                return q.fetch(limit, projection=projection)
+            except datastore_errors.NeedIndexError:
+                logging.warning('No index to project %s; fetching whole '
+                                'entities', ', '.join(projection))
+        return q.fetch(limit)
+
+    @staticmethod
+    def _filter(model, name, op, value):
+        """Return the ndb filter for a (property, operator, value)."""
+        if op == 'IN':
+            if not value:
+                return ndb.query.FalseNode()
+            return ndb.OR(*[NdbStorage._filter(model, name, '=', v)
+                            for v in value])
+        prop = model._properties.get(name)
+        if prop is not None:
+            try:
+                return prop._comparison(op, value)
+            except datastore_errors.BadValueError:
+                pass
+        # Values the property doesn't accept are matched as they are,
+        # e.g. keys still stored as urlsafe strings
+        return ndb.query.FilterNode(name, op, value)
+
+    def transaction(self, func, xg=False):
+        return ndb.transaction(func, xg=xg)
+
+
+# Comparisons of the query operators
+_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _indexValue(value):
+    """Return value as a tuple that sorts the way the Datastore orders
+    values: null, then integers and dates, booleans, strings, floats and
+    keys."""
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (2, value)
+    if isinstance(value, (int, long)):
+        return (1, value)
+    if isinstance(value, (date, time)):
+        # Dates and times are stored as datetimes
+        if isinstance(value, time):
+            value = datetime.combine(_EPOCH.date(), value)
+        elif not isinstance(value, datetime):
+            value = datetime.combine(value, time())
+        delta = value - _EPOCH
+        return (1, (delta.days * 86400 + delta.seconds) * 1000000 +
+                delta.microseconds)
+    if isinstance(value, basestring):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        return (3, value)
+    if isinstance(value, float):
+        return (4, value)
+    if isinstance(value, ndb.Key):
+        return (6, value.pairs())
+    return (5, value)
+
+
+class MemoryStorage(Storage):
+    """MemoryStorage -- entities kept in instance memory, for load tests.
+
+    Entities are held as protocol buffers, like the Datastore stores
+    them, and a query scans its kind. Values compare the way the
+    Datastore indexes them: repeated properties match on any of their
+    values and sort on their lowest (highest when descending) one,
+    entities with no value for an order are left out, and values of
+    different types sort by type. Unindexed properties match nothing.
+
+    Transactions only hold a lock for the duration; they are not rolled
+    back when they fail, and puts skip the model hooks.
+    """
+
+    def __init__(self):
+        self._kinds = {}
+        self._lastId = 0
+        self._lock = threading.RLock()
+        self._adapter = ndb.ModelAdapter()
+
+    def getMulti(self, keys):
+        with self._lock:
+            records = [self._kinds.get(key.kind(), {}).get(key)
+                       for key in keys]
+        return [self._adapter.pb_to_entity(record[0]) if record else None
+                for record in records]
+
+    def getMultiAsync(self, keys):
+        futures = []
+        for entity in self.getMulti(keys):
+            future = ndb.Future()
+            future.set_result(entity)
+            futures.append(future)
+        return futures
+
+    def putMulti(self, entities):
+        with self._lock:
+            for entity in entities:
+                key = entity.key
+                if key is None or key.id() is None:
+                    entity.key = ndb.Key(
+                        entity._get_kind(), self.allocateIds(type(entity), 1)[0],
+                        parent=key.parent() if key else None)
+                entity._prepare_for_put()
+                pb = self._adapter.entity_to_pb(entity)
+                self._kinds.setdefault(entity.key.kind(), {})[entity.key] = (
+                    pb, self._adapter.pb_to_entity(pb))
+        return [entity.key for entity in entities]
+
+    def deleteMulti(self, keys):
+        with self._lock:
+            for key in keys:
+                self._kinds.get(key.kind(), {}).pop(key, None)
+
+    def allocateIds(self, model, size, parent=None):
+        with self._lock:
+            first = self._lastId + 1
+            self._lastId += size
+        return first, self._lastId
+
+    def query(self, model, ancestor=None, filters=(), orders=(), limit=None,
+              keysOnly=False, projection=None):
+        with self._lock:
+            records = self._kinds.get(model._get_kind(), {}).values()
+        results = [(pb, entity) for pb, entity in records
+                   if (ancestor is None or
+                       self._descends(entity.key, ancestor)) and
+                   all(self._matches(entity, name, op, value)
+                       for name, op, value in filters)]
+
+        # Sort by key, then by each order from the last one
+        results.sort(key=lambda record: _indexValue(record[1].key))
+        for name in reversed(orders):
+            reverse = name.startswith('-')
+            pick = max if reverse else min
+            values = [(self._indexValues(record[1], name.lstrip('-')), record)
+                      for record in results]
+            results = [record for _, record in sorted(
+                [(pick(value), record) for value, record in values if value],
+                key=lambda pair: pair[0], reverse=reverse)]
+
+        results = results[:limit] if limit is not None else results
+        if keysOnly:
+            return [entity.key for _, entity in results]
+        return [self._adapter.pb_to_entity(pb) for pb, _ in results]
+
+    @staticmethod
+    def _descends(key, ancestor):
+        while key is not None:
+            if key == ancestor:
+                return True
+            key = key.parent()
+        return False
+
+    @staticmethod
+    def _indexValues(entity, name):
+        """Return the indexed values of a property as _indexValue()s."""
+        prop = entity._properties.get(name)
+        if prop is None or not prop._indexed:
+            return []
+        value = prop._get_value(entity)
+        values = value if prop._repeated else [value]
+        return [_indexValue(v) for v in values]
+
+    def _matches(self, entity, name, op, value):
+        values = self._indexValues(entity, name)
+        if op == 'IN':
+            wanted = set(_indexValue(v) for v in value)
+            return any(v in wanted for v in values)
+        target = _indexValue(value)
+        return any(_OPERATORS[op](v, target) for v in values)
+
+    def transaction(self, func, xg=False):
+        with self._lock:
+            return func()
+
+
+_storage = None
+
+
+def getStorage():
+    """Return the storage backend of this instance."""
+    global _storage
+    if _storage is None:
+        setStorage(MemoryStorage() if STORAGE_BACKEND == 'memory'
+                   else NdbStorage())
+    return _storage
+
+
+def setStorage(storage):
+    """Make storage the backend of this instance."""
+    global _storage
+    _storage = storage
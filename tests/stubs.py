@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""stubs.py
+
+Test case base that runs ConferenceApi and the main.py handlers on App
+Engine testbed stubs. The SDK is found through APPENGINE_SDK, see
+test_mail.py.
+
+"""
+
+import os
+import sys
+import unittest
+import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path.insert(0, ROOT)
+
+import webapp2
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import cache
+import main
+import storage
+
+
+class StubTestCase(unittest.TestCase):
+    """Activates the stubs, with a strongly consistent datastore, and
+    resets the per-instance caches and the storage backend. Test cases
+    that set requireIndexes fail queries index.yaml has no index for."""
+
+    requireIndexes = False
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1),
+            require_indexes=self.requireIndexes,
+            root_path=ROOT if self.requireIndexes else None)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+        cache._entities.clear()
+        cache._values.clear()
+        cache._versions.clear()
+        storage.setStorage(storage.NdbStorage())
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def login(self, email):
+        """Make endpoints.get_current_user() return the user of email."""
+        self.testbed.setup_env(endpoints_auth_email=email,
+                               endpoints_auth_domain='gmail.com',
+                               overwrite=True)
+
+    def request(self, path, **kwargs):
+        """Send a request to the main.py application."""
+        return webapp2.Request.blank(path, **kwargs).get_response(main.app)
+
+    def tasks(self, url=None, queue_names=None):
+        """Return the queued tasks, optionally only those of url."""
+        return self.taskqueue_stub.get_filtered_tasks(
+            url=url, queue_names=queue_names)
+
+    @staticmethod
+    def taskParams(task):
+        """Return the form parameters of a push task, as lists."""
+        return urlparse.parse_qs(task.payload)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""test_announcement.py
+
+Tests of the nearly sold out announcement as registrations change it,
+including updates that finish out of order.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+from conference import ANNOUNCEMENT_KEY
+from conference import CONF_GET_REQUEST
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+
+ORGANIZER = 'organizer@example.com'
+
+
+class AnnouncementTest(StubTestCase):
+
+    def setUp(self):
+        super(AnnouncementTest, self).setUp()
+        self.c_key = Conference(parent=ndb.Key(Profile, ORGANIZER),
+                                name='Conf', organizerUserId=ORGANIZER,
+                                maxAttendees=10, seatsAvailable=6).put()
+
+    def announcement(self):
+        return ConferenceApi().getAnnouncement(
+            message_types.VoidMessage()).data
+
+    def setSeats(self, seats):
+        conf = self.c_key.get()
+        conf.seatsAvailable = seats
+        conf.put()
+
+    def runUpdates(self):
+        for task in self.tasks(url='/tasks/update_announcement'):
+            response = self.request(
+                task.url, method='POST', body=task.payload,
+                content_type='application/x-www-form-urlencoded')
+            self.assertEqual(200, response.status_int)
+
+    def testRegistrationCrossingTheThresholdAnnounces(self):
+        self.assertEqual('', self.announcement())
+        self.login('user@example.com')
+        ConferenceApi().registerForConference(
+            CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=self.c_key.urlsafe()))
+        self.runUpdates()
+        self.assertIn('Conf', self.announcement())
+
+    def testOlderAnnouncementIsNotCachedOverANewerOne(self):
+        self.setSeats(3)
+        ConferenceApi._updateAnnouncement([self.c_key])
+        older = ANNOUNCEMENT_KEY.get()
+        self.setSeats(0)
+        ConferenceApi._updateAnnouncement([self.c_key])
+        self.assertEqual('', self.announcement())
+
+        # A task that read the announcement before the last update
+        # finishes after it
+        ConferenceApi._cacheAnnouncement(older)
+        self.assertEqual('', self.announcement())
+
+    def testLostAnnouncementIsRecomputed(self):
+        self.setSeats(3)
+        ConferenceApi._updateAnnouncement([self.c_key])
+        memcache.flush_all()
+        self.assertIn('Conf', self.announcement())
+
+
+if __name__ == '__main__':
+    unittest.main()
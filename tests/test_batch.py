@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""test_batch.py
+
+Tests of the BatchJob shards and reducers.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.ext import ndb
+
+import conference
+from conference import ConferenceApi
+from models import BatchJob
+from models import BatchShard
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionNeighbours
+
+ORGANIZER = 'organizer@example.com'
+
+
+class BatchTest(StubTestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        c_key = Conference(parent=ndb.Key(Profile, ORGANIZER),
+                           name='Conf').put()
+        self.s_keys = sorted(ndb.put_multi([
+            Session(parent=c_key, name=name)
+            for name in ('Keynote', 'Lunch', 'Closing')]))
+
+    def neighbours(self, s_key):
+        return ndb.Key(SessionNeighbours, 1, parent=s_key)
+
+    def testShardFlushesWithinAPage(self):
+        ndb.put_multi([Profile(key=ndb.Key(Profile, 'user%d' % i),
+                               sessionKeysToAttend=self.s_keys[:2])
+                       for i in range(3)])
+        flush_entries = conference.BATCH_FLUSH_ENTRIES
+        conference.BATCH_FLUSH_ENTRIES = 2
+        try:
+            job = ConferenceApi._startBatchJob('recommend_sessions')
+            for task in self.tasks(url='/tasks/batch_shard'):
+                ConferenceApi._runBatchShard(
+                    self.taskParams(task)['shardKey'][0], 0)
+        finally:
+            conference.BATCH_FLUSH_ENTRIES = flush_entries
+        # Each Profile adds a pair under both of its sessions, so every
+        # one of them fills a flush, although they are read in one page
+        shards = ndb.get_multi([ndb.Key(BatchShard, n, parent=job.key)
+                                for n in range(1, job.totalShards + 1)])
+        self.assertEqual(3, sum(sum(shard.flushes) for shard in shards))
+
+    def testReducerRemovesOnlyStaleNeighboursInItsRange(self):
+        first, middle, last = self.s_keys
+        ndb.put_multi([SessionNeighbours(key=self.neighbours(s_key),
+                                         sessionKeys=[middle], counts=[1])
+                       for s_key in (first, last)])
+        job = BatchJob(jobType='recommend_sessions', partitionBounds=[middle],
+                       totalReducers=2)
+
+        ConferenceApi._reduceCoSaves(job, 0, [])
+        self.assertEqual(None, self.neighbours(first).get())
+        self.assertTrue(self.neighbours(last).get())
+
+        output = {last.urlsafe(): {first.urlsafe(): 2}}
+        ConferenceApi._reduceCoSaves(job, 1, [output])
+        self.assertEqual([first], self.neighbours(last).get().sessionKeys)
+
+    def testOutputKeysFallInTheirPartition(self):
+        first, middle, last = self.s_keys
+        bounds = [middle]
+        self.assertEqual([0, 1, 1], [
+            ConferenceApi._batchPartition(s_key.urlsafe(), bounds)
+            for s_key in (first, middle, last)])
+        self.assertEqual(0, ConferenceApi._batchPartition(last.urlsafe(), []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""test_cache.py
+
+Tests of the instance caches and the version stamps that invalidate
+them.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import cache
+from models import Conference
+from storage import getStorage
+
+
+class CountingOffsetMulti(object):
+    """Stands in for memcache.offset_multi, recording each call."""
+
+    def __init__(self):
+        self.calls = []
+        self.offset_multi = memcache.offset_multi
+
+    def __call__(self, mapping, *args, **kwargs):
+        self.calls.append(sorted(mapping))
+        return self.offset_multi(mapping, *args, **kwargs)
+
+
+class VersionTest(StubTestCase):
+
+    def setUp(self):
+        super(VersionTest, self).setUp()
+        self.offsets = CountingOffsetMulti()
+        memcache.offset_multi = self.offsets
+
+    def tearDown(self):
+        memcache.offset_multi = self.offsets.offset_multi
+        super(VersionTest, self).tearDown()
+
+    def conferences(self, n):
+        return [Conference(name='Conf %d' % i) for i in range(n)]
+
+    def testPutMultiBumpsOnce(self):
+        getStorage().putMulti(self.conferences(5))
+        self.assertEqual(1, len(self.offsets.calls))
+        # The kind and each of the five entities
+        self.assertEqual(6, len(self.offsets.calls[0]))
+
+    def testTransactionBumpsOnceOnCommit(self):
+        @ndb.transactional(xg=True)
+        def put():
+            for conf in self.conferences(3):
+                conf.put()
+            self.assertEqual([], self.offsets.calls)
+        put()
+        self.assertEqual(1, len(self.offsets.calls))
+
+    def testCachedEntityIsReplacedAfterAWrite(self):
+        c_key = Conference(name='Before').put()
+        self.assertEqual('Before', cache.cachedGetMulti([c_key])[0].name)
+        conf = c_key.get()
+        conf.name = 'After'
+        getStorage().put(conf)
+        self.assertEqual('After', cache.cachedGetMulti([c_key])[0].name)
+
+    def testOnlyStaleStampsAreReread(self):
+        cache.kindVersions(['A', 'B'])
+        version, _ = cache._versions['A']
+        cache._versions['A'] = (version, 0)
+        reads = []
+        versionStamps = cache.versionStamps
+        cache.versionStamps = lambda names: reads.append(
+            sorted(names)) or versionStamps(names)
+        try:
+            cache.kindVersions(['A', 'B'])
+        finally:
+            cache.versionStamps = versionStamps
+        self.assertEqual([['A']], reads)
+
+    def testHeldStampsAreBounded(self):
+        size = cache.VERSION_CACHE_SIZE
+        cache.VERSION_CACHE_SIZE = 10
+        try:
+            cache.kindVersions(['stamp:%d' % i for i in range(25)])
+            cache.bumpVersion(*['other:%d' % i for i in range(25)])
+        finally:
+            cache.VERSION_CACHE_SIZE = size
+        self.assertEqual(10, len(cache._versions))
+
+
+if __name__ == '__main__':
+    unittest.main()
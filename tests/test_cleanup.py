@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""test_cleanup.py
+
+Tests of the delete_conference cleanup task, in particular of retried
+batches.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionNeighbours
+from models import Speaker
+from models import Tombstone
+from models import WaitlistEntry
+
+ORGANIZER = 'organizer@example.com'
+
+
+class CleanupTest(StubTestCase):
+
+    def setUp(self):
+        super(CleanupTest, self).setUp()
+        self.c_key = Conference(
+            parent=ndb.Key(Profile, ORGANIZER), name='Conf',
+            organizerUserId=ORGANIZER, maxAttendees=10, seatsAvailable=10,
+            deleted=True).put()
+        self.wsck = self.c_key.urlsafe()
+        self.speaker = Speaker(name='Ada Lovelace', sessionCount=2,
+                               conferenceKeys=[self.c_key],
+                               conferenceCount=1)
+        self.speaker.put()
+        self.sessions = [Session(parent=self.c_key, name=name,
+                                 speaker=self.speaker.key)
+                         for name in ('Keynote', 'Closing')]
+        ndb.put_multi(self.sessions)
+        SessionNeighbours(key=ndb.Key(SessionNeighbours, 1,
+                                      parent=self.sessions[0].key),
+                          sessionKeys=[self.sessions[1].key],
+                          counts=[1]).put()
+        WaitlistEntry(key=ConferenceApi()._waitlistEntryKey(self.c_key, 'u'),
+                      conference=self.c_key, userId='u').put()
+
+    def runSessionsPhase(self):
+        ConferenceApi._cleanupConference(self.wsck, 'sessions')
+
+    def testSessionsPhaseRemovesSessionData(self):
+        self.runSessionsPhase()
+        self.runSessionsPhase()
+        self.assertEqual(0, Session.query(ancestor=self.c_key).count())
+        self.assertEqual(0, SessionNeighbours.query().count())
+        self.assertEqual(0, WaitlistEntry.query().count())
+
+    def testRetriedBatchKeepsSpeakerCountsAndTombstones(self):
+        # A retry of the batch finds the sessions already deleted and
+        # must neither add tombstones nor take them off twice
+        self.runSessionsPhase()
+        ndb.put_multi(self.sessions)
+        self.runSessionsPhase()
+
+        self.assertEqual(len(self.sessions), Tombstone.query().count())
+        recounts = self.tasks(url='/tasks/recount_speakers')
+        self.assertTrue(recounts)
+        ConferenceApi._recountSpeakers([self.speaker.key])
+        speaker = self.speaker.key.get()
+        self.assertEqual(0, speaker.sessionCount)
+        self.assertEqual([], speaker.conferenceKeys)
+
+
+if __name__ == '__main__':
+    unittest.main()
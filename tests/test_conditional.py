@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""test_conditional.py
+
+Tests of the conditional read handlers: ETags, 304 responses and the
+writes that must change the ETag.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import ProfileMiniForm
+
+ORGANIZER = 'organizer@example.com'
+
+
+class ConferenceReadTest(StubTestCase):
+
+    def setUp(self):
+        super(ConferenceReadTest, self).setUp()
+        p_key = Profile(key=ndb.Key(Profile, ORGANIZER), displayName='Old',
+                        mainEmail=ORGANIZER).put()
+        self.c_key = Conference(parent=p_key, name='Conf',
+                                organizerUserId=ORGANIZER, maxAttendees=10,
+                                seatsAvailable=10).put()
+        self.path = '/read/conference/%s' % self.c_key.urlsafe()
+
+    def read(self, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.request(self.path, headers=headers)
+
+    def testUnchangedConferenceIsNotModified(self):
+        response = self.read()
+        self.assertEqual(200, response.status_int)
+        etag = response.headers['ETag']
+        self.assertEqual(304, self.read(etag).status_int)
+
+    def testConferenceWriteChangesTheETag(self):
+        etag = self.read().headers['ETag']
+        conf = self.c_key.get()
+        conf.city = 'Paris'
+        conf.put()
+        response = self.read(etag)
+        self.assertEqual(200, response.status_int)
+        self.assertIn('Paris', response.body)
+
+    def testOrganizerNameChangeChangesTheETag(self):
+        etag = self.read().headers['ETag']
+        self.login(ORGANIZER)
+        ConferenceApi().saveProfile(ProfileMiniForm(displayName='New'))
+        response = self.read(etag)
+        self.assertEqual(200, response.status_int)
+        self.assertIn('New', response.body)
+
+    def testNoETagWithoutStamps(self):
+        get_multi, add = memcache.get_multi, memcache.add
+        memcache.get_multi = lambda keys, *args, **kwargs: {}
+        memcache.add = lambda *args, **kwargs: False
+        try:
+            response = self.read()
+        finally:
+            memcache.get_multi, memcache.add = get_multi, add
+        self.assertEqual(200, response.status_int)
+        self.assertNotIn('ETag', response.headers)
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""test_import.py
+
+Tests of session program imports, in particular of retried import
+chunks.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import ImportChunk
+from models import ImportJob
+from models import Profile
+from models import Session
+from models import Speaker
+
+ORGANIZER = 'organizer@example.com'
+ROWS = [
+    {'name': 'Keynote', 'speaker': 'Ada Lovelace', 'date': '2026-05-01',
+     'startTime': '09:00', 'duration': '01:00'},
+    {'name': 'Closing', 'speaker': 'Alan Turing', 'date': '2026-05-01',
+     'startTime': '17:00', 'duration': '00:30'},
+]
+
+
+class ImportChunkTest(StubTestCase):
+
+    def setUp(self):
+        super(ImportChunkTest, self).setUp()
+        self.c_key = Conference(
+            parent=ndb.Key(Profile, ORGANIZER), name='Conf',
+            organizerUserId=ORGANIZER, maxAttendees=10,
+            seatsAvailable=10).put()
+        first, _ = Session.allocate_ids(size=len(ROWS), parent=self.c_key)
+        self.job = ImportJob(conference=self.c_key, organizerUserId=ORGANIZER,
+                             totalRows=len(ROWS), totalChunks=1,
+                             hasSpeakers=True)
+        self.job.put()
+        self.chunk = ImportChunk(key=ndb.Key(ImportChunk, 1,
+                                             parent=self.job.key),
+                                 rows=ROWS, firstSessionId=first)
+        self.chunk.put()
+
+    def runChunk(self):
+        ConferenceApi._importChunk(self.job.key.urlsafe(), 1)
+        return self.job.key.get()
+
+    def recountedSpeakers(self):
+        return [set(self.taskParams(task)['speakerKey'])
+                for task in self.tasks(url='/tasks/recount_speakers')]
+
+    def testChunkImportsEverySession(self):
+        job = self.runChunk()
+        self.assertEqual('DONE', job.status)
+        self.assertEqual(len(ROWS), job.importedRows)
+        self.assertEqual([], job.errors)
+        self.assertEqual(len(ROWS), Session.query(ancestor=self.c_key).count())
+
+    def testRetriedChunkKeepsItsOwnSessions(self):
+        # The first attempt writes the sessions, then fails before the
+        # chunk is marked done; the retry must not reject its own names
+        self.runChunk()
+        self.job.put()
+        self.chunk.put()
+
+        job = self.runChunk()
+        self.assertEqual('DONE', job.status)
+        self.assertEqual(len(ROWS), job.importedRows)
+        self.assertEqual([], job.errors)
+        self.assertEqual(len(ROWS), Session.query(ancestor=self.c_key).count())
+        speakers = set(s.key.urlsafe() for s in Speaker.query())
+        self.assertEqual(2, len(speakers))
+        self.assertEqual(speakers, self.recountedSpeakers()[-1])
+
+    def testChunkReportsNamesTakenSinceTheJobStarted(self):
+        Session(parent=self.c_key, name='Keynote').put()
+
+        job = self.runChunk()
+        self.assertEqual(len(ROWS) - 1, job.importedRows)
+        self.assertEqual(["Entity with name 'Keynote' already exists"],
+                         job.errors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""test_mail.py
+
+Tests of the mail tasks on App Engine testbed stubs: the mail pull
+queue drained by the send_queued_emails cron job, the attendee
+notifications buffered in it, and the legacy send_confirmation_email
+push task. Run them with the SDK given in
+APPENGINE_SDK:
+
+    APPENGINE_SDK=$SDK/platform/google_appengine python -m unittest discover tests
+
+"""
+
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path.insert(0, ROOT)
+
+import webapp2
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import conference
+import main
+from conference import ConferenceApi
+from conference import MAIL_QUEUE
+from models import Conference
+from models import Profile
+from stubs import StubTestCase
+
+
+class MailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def request(self, path, **kwargs):
+        return webapp2.Request.blank(path, **kwargs).get_response(main.app)
+
+    def queuedTasks(self):
+        return self.taskqueue_stub.get_filtered_tasks(
+            queue_names=[MAIL_QUEUE])
+
+    def testQueuedEmailsAreCombinedPerRecipientAndSubject(self):
+        ConferenceApi._queueEmails([
+            ('a@example.com', 'Subject', 'first'),
+            ('a@example.com', 'Subject', 'second'),
+            ('b@example.com', 'Subject', 'third'),
+        ])
+        self.assertEqual(3, len(self.queuedTasks()))
+
+        response = self.request('/crons/send_queued_emails')
+        self.assertEqual(204, response.status_int)
+
+        messages = self.mail_stub.get_sent_messages(to='a@example.com')
+        self.assertEqual(1, len(messages))
+        self.assertEqual('Subject', messages[0].subject)
+        body = messages[0].body.decode()
+        self.assertIn('first', body)
+        self.assertIn('second', body)
+        messages = self.mail_stub.get_sent_messages(to='b@example.com')
+        self.assertEqual(1, len(messages))
+        self.assertEqual('third', messages[0].body.decode())
+        self.assertEqual([], self.queuedTasks())
+
+    def testFailedEmailStaysQueued(self):
+        ConferenceApi._queueEmails([
+            ('a@example.com', 'Subject', 'sent'),
+            ('b@example.com', 'Subject', 'failed'),
+        ])
+        send_mail = conference.mail.send_mail
+
+        def failing_send_mail(sender, to, subject, body):
+            if to == 'b@example.com':
+                raise Exception('Mail service unavailable')
+            return send_mail(sender, to, subject, body)
+
+        conference.mail.send_mail = failing_send_mail
+        try:
+            sent, failed = ConferenceApi._sendQueuedEmails()
+        finally:
+            conference.mail.send_mail = send_mail
+
+        self.assertEqual((1, 1), (sent, failed))
+        self.assertEqual(
+            1, len(self.mail_stub.get_sent_messages(to='a@example.com')))
+        tasks = self.queuedTasks()
+        self.assertEqual(1, len(tasks))
+        self.assertEqual('b@example.com',
+                         json.loads(tasks[0].payload)['to'])
+
+    def testLegacyConfirmationEmailTask(self):
+        response = self.request('/tasks/send_confirmation_email', POST={
+            'email': 'organizer@example.com',
+            'conferenceInfo': 'Test Conference',
+        })
+        self.assertEqual(200, response.status_int)
+
+        messages = self.mail_stub.get_sent_messages(
+            to='organizer@example.com')
+        self.assertEqual(1, len(messages))
+        self.assertEqual('You created a new Conference!',
+                         messages[0].subject)
+        self.assertIn('Test Conference', messages[0].body.decode())
+
+
+class NotifyAttendeesTest(StubTestCase):
+
+    def setUp(self):
+        super(NotifyAttendeesTest, self).setUp()
+        self.c_key = Conference(parent=ndb.Key(Profile, 'organizer'),
+                                name='Conf').put()
+        ndb.put_multi([Profile(key=ndb.Key(Profile, 'user%d' % i),
+                               mainEmail='user%d@example.com' % i,
+                               conferenceKeysToAttend=[self.c_key])
+                       for i in range(3)])
+
+    def notify(self):
+        ConferenceApi._notifyAttendees(self.c_key.urlsafe(), 'Subject',
+                                       'Body', '1-2')
+
+    def testRetriedPageBuffersItsEmailsOnce(self):
+        self.notify()
+        self.notify()
+        self.assertEqual(3, len(self.tasks(queue_names=[MAIL_QUEUE])))
+        self.assertEqual(
+            1, len(self.tasks(url='/tasks/send_queued_emails')))
+
+    def testPageIsSentWithoutWaitingForTheCron(self):
+        self.notify()
+        [task] = self.tasks(url='/tasks/send_queued_emails')
+        response = self.request(task.url, method='POST')
+        self.assertEqual(200, response.status_int)
+        self.assertEqual([], self.tasks(queue_names=[MAIL_QUEUE]))
+        mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.assertEqual(3, len(mail_stub.get_sent_messages(
+            subject='Subject')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""test_registration.py
+
+Tests of the bulk and group registration endpoints, in particular of
+how they account for seats.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+import endpoints
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import storage
+from conference import GROUP_REGISTRATION_MAX
+from conference import GROUP_REGISTRATION_REQUEST
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceKeysForm
+from models import Profile
+
+ORGANIZER = 'organizer@example.com'
+USER = 'user@example.com'
+
+
+class FailingProfileStorage(storage.NdbStorage):
+    """Fails every write of Profiles."""
+
+    def putMulti(self, entities):
+        if any(isinstance(entity, Profile) for entity in entities):
+            raise datastore_errors.TransactionFailedError()
+        return super(FailingProfileStorage, self).putMulti(entities)
+
+
+class RegistrationTest(StubTestCase):
+
+    def setUp(self):
+        super(RegistrationTest, self).setUp()
+        organizer = ndb.Key(Profile, ORGANIZER)
+        self.full, self.roomy = [
+            Conference(parent=organizer, name=name, organizerUserId=ORGANIZER,
+                       maxAttendees=10, seatsAvailable=seats).put()
+            for name, seats in (('Full', 1), ('Roomy', 10))]
+        Profile(key=ndb.Key(Profile, USER), mainEmail=USER).put()
+
+    def seats(self, c_key):
+        return c_key.get(use_cache=False).seatsAvailable
+
+    def register(self, *c_keys):
+        self.login(USER)
+        return ConferenceApi().registerForConferences(ConferenceKeysForm(
+            websafeConferenceKeys=[c_key.urlsafe() for c_key in c_keys]))
+
+    def registerGroup(self, c_key, emails):
+        return ConferenceApi().registerGroupForConference(
+            GROUP_REGISTRATION_REQUEST.combined_message_class(
+                websafeConferenceKey=c_key.urlsafe(), emails=emails))
+
+    def testSeatsAreTakenOncePerRegistration(self):
+        results = self.register(self.full, self.full, self.roomy).items
+        self.assertEqual([True, False, True],
+                         [result.success for result in results])
+        self.assertEqual(0, self.seats(self.full))
+        self.assertEqual(9, self.seats(self.roomy))
+        prof = ndb.Key(Profile, USER).get(use_cache=False)
+        self.assertEqual([self.full, self.roomy],
+                         prof.conferenceKeysToAttend)
+
+    def testRegisteringAgainTakesNoSeat(self):
+        self.register(self.roomy)
+        [result] = self.register(self.roomy).items
+        self.assertFalse(result.success)
+        self.assertEqual(9, self.seats(self.roomy))
+
+    def testGroupBeyondTheSeatsIsPartlyRegistered(self):
+        self.login(ORGANIZER)
+        results = self.registerGroup(
+            self.full, ['a@example.com', 'b@example.com']).items
+        self.assertEqual([True, False], [r.success for r in results])
+        self.assertEqual('There are no seats available.', results[1].error)
+        self.assertEqual(0, self.seats(self.full))
+
+    def testSeatsOfFailedWritesAreGivenBack(self):
+        storage.setStorage(FailingProfileStorage())
+        results = self.register(self.full, self.roomy).items
+        self.assertFalse(any(result.success for result in results))
+        self.assertEqual(1, self.seats(self.full))
+        self.assertEqual(10, self.seats(self.roomy))
+
+    def testOnlyTheOrganizerRegistersAGroup(self):
+        self.login(USER)
+        self.assertRaises(endpoints.ForbiddenException, self.registerGroup,
+                          self.roomy, ['a@example.com'])
+        self.assertEqual(10, self.seats(self.roomy))
+
+    def testOversizedGroupIsRejected(self):
+        self.login(ORGANIZER)
+        emails = ['user%d@example.com' % i
+                  for i in range(GROUP_REGISTRATION_MAX + 1)]
+        self.assertRaises(endpoints.BadRequestException, self.registerGroup,
+                          self.roomy, emails)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""test_sessions.py
+
+Tests of the session endpoints: the projections the list endpoints
+pick for `fields`, and the unique names claimed by created sessions.
+
+"""
+
+import unittest
+from datetime import date
+from datetime import time
+
+from stubs import StubTestCase
+
+import endpoints
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from conference import SESS_GET_REQUEST
+from conference import SESSION_FIELD_PROPERTIES
+from conference import SESSION_PROJECTIONS
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionForm
+from models import SessionForms
+
+ORGANIZER = 'organizer@example.com'
+
+
+class ProjectionTest(StubTestCase):
+
+    requireIndexes = True
+
+    def setUp(self):
+        super(ProjectionTest, self).setUp()
+        self.c_key = Conference(parent=ndb.Key(Profile, ORGANIZER),
+                                name='Conf', organizerUserId=ORGANIZER).put()
+        Session(parent=self.c_key, name='Keynote', highlights='Opening',
+                duration='01:00', typeOfSession='talk',
+                date=date(2026, 5, 1), startTime=time(9)).put()
+
+    def projection(self, fields):
+        return ConferenceApi._projectionFor(
+            fields, SESSION_FIELD_PROPERTIES, indexed=SESSION_PROJECTIONS)
+
+    def sessions(self, fields):
+        return ConferenceApi().getConferenceSessions(
+            SESS_GET_REQUEST.combined_message_class(
+                websafeConfKey=self.c_key.urlsafe(), fields=fields)).items
+
+    def testIndexedFieldSetsAreProjected(self):
+        self.assertEqual(['date', 'name', 'startTime'],
+                         self.projection(['name', 'date', 'startTime']))
+        self.assertEqual(['name'], self.projection(['name', 'sessionKey']))
+
+    def testOtherFieldSetsFetchWholeEntities(self):
+        self.assertEqual(None, self.projection(['name', 'highlights']))
+        self.assertEqual(None, self.projection(['name', 'startTime']))
+        self.assertEqual(None, self.projection(['sessionKey']))
+
+    def testEveryIndexedProjectionRuns(self):
+        # require_indexes makes queries index.yaml lacks an index for
+        # raise NeedIndexError instead of falling back
+        for projection in SESSION_PROJECTIONS:
+            Session.query(ancestor=self.c_key).fetch(projection=projection)
+
+    def testFieldsAreFilledEitherWay(self):
+        for fields in (['name', 'date', 'startTime'],
+                       ['name', 'highlights']):
+            [form] = self.sessions(fields)
+            self.assertEqual('Keynote', form.name)
+            for name in fields:
+                self.assertTrue(getattr(form, name), name)
+
+
+class UniqueNameTest(StubTestCase):
+
+    def setUp(self):
+        super(UniqueNameTest, self).setUp()
+        self.c_key = Conference(parent=ndb.Key(Profile, ORGANIZER),
+                                name='Conf', organizerUserId=ORGANIZER).put()
+        self.login(ORGANIZER)
+
+    def form(self, name):
+        return SessionForm(name=name, websafeConfKey=self.c_key.urlsafe())
+
+    def testNamesAreUniqueWithinABatch(self):
+        results = ConferenceApi().createSessions(SessionForms(items=[
+            self.form('Keynote'), self.form('keynote'),
+            self.form('Closing')])).items
+        self.assertEqual([True, False, True],
+                         [result.success for result in results])
+        self.assertEqual(2, Session.query(ancestor=self.c_key).count())
+
+    def testTakenNameIsRefused(self):
+        ConferenceApi().createSession(self.form('Keynote'))
+        self.assertRaises(endpoints.BadRequestException,
+                          ConferenceApi().createSession,
+                          self.form('KEYNOTE'))
+        [result] = ConferenceApi().createSessions(
+            SessionForms(items=[self.form('Keynote')])).items
+        self.assertFalse(result.success)
+        self.assertEqual(1, Session.query(ancestor=self.c_key).count())
+
+    def testLegacySessionNameIsRefused(self):
+        # Written before names were claimed, so without a marker
+        Session(parent=self.c_key, name='Keynote').put()
+        self.assertRaises(endpoints.BadRequestException,
+                          ConferenceApi().createSession,
+                          self.form('Keynote'))
+
+
+if __name__ == '__main__':
+    unittest.main()
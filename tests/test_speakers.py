@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""test_speakers.py
+
+Tests of the speaker listings, of the lookup of speakers by name and
+of the limits of the bulk create endpoints.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+import endpoints
+from google.appengine.ext import ndb
+
+import storage
+from conference import ConferenceApi
+from conference import REGISTRATION_BATCH_MAX
+from conference import SPEAKERS_REQUEST
+from models import ConferenceForm
+from models import ConferenceForms
+from models import SessionForm
+from models import SessionForms
+from models import Speaker
+from utils import normalizeName
+
+NAMES = ['Ada Lovelace', 'Alan Turing', 'Barbara Liskov', 'Grace Hopper',
+         'Edsger Dijkstra']
+
+
+class SpeakerListTest(StubTestCase):
+
+    def setUp(self):
+        super(SpeakerListTest, self).setUp()
+        ndb.put_multi([Speaker(name=name, normalizedName=normalizeName(name))
+                       for name in NAMES])
+
+    def page(self, cursor=None, pageSize=2):
+        return ConferenceApi().getAllSpeakers(
+            SPEAKERS_REQUEST.combined_message_class(
+                pageSize=pageSize, websafeCursor=cursor))
+
+    def testPagesCoverEverySpeakerOnce(self):
+        names, cursor = [], None
+        while True:
+            page = self.page(cursor)
+            self.assertTrue(len(page.items) <= 2)
+            names.extend(item.name for item in page.items)
+            cursor = page.nextCursor
+            if not cursor:
+                break
+        self.assertEqual(sorted(NAMES), names)
+
+    def testInvalidCursorIsRejected(self):
+        self.assertRaises(endpoints.BadRequestException,
+                          self.page, 'not a cursor')
+
+
+class SpeakerLookupTest(StubTestCase):
+
+    def testNamesAreMatchedNormalized(self):
+        keys = ConferenceApi._speakerKeysForNames(
+            ['Ada Lovelace', 'ada  lovelace', 'Alan Turing'])
+        self.assertEqual(keys['Ada Lovelace'], keys['ada  lovelace'])
+        self.assertEqual(2, Speaker.query().count())
+        again = ConferenceApi._speakerKeysForNames(['ADA LOVELACE'])
+        self.assertEqual(keys['Ada Lovelace'], again['ADA LOVELACE'])
+        self.assertEqual(2, Speaker.query().count())
+
+    def testMarkedNamesAreFoundWithoutQueries(self):
+        ConferenceApi._speakerKeysForNames(['Ada Lovelace'])
+        backend = storage.getStorage()
+        query = backend.query
+        backend.query = lambda *args, **kwargs: self.fail('Queried')
+        try:
+            ConferenceApi._speakerKeysForNames(['Ada Lovelace'])
+        finally:
+            backend.query = query
+
+    def testLegacySpeakerIsFoundAndMarked(self):
+        s_key = Speaker(name='Grace Hopper').put()
+        keys = ConferenceApi._speakerKeysForNames(['Grace Hopper'])
+        self.assertEqual(s_key, keys['Grace Hopper'])
+        marker = ConferenceApi._speakerNameKey('Grace Hopper').get()
+        self.assertEqual(s_key, marker.owner)
+
+    def testMigrationMarksTheFirstOfSameNamedSpeakers(self):
+        s_keys = ndb.put_multi([Speaker(name='Grace Hopper'),
+                                Speaker(name='grace hopper')])
+        markers = ConferenceApi._missingUniqueValues(
+            ndb.get_multi(s_keys))
+        self.assertEqual(1, len(markers))
+        self.assertEqual(s_keys[0], markers[0].owner)
+
+
+class BulkLimitTest(StubTestCase):
+
+    def setUp(self):
+        super(BulkLimitTest, self).setUp()
+        self.login('organizer@example.com')
+
+    def testOversizedConferenceBatchIsRejected(self):
+        forms = ConferenceForms(items=[
+            ConferenceForm(name='Conf %d' % i)
+            for i in range(REGISTRATION_BATCH_MAX + 1)])
+        self.assertRaises(endpoints.BadRequestException,
+                          ConferenceApi().createConferences, forms)
+
+    def testOversizedSessionBatchIsRejected(self):
+        forms = SessionForms(items=[
+            SessionForm(name='Session %d' % i, websafeConfKey='x')
+            for i in range(REGISTRATION_BATCH_MAX + 1)])
+        self.assertRaises(endpoints.BadRequestException,
+                          ConferenceApi().createSessions, forms)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""test_storage.py
+
+Tests that MemoryStorage answers queries the way NdbStorage does on the
+datastore stub, and that the conference endpoints run on it.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.ext import ndb
+
+import storage
+from conference import CONF_GET_REQUEST
+from conference import CONF_POST_REQUEST
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import ConferenceForms
+from models import Profile
+from models import Session
+
+ORGANIZER = 'organizer@example.com'
+
+CONFERENCES = [
+    dict(name='A', city='London', topics=['Medical', 'Web'], month=6),
+    dict(name='B', city='Paris', topics=['Web'], month=3),
+    dict(name='C', city='London', topics=[], month=6),
+    dict(name='D', city=None, topics=['Medical'], month=1),
+]
+
+# (filters, orders, whether the result order is defined)
+QUERIES = [
+    ([('city', '=', 'London')], [], True),
+    ([('topics', '=', 'Web')], [], True),
+    ([('topics', 'IN', ['Medical', 'Web'])], [], True),
+    ([('topics', 'IN', [])], [], True),
+    ([('month', '>', 2)], ['month'], True),
+    ([('month', '>=', 3), ('month', '<', 6)], [], True),
+    ([], ['city'], True),
+    ([], ['topics'], True),
+    ([], ['-topics', 'name'], True),
+    ([('city', '!=', None)], [], False),
+]
+
+
+class MemoryStorageTest(StubTestCase):
+
+    def setUp(self):
+        super(MemoryStorageTest, self).setUp()
+        self.ndb = storage.NdbStorage()
+        self.memory = storage.MemoryStorage()
+        p_key = ndb.Key(Profile, ORGANIZER)
+        for backend in (self.ndb, self.memory):
+            backend.putMulti([
+                Conference(key=ndb.Key(Conference, i + 1, parent=p_key),
+                           **values)
+                for i, values in enumerate(CONFERENCES)])
+            backend.putMulti([
+                Session(parent=ndb.Key(Conference, c_id, parent=p_key),
+                        name=name)
+                for c_id, name in ((1, 'Keynote'), (2, 'Closing'))])
+
+    def assertSameResults(self, filters=(), orders=(), ordered=True, **kwargs):
+        results = [backend.query(Conference, filters=filters, orders=orders,
+                                 keysOnly=True, **kwargs)
+                   for backend in (self.ndb, self.memory)]
+        if not ordered:
+            results = [sorted(keys) for keys in results]
+        self.assertEqual(results[0], results[1], (filters, orders))
+        return results[1]
+
+    def testQueriesMatchTheDatastore(self):
+        for filters, orders, ordered in QUERIES:
+            self.assertSameResults(filters, orders, ordered)
+
+    def testRepeatedPropertiesMatchAnyValue(self):
+        keys = self.assertSameResults([('topics', '=', 'Medical')])
+        self.assertEqual([1, 4], [key.id() for key in keys])
+
+    def testEntitiesWithoutValuesAreLeftOutOfOrders(self):
+        keys = self.assertSameResults(orders=['topics'])
+        self.assertNotIn(3, [key.id() for key in keys])
+
+    def testLimitAppliesAfterOrdering(self):
+        keys = self.assertSameResults(orders=['-month', 'name'], limit=2)
+        self.assertEqual([1, 3], [key.id() for key in keys])
+
+    def testAncestorQueries(self):
+        c_key = ndb.Key(Conference, 1, parent=ndb.Key(Profile, ORGANIZER))
+        names = [[sess.name for sess in backend.query(Session, ancestor=c_key)]
+                 for backend in (self.ndb, self.memory)]
+        self.assertEqual(['Keynote'], names[0])
+        self.assertEqual(names[0], names[1])
+
+    def testEntitiesAreCopied(self):
+        c_key = ndb.Key(Conference, 1, parent=ndb.Key(Profile, ORGANIZER))
+        conf = self.memory.get(c_key)
+        conf.city = 'Berlin'
+        self.assertEqual('London', self.memory.get(c_key).city)
+
+
+class MemoryConferenceTest(StubTestCase):
+
+    def setUp(self):
+        super(MemoryConferenceTest, self).setUp()
+        self.memory = storage.MemoryStorage()
+        storage.setStorage(self.memory)
+        self.login(ORGANIZER)
+        self.api = ConferenceApi()
+
+    def testConferenceLifecycle(self):
+        form = self.api.createConference(ConferenceForm(
+            name='Conf', city='London', maxAttendees=10))
+        c_key = self.memory.first(Conference, keysOnly=True)
+        self.assertEqual(ORGANIZER, form.organizerUserId)
+
+        self.api.updateConference(CONF_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=c_key.urlsafe(), city='Paris'))
+        self.assertEqual('Paris', self.memory.get(c_key).city)
+
+        self.api.deleteConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=c_key.urlsafe()))
+        self.assertTrue(self.memory.get(c_key).deleted)
+        # Nothing was written to the datastore stub
+        self.assertEqual(0, Conference.query().count())
+
+    def testBulkCreateAllocatesDistinctKeys(self):
+        result = self.api.createConferences(ConferenceForms(items=[
+            ConferenceForm(name='Conf %d' % i) for i in range(3)]))
+        self.assertTrue(all(item.success for item in result.items))
+        self.assertEqual(3, len(set(item.websafeKey
+                                    for item in result.items)))
+        self.assertEqual(3, len(self.memory.query(Conference)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""test_waitlist.py
+
+Tests of the conference waitlist: joining it, and the promotion of
+waiting users, first come first served, as seats free up.
+
+"""
+
+import unittest
+
+from stubs import StubTestCase
+
+from google.appengine.ext import ndb
+
+from conference import CONF_GET_REQUEST
+from conference import ConferenceApi
+from models import ConflictException
+from models import Conference
+from models import Profile
+from models import WaitlistEntry
+
+ORGANIZER = 'organizer@example.com'
+
+
+class WaitlistTest(StubTestCase):
+
+    def setUp(self):
+        super(WaitlistTest, self).setUp()
+        self.c_key = Conference(parent=ndb.Key(Profile, ORGANIZER),
+                                name='Conf', organizerUserId=ORGANIZER,
+                                maxAttendees=1, seatsAvailable=0).put()
+        self.wsck = self.c_key.urlsafe()
+
+    def call(self, method, user):
+        self.login(user)
+        return getattr(ConferenceApi(), method)(
+            CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=self.wsck))
+
+    def registered(self, user):
+        prof = ndb.Key(Profile, user).get(use_cache=False)
+        return self.c_key in prof.conferenceKeysToAttend
+
+    def testUserWaitsOnce(self):
+        self.assertTrue(self.call('joinWaitlist', 'a@example.com').data)
+        self.assertRaises(ConflictException, self.call, 'joinWaitlist',
+                          'a@example.com')
+        self.assertEqual(1, WaitlistEntry.query().count())
+
+    def testLeavingTwiceIsHarmless(self):
+        self.call('joinWaitlist', 'a@example.com')
+        self.assertTrue(self.call('leaveWaitlist', 'a@example.com').data)
+        self.assertFalse(self.call('leaveWaitlist', 'a@example.com').data)
+
+    def testFreedSeatGoesToTheFirstWaitingUser(self):
+        for user in ('a@example.com', 'b@example.com'):
+            self.call('joinWaitlist', user)
+        conf = self.c_key.get()
+        conf.seatsAvailable = 1
+        conf.put()
+
+        ConferenceApi._promoteWaitlist(self.wsck)
+        # A duplicate task finds no seat left
+        ConferenceApi._promoteWaitlist(self.wsck)
+
+        self.assertTrue(self.registered('a@example.com'))
+        self.assertFalse(self.registered('b@example.com'))
+        self.assertEqual(0, self.c_key.get(use_cache=False).seatsAvailable)
+        [entry] = WaitlistEntry.query().fetch()
+        self.assertEqual('b@example.com', entry.userId)
+
+
+if __name__ == '__main__':
+    unittest.main()
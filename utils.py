@@ -7,6 +7,11 @@ from google.appengine.api import urlfetch
 from models import Profile
 
 
+def normalizeName(name):
+    """Lowercase a name and collapse its whitespace, for comparisons."""
+    return u' '.join(name.lower().split())
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()